@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# Benchmark: per-request CPU overhead of the demo API outside the LLM call.
+# Compares the former cold path (read features.csv, build a jinja2 Environment, pandas merge/groupby per request)
+# with the preloaded ServingCore of api.py. A fixed model answer is used, so no LLM requests are made.
+#
+# Usage:
+#   ./bench_demo_serving.py --requests 500
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import jinja2
+import pandas as pd
+
+demo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "demo_application")
+sys.path.insert(0, demo_dir)
+# The client is created at import, but no requests are made
+os.environ.setdefault("TOGETHER_API_KEY", "stub")
+import api
+
+
+# Function to run the local part of evaluateFeatures as it was before the serving core (everything per request)
+def coldRequest(text_input, output):
+    features = pd.read_csv(os.path.join(demo_dir, "features.csv"))
+    features_definition_csv = features[["feature_name", "description", "rating_options"]].to_csv(index=False)
+    templateEnv = jinja2.Environment(loader=jinja2.FileSystemLoader(searchpath=os.path.join(demo_dir, "prompts")))
+    templateEnv.get_template("features.j2").render(text_input=text_input, features=features_definition_csv)
+    model_output = json.loads(output)
+    model_output_df = pd.DataFrame(model_output.items(), columns=["feature_name", "score"])
+    features = pd.merge(features, model_output_df, on="feature_name")
+    clusters = features.groupby("cluster")["score"].mean().round(2).reset_index()
+    return {
+        "features": features.set_index("feature_name").to_dict()["score"],
+        "cluster": clusters.set_index("cluster").to_dict()["score"],
+    }
+
+
+# Function to run the local part of evaluateFeatures with the preloaded serving core
+def warmRequest(text_input, output):
+    api.createFeaturePrompt(text_input=text_input, features=api.serving_core.features_definition_csv)
+    return api.scoreFeatures(json.loads(output))
+
+
+# Function to measure CPU and wall time per request
+def measure(request, text_inputs, output):
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for text_input in text_inputs:
+        request(text_input, output)
+    n = len(text_inputs)
+    return {
+        "cpu_ms/request": (time.process_time() - cpu_start) / n * 1000,
+        "wall_ms/request": (time.perf_counter() - wall_start) / n * 1000,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-request CPU overhead of the demo API")
+    parser.add_argument("--requests", type=int, default=500)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    output = json.dumps({feature_name: rng.randint(0, 3) for feature_name in api.serving_core.feature_names})
+    text_inputs = [f"example post {idx} " * 50 for idx in range(args.requests)]
+
+    assert coldRequest(text_inputs[0], output) == warmRequest(text_inputs[0], output)
+    results = {
+        "cold (per request)": measure(coldRequest, text_inputs, output),
+        "ServingCore": measure(warmRequest, text_inputs, output),
+    }
+    print(pd.DataFrame(results).T.round(3).to_string())
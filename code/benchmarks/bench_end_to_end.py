@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# End-to-end benchmark: replays the posts of data/si_dataset_1k.csv through Part 1 (C-SSRS scoring),
+# Part 3 (feature evaluation, post by post as in main.py) and the endpoints of the demo application.
+# Reports posts per second, p50/p99 latency per post and LLM calls per post (counted by the stub server).
+#
+# Usage (response cache disabled so every post reaches the stub):
+#   ./stub_llm_server.py --port 8008 --latency 0.5 --latency-dist lognormal --malformed-rate 0.05
+#   export TOGETHER_BASE_URL=http://127.0.0.1:8008/v1 TOGETHER_API_KEY=stub LLM_CACHE_DISABLED=1
+#   (cd ../demo_application && ./app.py)                       # for the demo stage (or uvicorn asgi:app --port 5001)
+#   ./bench_end_to_end.py --posts 200 --stages part1 part3 demo
+
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import time
+
+import httpx
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mainanalysis"))
+import functions
+from functions import evaluateAllCategories, getFeaturesAsString, scoreCSSRSConcurrently
+from structured_output import parseStats
+
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data")
+
+
+# Function to read the request counter of the stub server
+def stubRequests(base_url):
+    return httpx.get(base_url.rsplit("/v1", 1)[0] + "/stats").json()["requests"]
+
+
+# Function to summarize the latencies of one stage
+def summarize(stage, n, errors, elapsed, latencies, calls):
+    latencies = np.array(latencies) if latencies else np.array([np.nan])
+    return {
+        "stage": stage,
+        "posts": n,
+        "errors": errors,
+        "seconds": elapsed,
+        "posts/s": n / elapsed,
+        "p50_s": np.nanpercentile(latencies, 50),
+        "p99_s": np.nanpercentile(latencies, 99),
+        "calls/post": calls / n,
+    }
+
+
+# Part 1: score the C-SSRS questions of all posts concurrently, as main.py does
+# The latency of a post is timed around its scoring function, from its start to its (possibly re-asked) answer
+def runPart1(texts):
+    latencies = []
+    score = functions.getLLMAnswerSafeguardAsync
+
+    async def timedScore(async_client, text_input):
+        start = time.perf_counter()
+        try:
+            return await score(async_client, text_input)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    functions.getLLMAnswerSafeguardAsync = timedScore
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            outputs, errors = scoreCSSRSConcurrently(texts)
+    finally:
+        functions.getLLMAnswerSafeguardAsync = score
+    return sum(error is not None for error in errors), latencies
+
+
+# Part 3: evaluate the features of all categories post by post, as main.py does
+# Posts with categories missing after all re-asks count as errors
+def runPart3(texts, features_strings_dict):
+    latencies = []
+    errors = 0
+    for text_input in texts:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            feature_evaluation_dict, calls = evaluateAllCategories(text_input, features_strings_dict, merged=functions.config.merged_feature_evaluation)
+        latencies.append(time.perf_counter() - start)
+        errors += len(feature_evaluation_dict) < len(features_strings_dict)
+    return errors, latencies
+
+
+# Demo application: post every text to a route with a fixed number of clients
+async def runDemo(url, route, texts, concurrency, timeout):
+    latencies = []
+    errors = 0
+    queue = iter(texts)
+
+    async def client(http):
+        nonlocal errors
+        for text_input in queue:
+            start = time.perf_counter()
+            try:
+                response = await http.post(url + route, json={"text_input": text_input})
+                response.raise_for_status()
+                if response.json().get("errors"):
+                    errors += 1
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    # One small connection pool per 25 clients, a single large httpx pool costs more CPU per request
+    shards = [httpx.AsyncClient(limits=httpx.Limits(max_connections=25), timeout=timeout)
+              for _ in range((concurrency + 24) // 25)]
+    await asyncio.gather(*(client(shards[i // 25]) for i in range(concurrency)))
+    for http in shards:
+        await http.aclose()
+    return errors, latencies
+
+
+# Function to build the feature strings per category from the final feature definitions
+def loadFeatureStrings(path):
+    final_df = pd.read_csv(path, index_col=0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return {category: getFeaturesAsString(category_df) for category, category_df in final_df.groupby("category", sort=False)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end throughput of the pipeline and the demo application")
+    parser.add_argument("--posts", type=int, default=100, help="number of posts from si_dataset_1k.csv")
+    parser.add_argument("--stages", nargs="+", default=["part1", "part3", "demo"], choices=["part1", "part3", "demo"])
+    parser.add_argument("--dataset", default=os.path.join(data_dir, "si_dataset_1k.csv"))
+    parser.add_argument("--features", default=os.path.join(data_dir, "feature_definitions_final.csv"))
+    parser.add_argument("--demo-url", default="http://127.0.0.1:5001")
+    parser.add_argument("--routes", nargs="+", default=["/evaluate"], help="demo routes to replay the posts to")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients of the demo stage")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--output", help="CSV file for the results")
+    args = parser.parse_args()
+    base_url = os.getenv("TOGETHER_BASE_URL", "http://127.0.0.1:8008/v1")
+
+    functions.llm_cache.enabled = False
+    texts = pd.read_csv(args.dataset)["text"].head(args.posts).tolist()
+
+    stages = []
+    for stage in args.stages:
+        if stage == "demo":
+            stages += [(f"demo {route}", route) for route in args.routes]
+        else:
+            stages.append((stage, None))
+
+    results = []
+    for stage, route in stages:
+        if route is not None:
+            try:
+                httpx.get(args.demo_url, timeout=5)
+            except httpx.HTTPError:
+                print(f"Skipping {stage}: no demo application at {args.demo_url}")
+                continue
+        calls_before = stubRequests(base_url)
+        start = time.perf_counter()
+        if stage == "part1":
+            errors, latencies = runPart1(texts)
+        elif stage == "part3":
+            errors, latencies = runPart3(texts, loadFeatureStrings(args.features))
+        else:
+            errors, latencies = asyncio.run(runDemo(args.demo_url, route, texts, args.concurrency, args.timeout))
+        elapsed = time.perf_counter() - start
+        results.append(summarize(stage, len(texts), errors, elapsed, latencies, stubRequests(base_url) - calls_before))
+        print(f"{stage}: done in {elapsed:.1f}s")
+
+    results = pd.DataFrame(results).set_index("stage").round(3)
+    print(results.to_string())
+    print("Parsing of the pipeline answers:")
+    print(pd.DataFrame(parseStats()).T.to_string())
+    if args.output:
+        results.to_csv(args.output)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# Benchmark: merged multi-category feature evaluation vs. the per-category loop of Part 3.
+# Reports LLM calls, prompt/completion tokens and latency per post for both modes.
+# The response cache is bypassed so that every request reaches the endpoint.
+#
+# Usage (against the stub server, see README.md):
+#   ./bench_feature_evaluation.py --posts 20
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mainanalysis"))
+import functions
+from functions import evaluateAllCategories, getFeaturesAsString
+
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data")
+
+
+# Counts calls and token usage of every chat-completion request
+class UsageCounter:
+    def __init__(self, create):
+        self.create = create
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def __call__(self, *args, **kwargs):
+        completion = self.create(*args, **kwargs)
+        self.calls += 1
+        if completion.usage is not None:
+            self.prompt_tokens += completion.usage.prompt_tokens
+            self.completion_tokens += completion.usage.completion_tokens
+        return completion
+
+
+# Function to build the feature strings per category from the final feature definitions
+def loadFeatureStrings(path):
+    final_df = pd.read_csv(path, index_col=0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return {category: getFeaturesAsString(category_df) for category, category_df in final_df.groupby("category", sort=False)}
+
+
+# Function to evaluate all posts in one mode and summarize the usage per post
+def runMode(texts, features_strings_dict, merged, counter):
+    counter.reset()
+    latencies = []
+    missing = 0
+    for text_input in texts:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            feature_evaluation_dict, calls = evaluateAllCategories(text_input, features_strings_dict, merged=merged)
+        latencies.append(time.perf_counter() - start)
+        missing += len(features_strings_dict) - len(feature_evaluation_dict)
+    n = len(texts)
+    return {
+        "mode": "merged" if merged else "per-category",
+        "calls/post": counter.calls / n,
+        "prompt_tokens/post": counter.prompt_tokens / n,
+        "completion_tokens/post": counter.completion_tokens / n,
+        "latency_mean_s": sum(latencies) / n,
+        "latency_max_s": max(latencies),
+        "categories_missing": missing,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare merged and per-category feature evaluation")
+    parser.add_argument("--posts", type=int, default=20, help="number of posts from si_dataset_1k.csv")
+    parser.add_argument("--features", default=os.path.join(data_dir, "feature_definitions_final.csv"))
+    parser.add_argument("--dataset", default=os.path.join(data_dir, "si_dataset_1k.csv"))
+    args = parser.parse_args()
+
+    functions.llm_cache.enabled = False
+    counter = UsageCounter(functions.llm_client.chat.completions.create)
+    functions.llm_client.chat.completions.create = counter
+
+    features_strings_dict = loadFeatureStrings(args.features)
+    texts = pd.read_csv(args.dataset)["text"].head(args.posts).tolist()
+
+    results = [runMode(texts, features_strings_dict, merged, counter) for merged in (False, True)]
+    print(f"{len(texts)} posts, {len(features_strings_dict)} categories")
+    print(pd.DataFrame(results).set_index("mode").round(3).to_string())
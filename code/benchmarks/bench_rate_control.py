@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# Benchmark: adaptive rate control (rate_control.py) against a stub server that throttles.
+# Sends the same requests once with a fixed number of requests in flight and no retries (the former behaviour),
+# and once through RateController. Reports finished and failed requests, 429s seen, throughput
+# and the concurrency limit the controller settled on.
+#
+# Usage:
+#   ./stub_llm_server.py --port 8008 --latency 0.5 --max-concurrent 20 --rpm 1800
+#   export TOGETHER_BASE_URL=http://127.0.0.1:8008/v1 TOGETHER_API_KEY=stub
+#   ./bench_rate_control.py --requests 600 --in-flight 64
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import httpx
+import pandas as pd
+from together import AsyncTogether
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mainanalysis"))
+from rate_control import RateController, estimateRequestTokens
+
+model_id = "meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo"
+
+
+# Function to read the counters of the stub server
+def stubStats(base_url):
+    return httpx.get(base_url.rsplit("/v1", 1)[0] + "/stats").json()
+
+
+# Function to send n requests with at most in_flight at a time, through the controller if one is given
+async def run(n, in_flight, controller):
+    finished = 0
+    failed = 0
+    async with AsyncTogether(max_retries=0) as client:
+        semaphore = asyncio.Semaphore(in_flight)
+
+        async def one(i):
+            nonlocal finished, failed
+            messages = [{"role": "user", "content": f"Wish to be Dead, request {i}"}]
+            call = lambda: client.chat.completions.create(model=model_id, messages=messages)
+            async with semaphore:
+                try:
+                    if controller is None:
+                        await call()
+                    else:
+                        await controller.callAsync(call, estimateRequestTokens(messages, 100))
+                    finished += 1
+                except Exception:
+                    failed += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(n)))
+        elapsed = time.perf_counter() - start
+    return finished, failed, elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Adaptive rate control against a throttling stub server")
+    parser.add_argument("--requests", type=int, default=600)
+    parser.add_argument("--in-flight", type=int, default=64, help="requests in flight of the fixed mode and upper limit of the controller")
+    parser.add_argument("--rpm", type=float, default=None, help="requests per minute for the controller's token bucket")
+    args = parser.parse_args()
+    base_url = os.getenv("TOGETHER_BASE_URL", "http://127.0.0.1:8008/v1")
+
+    rows = []
+    for mode in ["fixed", "adaptive"]:
+        controller = None
+        if mode == "adaptive":
+            controller = RateController(requests_per_minute=args.rpm, max_concurrency=args.in_flight, max_retries=8, backoff=0.5)
+        before = stubStats(base_url)
+        finished, failed, elapsed = asyncio.run(run(args.requests, args.in_flight, controller))
+        after = stubStats(base_url)
+        row = {
+            "mode": mode,
+            "finished": finished,
+            "failed": failed,
+            "http_requests": after["requests"] - before["requests"],
+            "429s": after["throttled"] - before["throttled"],
+            "seconds": round(elapsed, 1),
+            "finished/s": round(finished / elapsed, 1),
+        }
+        if controller is not None:
+            stats = controller.stats()
+            row["final_limit"] = stats["concurrency_limit"]
+            row["limit_decreases"] = stats["limit_decreases"]
+        rows.append(row)
+
+    print(pd.DataFrame(rows).set_index("mode").to_string())
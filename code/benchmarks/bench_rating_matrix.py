@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# Benchmark: assembling the evaluated feature table with RatingMatrix vs. one DataFrame per post + pd.concat.
+# Uses synthetic ratings for the features in feature_definitions_final.csv (no LLM calls).
+# Reports assembly time, peak traced memory and the memory of the resulting table for 1k and 10k posts.
+#
+# Usage:
+#   ./bench_rating_matrix.py --posts 1000 10000
+
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mainanalysis"))
+from rating_store import RatingMatrix
+
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data")
+
+
+# Function to create synthetic checkpoint records, about 5% of the ratings are missing
+def createRecords(n_posts, feature_ids, seed=1):
+    rng = random.Random(seed)
+    records = []
+    for idx in range(n_posts):
+        record = {"ID": f"ID{idx}_SuicideWatch"}
+        for feature_id in feature_ids:
+            if rng.random() > 0.05:
+                record[feature_id] = rng.randint(0, 3)
+        records.append(record)
+    return records
+
+
+# Function to assemble the table as before: one single-row DataFrame per post, concatenated at the end
+def assembleConcat(records, feature_ids):
+    evaluated_feature_dfs = []
+    for clean_dict in records:
+        post_df = pd.DataFrame.from_dict(clean_dict, orient='index').T
+        evaluated_feature_dfs.append(post_df)
+    return pd.concat(evaluated_feature_dfs)
+
+
+# Function to assemble the table with the preallocated int8 matrix
+def assembleMatrix(records, feature_ids):
+    rating_matrix = RatingMatrix([record["ID"] for record in records], feature_ids)
+    for record in records:
+        rating_matrix.setRatings(record["ID"], record)
+    return rating_matrix.toDataFrame()
+
+
+# Function to time one assembly path and measure its memory
+def measure(assemble, records, feature_ids):
+    tracemalloc.start()
+    start = time.perf_counter()
+    table = assemble(records, feature_ids)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "assembly_s": elapsed,
+        "peak_mb": peak / 1e6,
+        "table_mb": table.memory_usage(deep=True).sum() / 1e6,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare RatingMatrix with per-post DataFrame concat")
+    parser.add_argument("--posts", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--features", default=os.path.join(data_dir, "feature_definitions_final.csv"))
+    args = parser.parse_args()
+
+    feature_ids = pd.read_csv(args.features)["feature_id"].drop_duplicates().tolist()
+    results = []
+    for n_posts in args.posts:
+        records = createRecords(n_posts, feature_ids)
+        for name, assemble in [("concat", assembleConcat), ("RatingMatrix", assembleMatrix)]:
+            results.append({"posts": n_posts, "path": name, **measure(assemble, records, feature_ids)})
+
+    print(f"{len(feature_ids)} features")
+    print(pd.DataFrame(results).set_index(["posts", "path"]).round(3).to_string())
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# Load test for the demo application: N concurrent clients post distinct texts to one route for a fixed time.
+# Reports requests per second, latency percentiles and errors, to compare the Flask server (app.py)
+# with the ASGI mode (asgi.py) against the stub LLM server.
+#
+# Usage (stub server on port 8008, response cache disabled so every request reaches the stub):
+#   export TOGETHER_BASE_URL=http://127.0.0.1:8008/v1 TOGETHER_API_KEY=stub LLM_CACHE_DISABLED=1
+#   (cd ../demo_application && ./app.py)                                  # Flask on port 5001
+#   (cd ../demo_application && uvicorn asgi:app --port 5002)              # ASGI on port 5002
+#   ./loadtest_demo.py --url http://127.0.0.1:5001 --concurrency 10 50 200
+#   ./loadtest_demo.py --url http://127.0.0.1:5002 --concurrency 10 50 200
+
+import argparse
+import asyncio
+import itertools
+import time
+
+import httpx
+import numpy as np
+import pandas as pd
+
+
+# Function to run one load level and summarize it
+async def runLoad(url, route, concurrency, duration, timeout):
+    latencies = []
+    errors = 0
+    counter = itertools.count()
+    deadline = time.perf_counter() + duration
+
+    async def client(http):
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            # Distinct texts, so no response cache or request coalescing can answer them
+            text_input = f"load test post {next(counter)}"
+            start = time.perf_counter()
+            try:
+                response = await http.post(url + route, json={"text_input": text_input})
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+            except Exception:
+                errors += 1
+
+    # One small connection pool per 25 clients, a single large httpx pool costs more CPU per request
+    shards = [httpx.AsyncClient(limits=httpx.Limits(max_connections=25), timeout=timeout)
+              for _ in range((concurrency + 24) // 25)]
+    start = time.perf_counter()
+    await asyncio.gather(*(client(shards[i // 25]) for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    for http in shards:
+        await http.aclose()
+
+    latencies = np.array(latencies) if latencies else np.array([np.nan])
+    return {
+        "concurrency": concurrency,
+        "requests": int(np.isfinite(latencies).sum()),
+        "errors": errors,
+        "req/s": np.isfinite(latencies).sum() / elapsed,
+        "p50_s": np.nanpercentile(latencies, 50),
+        "p99_s": np.nanpercentile(latencies, 99),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test for the demo application")
+    parser.add_argument("--url", default="http://127.0.0.1:5001")
+    parser.add_argument("--route", default="/evaluate_cssrs")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--duration", type=float, default=10, help="seconds per load level")
+    parser.add_argument("--timeout", type=float, default=30)
+    args = parser.parse_args()
+
+    results = [asyncio.run(runLoad(args.url, args.route, c, args.duration, args.timeout)) for c in args.concurrency]
+    print(f"{args.url}{args.route}")
+    print(pd.DataFrame(results).set_index("concurrency").round(3).to_string())
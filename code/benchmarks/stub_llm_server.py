@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# Local stand-in for the Together chat-completions endpoint.
+# Answers every prompt family of the pipeline and the demo application with a schema-valid response,
+# so the scoring code can be run and timed without calling (and paying for) the real API.
+# Answers are deterministic: the same prompt always gets the same answer (with the same --seed).
+# Latency, server errors, throttling and malformed answers can be configured to test the clients.
+#
+# Usage:
+#   ./stub_llm_server.py --port 8008 --latency 0.5
+#   ./stub_llm_server.py --port 8008 --latency 0.5 --latency-dist lognormal --per-token-latency 0.005
+#   ./stub_llm_server.py --port 8008 --latency 0.5 --max-concurrent 20 --rpm 1200   # simulate provider throttling
+#   ./stub_llm_server.py --port 8008 --latency 0.5 --error-rate 0.02 --malformed-rate 0.1
+#   export TOGETHER_BASE_URL=http://127.0.0.1:8008/v1 TOGETHER_API_KEY=stub
+
+import argparse
+import ast
+import asyncio
+import csv
+import io
+import json
+import math
+import random
+import re
+import time
+import uuid
+
+
+# Function to build the answer for a C-SSRS prompt
+def answerCSSRS(rng):
+    answers = ["Yes" if rng.random() < 0.3 else "No" for _ in range(5)]
+    output = {"brief_reasoning": "stub answer"}
+    for idx, answer in enumerate(answers):
+        output[f"answer{idx+1}"] = answer
+    output["frequency"] = rng.randint(0, 4)
+    return json.dumps(output)
+
+
+# Function to build the ratings for the features listed in a prompt block
+def rateFeatures(prompt_block, rng):
+    feature_ids = re.findall(r"featureid: '([^']+)'", prompt_block)
+    return [{"featureid": feature_id, "rating": rng.randint(0, 3)} for feature_id in feature_ids]
+
+
+# Function to build the answer for a feature evaluation prompt (one category or all categories at once)
+def answerFeatureEvaluation(prompt, rng):
+    if "grouped into categories" in prompt:
+        output = {}
+        for block in re.split(r"\n\s*Category: ", prompt)[1:]:
+            category = block.split("\n", 1)[0].strip()
+            output[category] = rateFeatures(block, rng)
+        return json.dumps(output)
+    return json.dumps(rateFeatures(prompt, rng))
+
+
+# Function to build the answer for a feature prompt of the demo application (prompts/features.j2)
+def answerDemoFeatures(prompt, rng):
+    feature_csv = prompt.split("Feature list begin->:", 1)[1].split(":<-Feature list end", 1)[0]
+    feature_names = [row["feature_name"] for row in csv.DictReader(io.StringIO(feature_csv.strip()))]
+    return json.dumps({feature_name: rng.randint(0, 3) for feature_name in feature_names})
+
+
+stub_categories = ["tone", "purpose", "mental health", "relationships", "coping", "self-perception",
+                   "future outlook", "method", "life events", "help-seeking", "substance use", "time frame"]
+
+
+# Function to build the answer for a comparison of two posts (getCategoriesSafeguard)
+def answerCategoryDiffs(rng):
+    categories = rng.sample(stub_categories, rng.randint(3, 6))
+    return json.dumps([{"Category": category, "Post 1": f"stub {category} 1", "Post 2": f"stub {category} 2"}
+                       for category in categories], indent=1)
+
+
+# Function to build the feature definitions for a category (getLLMFeatures)
+def answerFeatureDefinitions(prompt, rng):
+    category = re.search(r"Category: (.*)", prompt).group(1).strip()
+    features = []
+    for idx in range(rng.randint(2, 5)):
+        features.append({
+            "featurename": f"{category.title().replace(' ', '_')}_Feature_{idx+1}",
+            "short_description": f"Stub feature {idx+1} of {category}",
+            "rating": "none, low, medium, high (0-3)",
+        })
+    return json.dumps(features, indent=1)
+
+
+# Function to build the top categories without redundant terms (identifyRedundantCategories)
+def answerRedundantCategories(prompt):
+    try:
+        terms = ast.literal_eval(prompt.split("Categories:", 1)[1].split("Return your answer", 1)[0].strip())
+    except (ValueError, SyntaxError):
+        terms = stub_categories
+    names = list(dict.fromkeys(str(term).strip().lower() for term in terms))[:10]
+    return json.dumps({"categories": [{"name": name} for name in names]}, indent=1)
+
+
+# Function to pick an answer for the prompt of a request
+def createAnswer(prompt, rng):
+    if "Wish to be Dead" in prompt:
+        if "several social media posts" in prompt:
+            post_ids = re.findall(r"Post (\S+) begin->:", prompt)
+            return json.dumps({post_id: json.loads(answerCSSRS(rng)) for post_id in post_ids})
+        return answerCSSRS(rng)
+    if "evaluate the features for each of the given texts" in prompt:
+        text_ids = re.findall(r"Text (\S+) begin->:", prompt)
+        feature_block = prompt.split("Features:", 1)[1]
+        return json.dumps({text_id: rateFeatures(feature_block, rng) for text_id in text_ids})
+    if "evaluate the features for the given text" in prompt:
+        return answerFeatureEvaluation(prompt, rng)
+    if "Feature list begin->:" in prompt:
+        return answerDemoFeatures(prompt, rng)
+    if "What are differences between these two posts?" in prompt:
+        return answerCategoryDiffs(rng)
+    if "define measurable features" in prompt:
+        return answerFeatureDefinitions(prompt, rng)
+    if "identify similar terms in the list" in prompt:
+        return answerRedundantCategories(prompt)
+    return "[]"
+
+
+# Ways in which real answers break: text around the JSON, code fences, Python-style quoting,
+# trailing commas, answers cut off by the token limit and refusals without any JSON
+def malformAnswer(content, rng):
+    kind = rng.choice(["prose", "fence", "single_quotes", "trailing_comma", "truncated", "refusal"])
+    if kind == "prose":
+        return "Here is my answer in the requested format:\n" + content + "\nI hope this helps."
+    if kind == "fence":
+        return "```json\n" + content + "\n```"
+    if kind == "single_quotes":
+        return content.replace('"', "'")
+    if kind == "trailing_comma":
+        return re.sub(r"([}\]])$", r",\1", content.rstrip()) if content.rstrip()[-1:] in "}]" else content
+    if kind == "truncated":
+        return content[:max(1, int(len(content) * rng.uniform(0.5, 0.95)))]
+    return "I'm sorry, but I can't provide that assessment. Please reach out to a crisis line."
+
+
+class StubModel:
+    # malformed_rate: fraction of answers that are broken (see malformAnswer)
+    def __init__(self, malformed_rate=0.0, seed=None):
+        self.malformed_rate = malformed_rate
+        self.seed = seed
+        # Broken answer -> intact answer, so that a re-ask with the broken answer gets the intact one
+        self.intact_answers = {}
+
+    # Function to answer the messages of a request
+    def answer(self, messages):
+        prompt = "\n".join(message["content"] for message in messages)
+        # Re-ask of structured_output.py: return the intact version of the broken answer
+        if prompt.startswith("The following answer is not valid") and "\nAnswer:\n" in prompt:
+            broken = prompt.split("\nAnswer:\n", 1)[1]
+            return self.intact_answers.get(broken, "[]")
+
+        rng = random.Random(f"{self.seed}:{prompt}")
+        content = createAnswer(prompt, rng)
+        if self.malformed_rate and rng.random() < self.malformed_rate:
+            broken = malformAnswer(content, rng)
+            if len(self.intact_answers) > 100000:
+                self.intact_answers.clear()
+            self.intact_answers[broken] = content
+            content = broken
+        return content
+
+
+# Function to build the chat-completion response for a request body
+def createCompletion(body, model):
+    prompt_chars = sum(len(message["content"]) for message in body["messages"])
+    content = model.answer(body["messages"])
+    return {
+        "id": str(uuid.uuid4()),
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "stub"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {
+            "prompt_tokens": prompt_chars // 4,
+            "completion_tokens": len(content) // 4,
+            "total_tokens": (prompt_chars + len(content)) // 4,
+        },
+    }
+
+
+# Response time of the stub: a base latency drawn from a distribution with the given mean,
+# plus a time per completion token (LLMs take longer for longer answers)
+class LatencyModel:
+    def __init__(self, mean=0.5, distribution="fixed", sigma=0.5, per_token=0.0, seed=None):
+        self.mean = mean
+        self.distribution = distribution
+        self.sigma = sigma
+        self.per_token = per_token
+        self.rng = random.Random(seed)
+
+    def sample(self, completion_tokens):
+        if self.distribution == "uniform":
+            base = self.rng.uniform(0, 2 * self.mean)
+        elif self.distribution == "exponential":
+            base = self.rng.expovariate(1 / self.mean) if self.mean > 0 else 0.0
+        elif self.distribution == "lognormal":
+            # mu chosen so that the mean of the distribution is self.mean
+            base = self.rng.lognormvariate(math.log(self.mean) - self.sigma ** 2 / 2, self.sigma) if self.mean > 0 else 0.0
+        else:
+            base = self.mean
+        return base + self.per_token * completion_tokens
+
+
+# Simulated provider limits: requests per minute, requests in flight and random server errors
+# Requests over a limit are answered with 429 and a Retry-After header, like the Together API does
+class ProviderLimits:
+    def __init__(self, requests_per_minute=None, max_concurrent=None, error_rate=0.0, seed=None):
+        self.rate = requests_per_minute / 60.0 if requests_per_minute else None
+        self.capacity = max(1.0, self.rate) if self.rate else None
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self.max_concurrent = max_concurrent
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.in_flight = 0
+        self.counts = {"requests": 0, "ok": 0, "throttled": 0, "errors": 0, "peak_in_flight": 0}
+
+    # Function to admit a request, returns None or the (status, retry_after) of the rejection
+    def admit(self):
+        self.counts["requests"] += 1
+        if self.max_concurrent is not None and self.in_flight >= self.max_concurrent:
+            self.counts["throttled"] += 1
+            return "429 Too Many Requests", 1
+        if self.rate is not None:
+            now = time.monotonic()
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.level < 1:
+                self.counts["throttled"] += 1
+                return "429 Too Many Requests", math.ceil((1 - self.level) / self.rate)
+            self.level -= 1
+        if self.rng.random() < self.error_rate:
+            self.counts["errors"] += 1
+            return "500 Internal Server Error", None
+        return None
+
+
+# Function to write an HTTP/1.1 response with a JSON body
+async def writeResponse(writer, status, payload, retry_after=None):
+    data = json.dumps(payload).encode()
+    extra = f"Retry-After: {retry_after}\r\n" if retry_after is not None else ""
+    head = f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n{extra}\r\n"
+    writer.write(head.encode() + data)
+    await writer.drain()
+
+
+# Function to serve the requests of one keep-alive connection
+# The server runs on asyncio, so thousands of waiting requests cost no threads
+async def handleConnection(reader, writer, latency, limits, model):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            method, path = request_line.decode("latin-1").split()[:2]
+            if method == "GET" and path == "/stats":
+                # Counters of the simulated provider, e.g. to check how a client reacts to throttling
+                await writeResponse(writer, "200 OK", limits.counts)
+                continue
+            if method != "POST" or not path.endswith("/chat/completions"):
+                await writeResponse(writer, "404 Not Found", {"error": {"message": "not found"}})
+                continue
+            rejection = limits.admit()
+            if rejection is not None:
+                status, retry_after = rejection
+                await writeResponse(writer, status, {"error": {"message": status}}, retry_after)
+                continue
+            completion = createCompletion(json.loads(body), model)
+            limits.in_flight += 1
+            limits.counts["peak_in_flight"] = max(limits.counts["peak_in_flight"], limits.in_flight)
+            try:
+                await asyncio.sleep(latency.sample(completion["usage"]["completion_tokens"]))
+            finally:
+                limits.in_flight -= 1
+            limits.counts["ok"] += 1
+            await writeResponse(writer, "200 OK", completion)
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host, port, latency, limits, model):
+    server = await asyncio.start_server(lambda r, w: handleConnection(r, w, latency, limits, model), host, port, backlog=4096)
+    print(f"Stub LLM server on http://{host}:{port}/v1")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stub of the Together chat-completions endpoint")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8008)
+    parser.add_argument("--latency", type=float, default=0.5, help="mean seconds to wait before answering")
+    parser.add_argument("--latency-dist", choices=["fixed", "uniform", "exponential", "lognormal"], default="fixed")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="shape of the lognormal latency")
+    parser.add_argument("--per-token-latency", type=float, default=0.0, help="extra seconds per completion token")
+    parser.add_argument("--rpm", type=float, default=None, help="requests per minute before answering 429")
+    parser.add_argument("--max-concurrent", type=int, default=None, help="requests in flight before answering 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 500")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="fraction of answers with broken JSON")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    limits = ProviderLimits(args.rpm, args.max_concurrent, args.error_rate, args.seed)
+    latency = LatencyModel(args.latency, args.latency_dist, args.latency_sigma, args.per_token_latency, args.seed)
+    model = StubModel(args.malformed_rate, args.seed)
+    asyncio.run(serve(args.host, args.port, latency, limits, model))
@@ -1,39 +1,128 @@
 from together import Together
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from types import MappingProxyType
 import dotenv
 import jinja2
+import numpy as np
 import pandas as pd
+import csv
+import io
 import json
+import os
+import threading
+import time
+
+from llm_cache import LLMCache
+from llm_metrics import LLMMetrics, cacheStatus
+from near_duplicates import MinHashIndex
+from rate_control import RateController, estimateRequestTokens
+from singleflight import SingleFlight, requestKey
+from structured_output import onParsed, parseStats, parseStructured
 
 dotenv.load_dotenv(".env")
-llm_client = Together()
+# Retries are done by rate_controller, which also adapts the number of calls in flight to 429s and errors
+llm_client = Together(max_retries=0)
 
 model_id = "meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo"
 
+# Persistent LLM response cache, repeated submissions are answered locally (set LLM_CACHE_DISABLED=1 to bypass it)
+llm_cache = LLMCache(
+    os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite"),
+    max_bytes=int(os.getenv("LLM_CACHE_MAX_BYTES", 256 * 1024 * 1024)),
+    enabled=os.getenv("LLM_CACHE_DISABLED", "0") != "1",
+)
+
+# Rate control of all LLM calls, shared by the Flask and the ASGI mode (limits of the provider plan: 0 = not limited)
+rate_controller = RateController(
+    requests_per_minute=int(os.getenv("LLM_REQUESTS_PER_MINUTE", 0)) or None,
+    tokens_per_minute=int(os.getenv("LLM_TOKENS_PER_MINUTE", 0)) or None,
+    initial_concurrency=int(os.getenv("LLM_INITIAL_IN_FLIGHT", 8)),
+    max_concurrency=int(os.getenv("MAX_UPSTREAM_CALLS", 64)),
+    max_retries=int(os.getenv("LLM_MAX_RETRIES", 3)),
+)
+
+# Instrumentation of all LLM calls and parsed answers, served by the /metrics route
+# (LLM_METRICS_LOG: optional JSONL file with one record per call and per parsed answer)
+llm_metrics = LLMMetrics(os.getenv("LLM_METRICS_LOG") or None)
+onParsed(llm_metrics.parsed)
+
+app_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Everything a request needs that does not depend on the text input, loaded and compiled once at startup
+#   templates: compiled prompt templates (prompts/*.j2)
+#   features_definition_csv: feature_name, description and rating_options of features.csv as CSV block for the prompt
+#   feature_definition_rows: feature_name -> its CSV line, to ask for the ratings of some features only
+#   feature_index: feature_name -> position in feature_names
+#   row_feature / row_cluster: for every row of features.csv, the position of its feature and of its cluster,
+#   so that the cluster scores are one vectorized reduction over the rows
+@dataclass(frozen=True)
+class ServingCore:
+    cssrs_template: jinja2.Template
+    feature_template: jinja2.Template
+    features_definition_csv: str
+    feature_definition_rows: MappingProxyType
+    feature_names: tuple
+    feature_index: MappingProxyType
+    clusters: tuple
+    row_feature: np.ndarray
+    row_cluster: np.ndarray
+
+# Load the feature definitions and compile the prompt templates
+def loadServingCore(features_path=os.path.join(app_dir, "features.csv"), prompts_path=os.path.join(app_dir, "prompts")):
+    templateLoader = jinja2.FileSystemLoader(searchpath=prompts_path)
+    templateEnv = jinja2.Environment(loader=templateLoader)
+
+    # Load feature definitions from features.csv
+    features = pd.read_csv(features_path)
+    feature_names = tuple(dict.fromkeys(features["feature_name"]))
+    feature_index = {feature_name: idx for idx, feature_name in enumerate(feature_names)}
+    clusters = tuple(sorted(features["cluster"].unique().tolist()))
+    cluster_index = {cluster: idx for idx, cluster in enumerate(clusters)}
+
+    row_feature = np.array([feature_index[feature_name] for feature_name in features["feature_name"]], dtype=np.intp)
+    row_cluster = np.array([cluster_index[cluster] for cluster in features["cluster"]], dtype=np.intp)
+    row_feature.setflags(write=False)
+    row_cluster.setflags(write=False)
+    definitions = features[["feature_name", "description", "rating_options"]].drop_duplicates("feature_name")
+    feature_definition_rows = {row.feature_name: definitions.iloc[[idx]].to_csv(index=False, header=False)
+                               for idx, row in enumerate(definitions.itertuples())}
+
+    return ServingCore(
+        cssrs_template=templateEnv.get_template("cssrs.j2"),
+        feature_template=templateEnv.get_template("features.j2"),
+        # Keep only feature_name, description, and rating_options to be provided to the LLM in CSV format
+        features_definition_csv=features[["feature_name", "description", "rating_options"]].to_csv(index=False),
+        feature_definition_rows=MappingProxyType(feature_definition_rows),
+        feature_names=feature_names,
+        feature_index=MappingProxyType(feature_index),
+        clusters=clusters,
+        row_feature=row_feature,
+        row_cluster=row_cluster,
+    )
+
+serving_core = loadServingCore()
+
 # Create a prompt from template and text input
 # Template: prompts/cssrs.j2
 def createCSSRSPrompt(text_input):
-    templateLoader = jinja2.FileSystemLoader(searchpath="./prompts/")
-    templateEnv = jinja2.Environment(loader=templateLoader)
-    TEMPLATE_FILE = "cssrs.j2"
-    template = templateEnv.get_template(TEMPLATE_FILE)
-    outputText = template.render(text_input=text_input)
+    outputText = serving_core.cssrs_template.render(text_input=text_input)
     return outputText
 
 # Create a prompt from template, text input and feature definitions
 # Template: prompts/features.j2
 def createFeaturePrompt(text_input, features):
-    templateLoader = jinja2.FileSystemLoader(searchpath="./prompts/")
-    templateEnv = jinja2.Environment(loader=templateLoader)
-    TEMPLATE_FILE = "features.j2"
-    template = templateEnv.get_template(TEMPLATE_FILE)
-    outputText = template.render(text_input=text_input, features=features)
+    outputText = serving_core.feature_template.render(text_input=text_input, features=features)
     return outputText
 
-# Ask the model to evaluate the prompt
-def promptModel(input_prompt):
-    completion = llm_client.chat.completions.create(
-        model=model_id,
-        messages=[
+# Create a prompt that asks again for the ratings of some features only (their ratings in the answer were invalid)
+def createFeatureReaskPrompt(text_input, feature_names):
+    features = "feature_name,description,rating_options\n" + "".join(serving_core.feature_definition_rows[name] for name in feature_names)
+    return createFeaturePrompt(text_input=text_input, features=features)
+
+# Create the chat messages for a prompt
+def createMessages(input_prompt):
+    messages = [
         {
             "role": "user",
             "content": input_prompt            
@@ -43,21 +132,61 @@ def promptModel(input_prompt):
             "content": "Please do reach out for help. However, I can provide a response in the requested format:"
 
         }
-        ],
-    )
+    ]
+    return messages
+
+# Ask the model to evaluate the prompt
+def promptModel(input_prompt, prompt_type):
+    return completeMessages(createMessages(input_prompt), prompt_type)
+
+# Send chat messages to the model
+# Answers from the local response cache when the same messages were sent before
+# prompt_type: name of the prompt in the metrics (not part of the request)
+def completeMessages(messages, prompt_type="other"):
+    key = LLMCache.key(model_id, messages, {})
+    output = llm_cache.get(key)
+    with llm_metrics.call(prompt_type, model_id, cacheStatus(llm_cache, output)) as record:
+        if output is not None:
+            return output
+
+        completion = rate_controller.call(
+            record.counted(lambda: llm_client.chat.completions.create(model=model_id, messages=messages)),
+            estimateRequestTokens(messages),
+        )
+        record.completed(completion)
     output = completion.choices[0].message.content
+    llm_cache.put(key, output)
     return output
 
+# Identical texts submitted while their evaluation is still running share one LLM call
+singleflight = SingleFlight()
+
 def evaluateCSSRS(text_input):
+    return singleflight.do(requestKey("cssrs", text_input), requestCSSRS, text_input)
+
+# Evaluate the C-SSRS questions of a text with one LLM call
+def requestCSSRS(text_input):
     # Create a prompt from template and text input
     input_prompt = createCSSRSPrompt(text_input=text_input)
 
     # Ask the model to evaluate the prompt
-    output = promptModel(input_prompt)
+    output = promptModel(input_prompt, "cssrs")
 
     # Parse the output from the model
-    model_output = json.loads(output)
+    model_output = parseModelOutput(output, "cssrs")
+
+    return formatCSSRS(model_output)
+
+# Parse a structured answer of the model (see structured_output.py)
+# Answers that cannot be repaired locally are re-asked once with a short prompt, raises ValueError if that fails too
+def parseModelOutput(output, kind):
+    value, error = parseStructured(output, kind, reask=lambda messages: completeMessages(messages, kind + "_reask"))
+    if error is not None:
+        raise ValueError(f"Invalid {kind} answer: {error}")
+    return value
 
+# Convert the validated C-SSRS answer of the model to the response format
+def formatCSSRS(model_output):
     # Convert Yes/No answers to True/False
     result = {}
     result["answer1"] = model_output["answer1"] == "Yes"
@@ -70,31 +199,65 @@ def evaluateCSSRS(text_input):
     return result
 
 def evaluateFeatures(text_input):
-    # Load feature definitions from features.csv
-    features = pd.read_csv("features.csv")
-    
-    # Keep only feature_name, description, and rating_options to be provided to the LLM in CSV format
-    features_definition_csv = features[["feature_name", "description", "rating_options"]].to_csv(index=False)
+    return singleflight.do(requestKey("features", text_input), requestFeatures, text_input)
 
-    # Create a prompt from template, text input and feature definitions
-    input_prompt = createFeaturePrompt(text_input=text_input, features=features_definition_csv)
+# Evaluate the features of a text with one LLM call
+def requestFeatures(text_input):
+    # Create a prompt from template, text input and the preloaded feature definitions
+    input_prompt = createFeaturePrompt(text_input=text_input, features=serving_core.features_definition_csv)
 
     # Ask the model to evaluate the prompt
-    output = promptModel(input_prompt)
+    output = promptModel(input_prompt, "feature_scores")
 
     # Parse the output from the model
-    model_output = json.loads(output)
+    model_output = parseModelOutput(output, "feature_scores")
 
     # model_output = "{'relationships_Social_Isolation': 3, 'tone_Emotional_tone': 3, 'tone_Uncertainty': 3,...}"
 
-    # Convert the model output to pandas DataFrame
-    model_output_df = pd.DataFrame(model_output.items(), columns=["feature_name", "score"])
+    # Ask again once for the features whose rating was not a valid integer
+    invalid = invalidFeatures(model_output)
+    if invalid:
+        output = promptModel(createFeatureReaskPrompt(text_input, invalid), "feature_scores_reask")
+        try:
+            model_output = mergeFeatureScores(model_output, parseModelOutput(output, "feature_scores"), invalid)
+        except ValueError:
+            pass
+
+    return scoreFeatures(model_output)
+
+# Known features whose rating in a parsed answer was not a valid integer (None, see validateFeatureScores)
+def invalidFeatures(model_output):
+    return [name for name, rating in model_output.items() if rating is None and name in serving_core.feature_index]
 
-    # Merge the model output with the features
-    features = pd.merge(features, model_output_df, on="feature_name")
+# Take over the valid ratings of the re-asked features
+def mergeFeatureScores(model_output, reasked, invalid):
+    return {**model_output, **{name: rating for name, rating in reasked.items() if name in invalid and rating is not None}}
 
-    # Calculate average score ("score") for each cluster (group by "cluster")
-    clusters = features.groupby("cluster")["score"].mean().round(2).reset_index()
+# Combine the ratings of the model with the feature definitions and average them per cluster
+def scoreFeatures(model_output):
+    # Keep the ratings of known features, in the order of features.csv
+    scores = np.full(len(serving_core.feature_names), np.nan)
+    features = {}
+    for feature_name, score in model_output.items():
+        idx = serving_core.feature_index.get(feature_name)
+        if idx is None:
+            continue
+        try:
+            scores[idx] = float(score)
+        except (TypeError, ValueError):
+            continue
+    for feature_name in serving_core.feature_names:
+        if not np.isnan(scores[serving_core.feature_index[feature_name]]):
+            features[feature_name] = model_output[feature_name]
+
+    # Calculate average score for each cluster over the rows of features.csv
+    row_scores = scores[serving_core.row_feature]
+    rated = ~np.isnan(row_scores)
+    n_clusters = len(serving_core.clusters)
+    sums = np.bincount(serving_core.row_cluster[rated], weights=row_scores[rated], minlength=n_clusters)
+    counts = np.bincount(serving_core.row_cluster[rated], minlength=n_clusters)
+    means = np.round(sums / np.maximum(counts, 1), 2)
+    clusters = {cluster: float(means[idx]) for idx, cluster in enumerate(serving_core.clusters) if counts[idx] > 0}
 
     # Combine the features and clusters into a dictionary
     # result:
@@ -107,7 +270,169 @@ def evaluateFeatures(text_input):
     #         cluster2: 2.5
     #         ...
     result = {}
-    result["features"] = features.set_index("feature_name").to_dict()["score"]
-    result["cluster"] = clusters.set_index("cluster").to_dict()["score"]
+    result["features"] = features
+    result["cluster"] = clusters
+
+    return result
+
+# Counters of the request coalescing, the response cache, the rate control and the parsing, served by the /stats route
+def serviceStats():
+    return {
+        "singleflight": singleflight.stats(),
+        "llm_cache": llm_cache.stats(),
+        "rate_control": rate_controller.stats(),
+        "parsing": parseStats(),
+        "near_duplicates": dict(near_duplicate_counts),
+    }
+
+# Prometheus metrics of the LLM calls and the current rate control state, served by the /metrics route
+def serviceMetrics():
+    rate_control = rate_controller.stats()
+    lines = [
+        "# HELP llm_concurrency_limit Current limit of LLM calls in flight set by the rate controller.",
+        "# TYPE llm_concurrency_limit gauge",
+        f"llm_concurrency_limit {rate_control['concurrency_limit']}",
+        "# HELP llm_in_flight LLM calls in flight.",
+        "# TYPE llm_in_flight gauge",
+        f"llm_in_flight {rate_control['in_flight']}",
+    ]
+    return llm_metrics.prometheus() + "\n".join(lines) + "\n"
+
+# Thread pool used to run the C-SSRS and the feature evaluation of one post at the same time
+evaluation_pool = ThreadPoolExecutor(max_workers=int(os.getenv("EVALUATION_THREADS", 16)))
+
+# Run a part of the evaluation and time it, errors are returned instead of raised
+def timedPart(function, text_input):
+    start = time.perf_counter()
+    try:
+        return function(text_input), None, time.perf_counter() - start
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}", time.perf_counter() - start
+
+# Evaluate the C-SSRS questions and the features of a text in parallel
+# If one part fails, the result of the other part is still returned
+# result:
+#     cssrs: {answer1: true, ..., freq: 2} or null
+#     features: {features: {...}, cluster: {...}} or null
+#     errors: {cssrs: "...", features: "..."} (only failed parts)
+#     timing: {cssrs: 1.2, features: 2.3, total: 2.3} (seconds)
+def evaluateAll(text_input):
+    start = time.perf_counter()
+    futures = {
+        "cssrs": evaluation_pool.submit(timedPart, evaluateCSSRS, text_input),
+        "features": evaluation_pool.submit(timedPart, evaluateFeatures, text_input),
+    }
+    result = {"errors": {}, "timing": {}}
+    for part, future in futures.items():
+        output, error, elapsed = future.result()
+        result[part] = output
+        result["timing"][part] = round(elapsed, 3)
+        if error is not None:
+            result["errors"][part] = error
+    result["timing"]["total"] = round(time.perf_counter() - start, 3)
+    return result
+
+# Thread pool for the posts of /evaluate_batch, separate from evaluation_pool since every post uses evaluateAll
+batch_pool = ThreadPoolExecutor(max_workers=int(os.getenv("BATCH_THREADS", 16)))
+# Upper limit for the number of posts of one batch that are evaluated at the same time
+batch_max_concurrent = int(os.getenv("BATCH_MAX_CONCURRENT", 8))
+
+# Read the posts of an uploaded batch file (JSONL or CSV)
+# Every post needs a "text_input" (or "text") field, "id" (or "ID") is optional and defaults to the line number
+# Lines that cannot be read are returned as error records, so they show up in the results instead of failing the batch
+def readBatchItems(content, file_format):
+    if file_format == "csv":
+        rows = enumerate(csv.DictReader(io.StringIO(content)), start=2)
+    else:
+        rows = ((line_number, line) for line_number, line in enumerate(content.splitlines(), start=1) if line.strip())
+
+    for line_number, row in rows:
+        if file_format != "csv":
+            try:
+                row = json.loads(row)
+            except json.JSONDecodeError as e:
+                yield {"id": line_number, "line": line_number, "error": f"Invalid JSON: {e}"}
+                continue
+        if not isinstance(row, dict):
+            yield {"id": line_number, "line": line_number, "error": "Expected a JSON object"}
+            continue
+        post_id = row.get("id", row.get("ID", line_number))
+        text_input = row.get("text_input", row.get("text"))
+        if not isinstance(text_input, str) or not text_input.strip():
+            yield {"id": post_id, "line": line_number, "error": "Missing text_input"}
+            continue
+        yield {"id": post_id, "line": line_number, "text_input": text_input}
+
+# Near-duplicate posts of a batch (reposts, cross-posts) are evaluated once, the others get a copy of the result
+# with duplicate_of set to the id of the evaluated post (NEAR_DUPLICATE_THRESHOLD: MinHash similarity, e.g. 0.9, 0 disables)
+near_duplicate_threshold = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", 0))
+near_duplicate_counts = {"posts": 0, "near_duplicates": 0}
+near_duplicate_lock = threading.Lock()
+
+# Near-duplicates within one batch: posts waiting for the result of an earlier post and the results of evaluated posts
+class BatchDuplicates:
+    def __init__(self):
+        self.index = MinHashIndex(near_duplicate_threshold) if near_duplicate_threshold > 0 else None
+        self.waiting = {}
+        self.results = {}
+
+    # Register a post of the batch: True if it has to be evaluated, False if it waits for an earlier post
+    def add(self, item):
+        representative = self.index.add(item["line"], item["text_input"]) if self.index is not None else None
+        with near_duplicate_lock:
+            near_duplicate_counts["posts"] += 1
+            near_duplicate_counts["near_duplicates"] += representative is not None
+        if representative is None:
+            return True
+        self.waiting.setdefault(representative, []).append(item)
+        return False
+
+    # Record the result of an evaluated post, returns it with the copies for its near-duplicates
+    def completed(self, result):
+        self.results[result["line"]] = result
+        return [result] + self.ready()
+
+    # Copies of the results for the near-duplicates whose post was already evaluated
+    def ready(self):
+        copies = []
+        for line in [line for line in self.waiting if line in self.results]:
+            result = self.results[line]
+            copies += [{**result, "id": item["id"], "line": item["line"], "duplicate_of": result["id"]} for item in self.waiting.pop(line)]
+        return copies
+
+# Evaluate one post of a batch, errors are returned as a record of the post
+def evaluateBatchItem(item):
+    try:
+        result = evaluateAll(item["text_input"])
+    except Exception as e:
+        return {"id": item["id"], "line": item["line"], "error": f"{type(e).__name__}: {e}"}
+    return {"id": item["id"], "line": item["line"], **result}
 
-    return result
\ No newline at end of file
+# Evaluate the posts of a batch with at most max_concurrent posts in flight, yielding each result as soon as it is done
+# New posts are only started when the consumer takes a result, so a slow client slows down the batch (backpressure)
+def evaluateBatchStream(items, max_concurrent):
+    max_concurrent = max(1, min(max_concurrent, batch_max_concurrent))
+    items = iter(items)
+    pending = set()
+    exhausted = False
+    duplicates = BatchDuplicates()
+    try:
+        while True:
+            while not exhausted and len(pending) < max_concurrent:
+                item = next(items, None)
+                if item is None:
+                    exhausted = True
+                elif "error" in item:
+                    yield item
+                elif duplicates.add(item):
+                    pending.add(batch_pool.submit(evaluateBatchItem, item))
+            yield from duplicates.ready()
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from duplicates.completed(future.result())
+    finally:
+        # The client went away or the batch is done: do not start posts that are still queued
+        for future in pending:
+            future.cancel()
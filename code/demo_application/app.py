@@ -1,20 +1,34 @@
 #!/usr/bin/env python
 
-from flask import Flask, request, jsonify, render_template
+import json
+import os
 
-from api import evaluateCSSRS, evaluateFeatures
+from flask import Flask, Response, request, jsonify, render_template, stream_with_context
+
+from api import evaluateCSSRS, evaluateFeatures, evaluateAll, readBatchItems, evaluateBatchStream, serviceStats, serviceMetrics
 
 app = Flask(__name__)
+# Limit the size of uploaded batch files
+app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("BATCH_MAX_BYTES", 20 * 1024 * 1024))
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+# Function to read the text input of a JSON request
+# Returns (text_input, None), or (None, 400 response) if the body is not a JSON object, as the ASGI routes do
+def readTextInput():
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict):
+        return None, (jsonify({"error": "The request body must be a JSON object"}), 400)
+    return data.get("text_input", ""), None
+
 @app.route('/evaluate_cssrs', methods=['POST'])
 def evaluate():
     # Parse JSON data from the request
-    data = request.json
-    text_input = data.get("text_input", "")
+    text_input, error = readTextInput()
+    if error is not None:
+        return error
 
     # Evaluate the input text with the function
     output = evaluateCSSRS(text_input)
@@ -25,8 +39,9 @@ def evaluate():
 @app.route('/evaluate_features', methods=['POST'])
 def evaluate_features():
     # Parse JSON data from the request
-    data = request.json
-    text_input = data.get("text_input", "")
+    text_input, error = readTextInput()
+    if error is not None:
+        return error
 
     # Evaluate the input text with the function
     output = evaluateFeatures(text_input)
@@ -34,6 +49,65 @@ def evaluate_features():
     # Return the result as JSON
     return jsonify(output)
 
+@app.route('/evaluate', methods=['POST'])
+def evaluate_all():
+    # Parse JSON data from the request
+    text_input, error = readTextInput()
+    if error is not None:
+        return error
+
+    # Evaluate the C-SSRS questions and the features in parallel
+    output = evaluateAll(text_input)
+
+    # Return the combined result as JSON
+    return jsonify(output)
+
+@app.route('/evaluate_batch', methods=['POST'])
+def evaluate_batch():
+    # Read the uploaded file (multipart field "file") or the raw request body
+    # Only a multipart body is parsed as a form, any other body (e.g. curl --data-binary, sent as
+    # application/x-www-form-urlencoded) is the batch file itself
+    if request.mimetype == "multipart/form-data":
+        upload = request.files.get("file")
+        if upload is None:
+            return jsonify({"error": "Missing file field"}), 400
+        content = upload.read()
+        filename = upload.filename or ""
+    else:
+        content = request.get_data(cache=True)
+        filename = ""
+    if not content.strip():
+        return jsonify({"error": "The batch file is empty"}), 400
+    try:
+        content = content.decode("utf-8")
+    except UnicodeDecodeError:
+        return jsonify({"error": "The batch file is not UTF-8 text"}), 400
+
+    # Format from the query string, the file extension or the content type (default JSONL)
+    file_format = request.args.get("format")
+    if file_format is None:
+        is_csv = filename.lower().endswith(".csv") or request.content_type == "text/csv"
+        file_format = "csv" if is_csv else "jsonl"
+    try:
+        max_concurrent = int(request.args.get("max_concurrent", 4))
+    except ValueError:
+        return jsonify({"error": "max_concurrent must be an integer"}), 400
+
+    # Stream one JSON line per post as soon as it is evaluated
+    items = readBatchItems(content, file_format)
+    lines = (json.dumps(result) + "\n" for result in evaluateBatchStream(items, max_concurrent))
+    return Response(stream_with_context(lines), mimetype="application/x-ndjson")
+
+@app.route('/stats')
+def stats():
+    # Request coalescing (waiters, coalesced hits) and response cache counters
+    return jsonify(serviceStats())
+
+@app.route('/metrics')
+def metrics():
+    # LLM call latency histograms, token and retry counters in the Prometheus text format
+    return Response(serviceMetrics(), mimetype="text/plain; version=0.0.4")
+
 if __name__ == '__main__':
     # Host on 0.0.0.0
     app.run(host='0.0.0.0', port=5001, debug=False)
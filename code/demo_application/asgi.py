@@ -0,0 +1,124 @@
+# ASGI serving mode of the demo application, with the same routes as app.py
+# Requests wait on the shared async LLM client instead of holding a thread each.
+#
+# Run with:
+#   uvicorn asgi:app --host 0.0.0.0 --port 5001
+
+import contextlib
+import json
+import os
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+
+import async_api
+from api import app_dir, batch_max_concurrent, readBatchItems, serviceStats, serviceMetrics
+
+# Limit the size of uploaded batch files
+batch_max_bytes = int(os.getenv("BATCH_MAX_BYTES", 20 * 1024 * 1024))
+
+# The page has no template variables, so it is read once at startup
+with open(os.path.join(app_dir, "templates", "index.html"), encoding="utf-8") as f:
+    index_html = f.read()
+
+async def index(request):
+    return HTMLResponse(index_html)
+
+# Function to read the text input of a JSON request
+# Returns (text_input, None), or (None, 400 response) if the body is not a JSON object, as the Flask routes do
+async def readTextInput(request):
+    try:
+        data = await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        data = None
+    if not isinstance(data, dict):
+        return None, JSONResponse({"error": "The request body must be a JSON object"}, status_code=400)
+    return data.get("text_input", ""), None
+
+async def evaluate_cssrs(request):
+    text_input, error = await readTextInput(request)
+    if error is not None:
+        return error
+    output = await async_api.evaluateCSSRSAsync(text_input)
+    return JSONResponse(output)
+
+async def evaluate_features(request):
+    text_input, error = await readTextInput(request)
+    if error is not None:
+        return error
+    output = await async_api.evaluateFeaturesAsync(text_input)
+    return JSONResponse(output)
+
+async def evaluate_all(request):
+    text_input, error = await readTextInput(request)
+    if error is not None:
+        return error
+    output = await async_api.evaluateAllAsync(text_input)
+    return JSONResponse(output)
+
+async def evaluate_batch(request: Request):
+    if int(request.headers.get("content-length", 0)) > batch_max_bytes:
+        return PlainTextResponse("Batch file too large", status_code=413)
+
+    # Read the uploaded file (multipart field "file") or the raw request body
+    filename = ""
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("file")
+        if upload is None or isinstance(upload, str):
+            return JSONResponse({"error": "Missing file field"}, status_code=400)
+        content = await upload.read()
+        filename = upload.filename or ""
+    else:
+        content = await request.body()
+    if not content.strip():
+        return JSONResponse({"error": "The batch file is empty"}, status_code=400)
+    try:
+        content = content.decode("utf-8")
+    except UnicodeDecodeError:
+        return JSONResponse({"error": "The batch file is not UTF-8 text"}, status_code=400)
+
+    # Format from the query string, the file extension or the content type (default JSONL)
+    file_format = request.query_params.get("format")
+    if file_format is None:
+        is_csv = filename.lower().endswith(".csv") or request.headers.get("content-type") == "text/csv"
+        file_format = "csv" if is_csv else "jsonl"
+    try:
+        max_concurrent = int(request.query_params.get("max_concurrent", 4))
+    except ValueError:
+        return JSONResponse({"error": "max_concurrent must be an integer"}, status_code=400)
+
+    # Stream one JSON line per post as soon as it is evaluated
+    async def lines():
+        items = readBatchItems(content, file_format)
+        async for result in async_api.evaluateBatchStreamAsync(items, max_concurrent, batch_max_concurrent):
+            yield json.dumps(result) + "\n"
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+async def stats(request):
+    return JSONResponse(serviceStats())
+
+async def metrics(request):
+    return PlainTextResponse(serviceMetrics(), headers={"Content-Type": "text/plain; version=0.0.4"})
+
+# Open the shared LLM client in the event loop of the server and close it on shutdown
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    async_api.openClient()
+    yield
+    await async_api.closeClient()
+
+app = Starlette(
+    routes=[
+        Route("/", index),
+        Route("/evaluate_cssrs", evaluate_cssrs, methods=["POST"]),
+        Route("/evaluate_features", evaluate_features, methods=["POST"]),
+        Route("/evaluate", evaluate_all, methods=["POST"]),
+        Route("/evaluate_batch", evaluate_batch, methods=["POST"]),
+        Route("/stats", stats),
+        Route("/metrics", metrics),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,168 @@
+# Async counterparts of the evaluation functions in api.py, used by the ASGI app (asgi.py)
+# Prompts, parsing, the serving core and the response cache are shared with api.py;
+# only the model call is async, through pooled AsyncTogether clients shared by the process.
+
+import asyncio
+import itertools
+import os
+import time
+
+import httpx
+from together import AsyncTogether, DefaultAsyncHttpxClient
+
+from api import (BatchDuplicates, createCSSRSPrompt, createFeaturePrompt, createFeatureReaskPrompt, createMessages, formatCSSRS,
+                 invalidFeatures, mergeFeatureScores, scoreFeatures, serving_core, llm_cache, llm_metrics, model_id, singleflight,
+                 rate_controller)
+from llm_cache import LLMCache
+from llm_metrics import cacheStatus
+from rate_control import estimateRequestTokens
+from singleflight import requestKey
+from structured_output import parseStructuredAsync
+
+# HTTP connection pool towards the LLM provider (the number of calls in flight is limited by api.rate_controller)
+max_connections = int(os.getenv("LLM_MAX_CONNECTIONS", 100))
+max_keepalive_connections = int(os.getenv("LLM_MAX_KEEPALIVE", 50))
+# The connections are split over several clients: the cost of each request in an httpx pool
+# grows with the pool size, so a few small pools use much less CPU than one large pool
+client_shards = int(os.getenv("LLM_CLIENT_SHARDS", 4))
+
+# Created on startup of the ASGI app (in its event loop) by openClient
+async_llm_clients = []
+next_client = None
+
+# Create the shared async clients with HTTP connection pooling and keep-alive
+def openClient():
+    global async_llm_clients, next_client
+    async_llm_clients = []
+    for _ in range(client_shards):
+        http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=max(1, max_connections // client_shards),
+                max_keepalive_connections=max(1, max_keepalive_connections // client_shards),
+                keepalive_expiry=30,
+            ),
+        )
+        async_llm_clients.append(AsyncTogether(http_client=http_client, max_retries=0))
+    next_client = itertools.cycle(async_llm_clients)
+
+# Close the shared async clients on shutdown
+async def closeClient():
+    global async_llm_clients
+    for client in async_llm_clients:
+        await client.close()
+    async_llm_clients = []
+
+# Ask the model to evaluate the prompt
+async def promptModelAsync(input_prompt, prompt_type):
+    return await completeMessagesAsync(createMessages(input_prompt), prompt_type)
+
+# Send chat messages to the model
+# Answers from the local response cache when the same messages were sent before
+async def completeMessagesAsync(messages, prompt_type="other"):
+    key = LLMCache.key(model_id, messages, {})
+    # The SQLite cache is read and written in a worker thread, so its disk I/O does not block the event loop
+    output = await asyncio.to_thread(llm_cache.get, key)
+    with llm_metrics.call(prompt_type, model_id, cacheStatus(llm_cache, output)) as record:
+        if output is not None:
+            return output
+
+        completion = await rate_controller.callAsync(
+            record.counted(lambda: next(next_client).chat.completions.create(model=model_id, messages=messages)),
+            estimateRequestTokens(messages),
+        )
+        record.completed(completion)
+    output = completion.choices[0].message.content
+    await asyncio.to_thread(llm_cache.put, key, output)
+    return output
+
+async def evaluateCSSRSAsync(text_input):
+    return await singleflight.doAsync(requestKey("cssrs", text_input), requestCSSRSAsync, text_input)
+
+async def requestCSSRSAsync(text_input):
+    input_prompt = createCSSRSPrompt(text_input=text_input)
+    output = await promptModelAsync(input_prompt, "cssrs")
+    return formatCSSRS(await parseModelOutputAsync(output, "cssrs"))
+
+async def evaluateFeaturesAsync(text_input):
+    return await singleflight.doAsync(requestKey("features", text_input), requestFeaturesAsync, text_input)
+
+async def requestFeaturesAsync(text_input):
+    input_prompt = createFeaturePrompt(text_input=text_input, features=serving_core.features_definition_csv)
+    output = await promptModelAsync(input_prompt, "feature_scores")
+    model_output = await parseModelOutputAsync(output, "feature_scores")
+    # Ask again once for the features whose rating was not a valid integer (see api.requestFeatures)
+    invalid = invalidFeatures(model_output)
+    if invalid:
+        output = await promptModelAsync(createFeatureReaskPrompt(text_input, invalid), "feature_scores_reask")
+        try:
+            model_output = mergeFeatureScores(model_output, await parseModelOutputAsync(output, "feature_scores"), invalid)
+        except ValueError:
+            pass
+    return scoreFeatures(model_output)
+
+# Parse a structured answer of the model, re-asking once if it cannot be repaired (see api.parseModelOutput)
+async def parseModelOutputAsync(output, kind):
+    value, error = await parseStructuredAsync(output, kind, reask=lambda messages: completeMessagesAsync(messages, kind + "_reask"))
+    if error is not None:
+        raise ValueError(f"Invalid {kind} answer: {error}")
+    return value
+
+# Run a part of the evaluation and time it, errors are returned instead of raised
+async def timedPartAsync(function, text_input):
+    start = time.perf_counter()
+    try:
+        return await function(text_input), None, time.perf_counter() - start
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}", time.perf_counter() - start
+
+# Evaluate the C-SSRS questions and the features of a text concurrently (same result format as api.evaluateAll)
+async def evaluateAllAsync(text_input):
+    start = time.perf_counter()
+    parts = {"cssrs": evaluateCSSRSAsync, "features": evaluateFeaturesAsync}
+    outputs = await asyncio.gather(*(timedPartAsync(function, text_input) for function in parts.values()))
+    result = {"errors": {}, "timing": {}}
+    for part, (output, error, elapsed) in zip(parts, outputs):
+        result[part] = output
+        result["timing"][part] = round(elapsed, 3)
+        if error is not None:
+            result["errors"][part] = error
+    result["timing"]["total"] = round(time.perf_counter() - start, 3)
+    return result
+
+# Evaluate one post of a batch, errors are returned as a record of the post
+async def evaluateBatchItemAsync(item):
+    try:
+        result = await evaluateAllAsync(item["text_input"])
+    except Exception as e:
+        return {"id": item["id"], "line": item["line"], "error": f"{type(e).__name__}: {e}"}
+    return {"id": item["id"], "line": item["line"], **result}
+
+# Evaluate the posts of a batch with at most max_concurrent posts in flight, yielding each result as soon as it is done
+# New posts are only started when the consumer takes a result (backpressure)
+async def evaluateBatchStreamAsync(items, max_concurrent, batch_max_concurrent):
+    max_concurrent = max(1, min(max_concurrent, batch_max_concurrent))
+    items = iter(items)
+    pending = set()
+    exhausted = False
+    duplicates = BatchDuplicates()
+    try:
+        while True:
+            while not exhausted and len(pending) < max_concurrent:
+                item = next(items, None)
+                if item is None:
+                    exhausted = True
+                elif "error" in item:
+                    yield item
+                elif duplicates.add(item):
+                    pending.add(asyncio.ensure_future(evaluateBatchItemAsync(item)))
+            for result in duplicates.ready():
+                yield result
+            if not pending:
+                break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                for result in duplicates.completed(task.result()):
+                    yield result
+    finally:
+        for task in pending:
+            task.cancel()
@@ -0,0 +1,205 @@
+# llm_metrics.py
+# Instrumentation of the LLM calls. Every chat completion gives one "call" record with the prompt type, model,
+# latency, prompt and completion tokens (from completion.usage), retries, cache status and outcome. Every parsed
+# answer gives one "parse" record with its outcome (clean, repaired, reask_fixed, failed) and the id of the call
+# whose answer was parsed last.
+# Records are appended to a JSONL log (batch pipeline) and aggregated into counters and latency histograms,
+# served in the Prometheus text format by the /metrics route of the demo application.
+# The same file is used by mainanalysis and demo_application.
+
+import bisect
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets in seconds
+latency_buckets = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Id of the last call made by the current thread or asyncio task, the parse record of its answer refers to it
+last_call_id = contextvars.ContextVar("last_call_id", default=None)
+
+
+class CallRecord:
+    def __init__(self, metrics, prompt_type, model, cache):
+        self.metrics = metrics
+        self.attempts = 0
+        self.started = time.perf_counter()
+        self.fields = {
+            "event": "call",
+            "call_id": metrics.newCallId(),
+            "time": round(time.time(), 3),
+            "prompt_type": prompt_type,
+            "model": model,
+            "cache": cache,
+            "latency_s": 0.0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "retries": 0,
+            "outcome": "ok",
+        }
+
+    # Function to wrap a call so that every attempt is counted (the rate controller calls it once per attempt)
+    def counted(self, call):
+        def attempt():
+            self.attempts += 1
+            return call()
+        return attempt
+
+    # Function to take the token counts from the usage of the completion
+    def completed(self, completion):
+        usage = getattr(completion, "usage", None)
+        self.fields["prompt_tokens"] = getattr(usage, "prompt_tokens", None) or 0
+        self.fields["completion_tokens"] = getattr(usage, "completion_tokens", None) or 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        if self.fields["cache"] != "hit":
+            self.fields["latency_s"] = round(time.perf_counter() - self.started, 4)
+        self.fields["retries"] = max(0, self.attempts - 1)
+        if error_type is not None:
+            self.fields["outcome"] = "error"
+            self.fields["error"] = error_type.__name__
+        last_call_id.set(self.fields["call_id"])
+        self.metrics.write(self.fields)
+        return False
+
+
+class LLMMetrics:
+    # log_path: JSONL file the records are appended to (None: only the aggregates are kept)
+    def __init__(self, log_path=None):
+        self.log_path = log_path
+        self.lock = threading.Lock()
+        self.log_file = None
+        self.call_ids = itertools.count(1)
+        self.run_id = f"{os.getpid()}-{int(time.time())}"
+        # (prompt_type, model, cache, outcome) -> calls
+        self.calls = {}
+        # prompt_type -> [bucket counts..., count above the last bucket], sum of the latencies
+        self.latency_counts = {}
+        self.latency_sums = {}
+        # prompt_type -> tokens / retries
+        self.prompt_tokens = {}
+        self.completion_tokens = {}
+        self.retries = {}
+        # (prompt_type, outcome) -> parsed answers
+        self.parses = {}
+
+    # Function to get the id of a new call (unique within the log of this process run)
+    def newCallId(self):
+        return f"{self.run_id}-{next(self.call_ids)}"
+
+    # Function to start the record of a call, used as: with llm_metrics.call(...) as record: ...
+    # cache: "miss" (answer from the provider), "hit" (answer from the response cache) or "disabled"
+    def call(self, prompt_type, model, cache="miss"):
+        return CallRecord(self, prompt_type, model, cache)
+
+    # Function to record the final outcome of parsing an answer of a prompt type
+    # (registered as listener of structured_output.parse_stats)
+    def parsed(self, prompt_type, outcome):
+        self.write({
+            "event": "parse",
+            "call_id": last_call_id.get(),
+            "time": round(time.time(), 3),
+            "prompt_type": prompt_type,
+            "outcome": outcome,
+        })
+
+    # Function to add a record to the aggregates and to the JSONL log
+    def write(self, record):
+        with self.lock:
+            if record["event"] == "call":
+                self.aggregateCall(record)
+            else:
+                key = (record["prompt_type"], record["outcome"])
+                self.parses[key] = self.parses.get(key, 0) + 1
+            if self.log_path is not None:
+                if self.log_file is None:
+                    directory = os.path.dirname(self.log_path)
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                    self.log_file = open(self.log_path, "a", encoding="utf-8")
+                self.log_file.write(json.dumps(record) + "\n")
+                self.log_file.flush()
+
+    def aggregateCall(self, record):
+        prompt_type = record["prompt_type"]
+        key = (prompt_type, record["model"], record["cache"], record["outcome"])
+        self.calls[key] = self.calls.get(key, 0) + 1
+        self.prompt_tokens[prompt_type] = self.prompt_tokens.get(prompt_type, 0) + record["prompt_tokens"]
+        self.completion_tokens[prompt_type] = self.completion_tokens.get(prompt_type, 0) + record["completion_tokens"]
+        self.retries[prompt_type] = self.retries.get(prompt_type, 0) + record["retries"]
+        # Cache hits do not reach the provider and are left out of the latency histogram
+        if record["cache"] != "hit":
+            counts = self.latency_counts.setdefault(prompt_type, [0] * (len(latency_buckets) + 1))
+            counts[bisect.bisect_left(latency_buckets, record["latency_s"])] += 1
+            self.latency_sums[prompt_type] = self.latency_sums.get(prompt_type, 0.0) + record["latency_s"]
+
+    # Function to get calls, cache hits, errors, retries, latency and tokens per prompt type
+    def summary(self):
+        with self.lock:
+            summary = {}
+            for (prompt_type, model, cache, outcome), calls in self.calls.items():
+                row = summary.setdefault(prompt_type, {"calls": 0, "cache_hits": 0, "errors": 0})
+                row["calls"] += calls
+                row["cache_hits"] += calls if cache == "hit" else 0
+                row["errors"] += calls if outcome == "error" else 0
+            for prompt_type, row in summary.items():
+                upstream = sum(self.latency_counts.get(prompt_type, [0]))
+                row["retries"] = self.retries[prompt_type]
+                row["latency_s"] = round(self.latency_sums.get(prompt_type, 0.0), 3)
+                row["mean_latency_s"] = round(row["latency_s"] / upstream, 3) if upstream else 0.0
+                row["prompt_tokens"] = self.prompt_tokens[prompt_type]
+                row["completion_tokens"] = self.completion_tokens[prompt_type]
+            return summary
+
+    # Function to render the aggregates in the Prometheus text exposition format
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            lines += ["# HELP llm_calls_total LLM calls by prompt type, model, cache status and outcome.",
+                      "# TYPE llm_calls_total counter"]
+            for (prompt_type, model, cache, outcome), calls in sorted(self.calls.items()):
+                lines.append(f"llm_calls_total{labels(prompt_type=prompt_type, model=model, cache=cache, outcome=outcome)} {calls}")
+
+            lines += ["# HELP llm_call_latency_seconds Latency of the LLM calls sent to the provider, retries included.",
+                      "# TYPE llm_call_latency_seconds histogram"]
+            for prompt_type, counts in sorted(self.latency_counts.items()):
+                cumulative = 0
+                for bound, count in zip(latency_buckets + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append(f"llm_call_latency_seconds_bucket{labels(prompt_type=prompt_type, le=bound)} {cumulative}")
+                lines.append(f"llm_call_latency_seconds_sum{labels(prompt_type=prompt_type)} {round(self.latency_sums[prompt_type], 4)}")
+                lines.append(f"llm_call_latency_seconds_count{labels(prompt_type=prompt_type)} {cumulative}")
+
+            for name, help_text, values in [
+                ("llm_prompt_tokens_total", "Prompt tokens reported by the provider.", self.prompt_tokens),
+                ("llm_completion_tokens_total", "Completion tokens reported by the provider.", self.completion_tokens),
+                ("llm_retries_total", "Retries of throttled or failed LLM calls.", self.retries),
+            ]:
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                for prompt_type, value in sorted(values.items()):
+                    lines.append(f"{name}{labels(prompt_type=prompt_type)} {value}")
+
+            lines += ["# HELP llm_parse_total Parsed LLM answers by prompt type and outcome.",
+                      "# TYPE llm_parse_total counter"]
+            for (prompt_type, outcome), count in sorted(self.parses.items()):
+                lines.append(f"llm_parse_total{labels(prompt_type=prompt_type, outcome=outcome)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+# Function to format Prometheus labels
+def labels(**values):
+    escaped = [(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in values.items()]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+# Function to get the cache status of a lookup for the call record
+def cacheStatus(cache, output):
+    if not cache.enabled:
+        return "disabled"
+    return "miss" if output is None else "hit"
@@ -0,0 +1,76 @@
+# near_duplicates.py
+# Near-duplicate detection of posts (reposts, cross-posts) with MinHash and locality-sensitive hashing.
+# Every post is reduced to the set of its word shingles and a MinHash signature (num_perm hash permutations). The
+# signatures are split into bands, posts that share a band are candidates. A candidate is a near-duplicate when the
+# share of equal signature values (an estimate of the Jaccard similarity of the shingles) reaches the threshold.
+# Posts are added one at a time, each near-duplicate is assigned to the first post of its group (the representative),
+# so only representatives need to be scored and their results are copied to the other posts of the group.
+# The same file is used by mainanalysis and demo_application.
+
+import re
+import zlib
+
+import numpy as np
+
+# Prime above 2**32 for the hash permutations (a * x + b) % prime
+hash_prime = 4294967311
+
+
+# Function to get the word shingles of a text (lower case, punctuation removed), short texts are one shingle
+def shingles(text, size=5):
+    words = re.sub(r"[^\w\s]", " ", str(text).lower()).split()
+    if len(words) <= size:
+        return {" ".join(words)}
+    return {" ".join(words[idx:idx + size]) for idx in range(len(words) - size + 1)}
+
+
+class MinHashIndex:
+    # threshold: estimated Jaccard similarity from which posts are near-duplicates
+    # num_perm: length of the signatures, bands: number of LSH bands (num_perm / bands values per band)
+    def __init__(self, threshold=0.9, num_perm=128, bands=32, seed=1):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, 2 ** 31, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, 2 ** 32, num_perm, dtype=np.uint64)
+        self.buckets = [{} for _ in range(bands)]
+        self.signatures = {}
+        self.representatives = {}
+
+    # Function to get the MinHash signature of a text
+    def signature(self, text):
+        hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles(text)), dtype=np.uint64)
+        return ((np.outer(hashes, self.a) + self.b) % hash_prime).min(axis=0)
+
+    # Function to add a post, returns the key of the post it is a near-duplicate of (None: it is a representative)
+    def add(self, key, text):
+        signature = self.signature(text)
+        band_keys = [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+        # Representatives sharing a band are compared by the share of equal signature values
+        candidates = {candidate for band, band_key in enumerate(band_keys) for candidate in self.buckets[band].get(band_key, ())}
+        best, best_similarity = None, 0.0
+        for candidate in sorted(candidates, key=str):
+            similarity = float(np.mean(self.signatures[candidate] == signature))
+            if similarity >= self.threshold and similarity > best_similarity:
+                best, best_similarity = candidate, similarity
+        if best is not None:
+            self.representatives[key] = best
+            return best
+
+        # Only representatives are indexed, so every group keeps a single post to compare with
+        self.signatures[key] = signature
+        for band, band_key in enumerate(band_keys):
+            self.buckets[band].setdefault(band_key, []).append(key)
+        return None
+
+    # Function to get the number of posts added and of near-duplicates among them
+    def stats(self):
+        return {"posts": len(self.signatures) + len(self.representatives), "near_duplicates": len(self.representatives)}
+
+
+# Function to find the near-duplicates among posts, returns for every post the ID of the post it duplicates (or None)
+def findNearDuplicates(post_ids, texts, threshold=0.9):
+    index = MinHashIndex(threshold)
+    return [index.add(post_id, text) for post_id, text in zip(post_ids, texts)]
@@ -0,0 +1,294 @@
+# rate_control.py
+# Client-side flow control for the calls to the LLM provider:
+# - AdaptiveConcurrency: limit of calls in flight, adjusted by additive increase / multiplicative decrease (AIMD).
+#   Every successful call raises the limit a little, a 429 or a failed call halves it.
+# - TokenBucket: requests per minute and tokens per minute of the provider plan.
+# - RateController: runs a call under both, and retries throttled or failed calls with jittered
+#   exponential backoff, waiting at least as long as the Retry-After header asks for.
+# - estimateTokens: token count of a text (tiktoken when installed), used for the tokens per minute and by the
+#   token budgets of the prompts in mainanalysis, so both measure a text the same way.
+# The same file is used by mainanalysis and demo_application.
+
+import asyncio
+import email.utils
+import random
+import re
+import threading
+import time
+from collections import deque
+
+from together import APIConnectionError, APIStatusError
+
+
+# Function to get the number of seconds from a Retry-After header (seconds or HTTP date), None if there is none
+def parseRetryAfter(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# Function to classify a failed call
+# Returns "throttled" (429), "error" (timeout, connection error, 5xx, ...) or "fatal" (other 4xx, not retried)
+def classifyError(error):
+    if isinstance(error, APIStatusError):
+        if error.status_code == 429:
+            return "throttled"
+        if error.status_code in (408, 409) or error.status_code >= 500:
+            return "error"
+        return "fatal"
+    if isinstance(error, (APIConnectionError, TimeoutError, ConnectionError, asyncio.TimeoutError)):
+        return "error"
+    return "fatal"
+
+
+# Function to get the Retry-After of a failed call in seconds, None if the provider did not send one
+def retryAfter(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    return parseRetryAfter(response.headers.get("retry-after"))
+
+
+class TokenBucket:
+    # rate_per_minute: refill rate, capacity: burst size (defaults to one second of the rate, at least 1)
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else max(1.0, self.rate)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Function to take amount from the bucket, returns the seconds to wait before the call may start
+    # The level may go below zero, so callers that arrive later queue up behind the ones already waiting
+    def reserve(self, amount):
+        with self.lock:
+            now = time.monotonic()
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+            self.updated = now
+            self.level -= amount
+            return 0.0 if self.level >= 0 else -self.level / self.rate
+
+    # Function to correct a reservation once the real amount is known (e.g. tokens from the usage of the response)
+    def adjust(self, amount):
+        with self.lock:
+            self.level = min(self.capacity, self.level - amount)
+
+
+class AdaptiveConcurrency:
+    # The limit starts at initial and stays within min_limit..max_limit
+    # latency_factor: no increase while calls take longer than latency_factor times the fastest call seen
+    def __init__(self, initial=8, min_limit=1, max_limit=64, decrease=0.5, latency_factor=3.0):
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.in_flight = 0
+        self.min_latency = None
+        self.last_decrease = 0.0
+        self.lock = threading.Lock()
+        self.slot_free = threading.Condition(self.lock)
+        self.async_waiters = deque()
+        # Counters for the stats
+        self.increases = 0
+        self.decreases = 0
+
+    # Function to wait for a free slot (threads)
+    def acquire(self):
+        with self.slot_free:
+            while self.in_flight >= int(self.limit):
+                self.slot_free.wait()
+            self.in_flight += 1
+        return time.monotonic()
+
+    # Function to wait for a free slot (asyncio tasks)
+    async def acquireAsync(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return time.monotonic()
+                waiter = loop.create_future()
+                self.async_waiters.append((loop, waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # A task cancelled after it was woken up passes the wake-up on, else the free slot is lost
+                if waiter.done() and not waiter.cancelled():
+                    with self.lock:
+                        self.wakeAsyncWaiters()
+                raise
+
+    # Function to free the slot of a call and adjust the limit to its outcome ("ok", "throttled", "error", "fatal")
+    # started: return value of acquire, so only calls started after the last decrease can decrease the limit again
+    # (the calls in flight when the provider starts throttling all fail together, that is one signal and not many)
+    def release(self, started, outcome, latency=None):
+        with self.lock:
+            self.in_flight -= 1
+            if outcome == "ok":
+                if latency is not None:
+                    self.min_latency = latency if self.min_latency is None else min(self.min_latency, latency)
+                slow = latency is not None and latency > self.latency_factor * self.min_latency
+                if not slow and self.limit < self.max_limit:
+                    # Until the first decrease +1 per call (doubling per round of calls, like TCP slow start),
+                    # after that about +1 per limit calls, i.e. +1 per round of calls
+                    step = 1.0 if self.decreases == 0 else 1.0 / self.limit
+                    self.limit = min(self.max_limit, self.limit + step)
+                    self.increases += 1
+            elif outcome in ("throttled", "error") and started >= self.last_decrease:
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+                self.last_decrease = time.monotonic()
+                self.decreases += 1
+
+            # Wake up as many waiters as there are free slots
+            free = int(self.limit) - self.in_flight
+            self.slot_free.notify(max(0, free))
+            self.wakeAsyncWaiters()
+
+    # Function to wake up as many waiting tasks as there are free slots (called with the lock held)
+    def wakeAsyncWaiters(self):
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self.async_waiters:
+            loop, waiter = self.async_waiters.popleft()
+            if waiter.done():
+                # The waiting task was cancelled
+                continue
+            loop.call_soon_threadsafe(self.wakeAsyncWaiter, waiter)
+            free -= 1
+
+    # Function to wake up a waiting task, a task cancelled before the wake-up arrived passes it on to the next one
+    def wakeAsyncWaiter(self, waiter):
+        if not waiter.done():
+            waiter.set_result(None)
+        elif waiter.cancelled():
+            with self.lock:
+                self.wakeAsyncWaiters()
+
+
+class RateController:
+    # requests_per_minute, tokens_per_minute: limits of the provider plan (None: not limited)
+    # max_retries: retries of a throttled or failed call, backoff: base of the exponential backoff in seconds
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, initial_concurrency=8, max_concurrency=64,
+                 max_retries=5, backoff=1.0, max_backoff=60.0):
+        self.concurrency = AdaptiveConcurrency(initial=initial_concurrency, max_limit=max_concurrency)
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute, capacity=tokens_per_minute / 6) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.counts = {"calls": 0, "retries": 0, "throttled": 0, "errors": 0, "failed": 0}
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    # Function to get the seconds to wait for the rate limits before a call of estimated_tokens
+    def reserve(self, estimated_tokens):
+        wait = 0.0
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.reserve(estimated_tokens))
+        return wait
+
+    # Function to correct the token reservation with the usage reported in the response
+    def settle(self, response, estimated_tokens):
+        usage = getattr(response, "usage", None)
+        if self.tokens is not None and getattr(usage, "total_tokens", None):
+            self.tokens.adjust(usage.total_tokens - estimated_tokens)
+
+    # Function to get the seconds to wait before retry number attempt (full jitter, at least the Retry-After)
+    def retryDelay(self, attempt, error):
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        retry_after = retryAfter(error)
+        return max(delay, retry_after) if retry_after is not None else delay
+
+    # Function to record a failed attempt, returns the seconds to wait before the retry or raises the error
+    def failed(self, attempt, error, outcome):
+        self.count("throttled" if outcome == "throttled" else "errors")
+        if outcome == "fatal" or attempt >= self.max_retries:
+            self.count("failed")
+            raise error
+        self.count("retries")
+        return self.retryDelay(attempt, error)
+
+    # Function to run call() under the rate limits and the adaptive concurrency limit, with retries
+    def call(self, call, estimated_tokens=0):
+        self.count("calls")
+        for attempt in range(self.max_retries + 1):
+            time.sleep(self.reserve(estimated_tokens))
+            started = self.concurrency.acquire()
+            try:
+                response = call()
+            except Exception as e:
+                outcome = classifyError(e)
+                self.concurrency.release(started, outcome)
+                time.sleep(self.failed(attempt, e, outcome))
+                continue
+            self.concurrency.release(started, "ok", time.monotonic() - started)
+            self.settle(response, estimated_tokens)
+            return response
+
+    # Async version of call for coroutine functions
+    async def callAsync(self, call, estimated_tokens=0):
+        self.count("calls")
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(self.reserve(estimated_tokens))
+            started = await self.concurrency.acquireAsync()
+            try:
+                response = await call()
+            except asyncio.CancelledError:
+                self.concurrency.release(started, "fatal")
+                raise
+            except Exception as e:
+                outcome = classifyError(e)
+                self.concurrency.release(started, outcome)
+                await asyncio.sleep(self.failed(attempt, e, outcome))
+                continue
+            self.concurrency.release(started, "ok", time.monotonic() - started)
+            self.settle(response, estimated_tokens)
+            return response
+
+    # Function to get the counters and the current concurrency limit
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+        stats["concurrency_limit"] = int(self.concurrency.limit)
+        stats["in_flight"] = self.concurrency.in_flight
+        stats["limit_increases"] = self.concurrency.increases
+        stats["limit_decreases"] = self.concurrency.decreases
+        return stats
+
+
+# Local tokenizer for the token counts of the prompts (optional, without tiktoken the tokens are estimated)
+try:
+    import tiktoken
+    token_encoding = tiktoken.get_encoding("cl100k_base")
+except (ImportError, OSError):
+    token_encoding = None
+
+
+# Function to count the tokens of a text with the local tokenizer
+# Without it, every run of up to 4 ASCII letters or digits and every punctuation mark counts as one token and every
+# other character as one token per UTF-8 byte, which overestimates English text instead of underestimating posts
+# with emoji, non-Latin scripts or many punctuation marks
+def estimateTokens(text):
+    if token_encoding is not None:
+        return len(token_encoding.encode(text, disallowed_special=())) + 1
+    pieces = re.findall(r"[A-Za-z0-9]{1,4}|[^\sA-Za-z0-9]", text)
+    return sum(1 if piece.isascii() else len(piece.encode("utf-8")) for piece in pieces) + 1
+
+
+# Function to estimate the tokens of a chat request (counted as the prompts are packed) plus its answer
+def estimateRequestTokens(messages, max_tokens=None):
+    prompt_tokens = sum(estimateTokens(message["content"]) for message in messages)
+    return prompt_tokens + (max_tokens or 500)
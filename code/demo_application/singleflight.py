@@ -0,0 +1,98 @@
+# Coalescing of identical requests that are in flight at the same time ("singleflight")
+# The first request for a key runs the evaluation, requests for the same key that arrive before it
+# has finished wait for it and share its result (or its error) instead of calling the LLM again.
+# Unlike the response cache, nothing is kept once the call is done.
+
+import asyncio
+import copy
+import hashlib
+import threading
+import unicodedata
+
+
+# Function to build the coalescing key of a text for an endpoint
+# Texts that only differ in unicode normalization, surrounding or repeated whitespace share a key
+def requestKey(endpoint, text_input):
+    normalized = " ".join(unicodedata.normalize("NFC", text_input).split())
+    return endpoint + ":" + hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.task = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.async_calls = {}
+        # leaders: calls that went upstream, coalesced_hits: requests answered by another request's call
+        self.leaders = 0
+        self.coalesced_hits = 0
+        self.max_waiters = 0
+
+    # Function to register a request for key, returns True if it is the first one (the leader)
+    def join(self, calls, key, create):
+        with self.lock:
+            call = calls.get(key)
+            if call is None:
+                calls[key] = create()
+                self.leaders += 1
+                return calls[key], True
+            call.waiters += 1
+            self.coalesced_hits += 1
+            self.max_waiters = max(self.max_waiters, call.waiters)
+            return call, False
+
+    # Function to run function(*args) once for all threads asking for key at the same time
+    # Waiters get a copy of the result, so no request can change the result of another one
+    def do(self, key, function, *args):
+        call, leader = self.join(self.calls, key, InFlightCall)
+        if leader:
+            try:
+                call.result = function(*args)
+            except Exception as e:
+                call.error = e
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result if leader else copy.deepcopy(call.result)
+
+    # Function to run the coroutine function(*args) once for all tasks asking for key at the same time
+    # The call runs as its own task, so a request that is cancelled (client gone) does not cancel it for the others
+    async def doAsync(self, key, function, *args):
+        call, leader = self.join(self.async_calls, key, InFlightCall)
+        if leader:
+            call.task = asyncio.ensure_future(function(*args))
+            call.task.add_done_callback(lambda task: self.finishAsync(key))
+        result = await asyncio.shield(call.task)
+        return result if leader else copy.deepcopy(result)
+
+    # Function to forget a finished async call, later requests for the key start a new call
+    def finishAsync(self, key):
+        with self.lock:
+            del self.async_calls[key]
+
+    # Function to get the coalescing counters, waiting: requests currently waiting for another request's call
+    def stats(self):
+        with self.lock:
+            in_flight = list(self.calls.values()) + list(self.async_calls.values())
+            requests = self.leaders + self.coalesced_hits
+            return {
+                "in_flight": len(in_flight),
+                "waiting": sum(call.waiters for call in in_flight),
+                "leaders": self.leaders,
+                "coalesced_hits": self.coalesced_hits,
+                "coalesced_rate": round(self.coalesced_hits / requests, 4) if requests else 0.0,
+                "max_waiters": self.max_waiters,
+            }
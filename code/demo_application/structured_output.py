@@ -0,0 +1,462 @@
+# structured_output.py
+# Parsing of the JSON answers of the LLM, with a schema per prompt type.
+# Answers that are not valid JSON are repaired locally first: text around the JSON, code fences, single quotes,
+# Python literals, trailing or missing commas, unescaped quotes and answers cut off in the middle.
+# Only if that fails, a short re-ask (the broken answer and what is wrong with it, without the post) is sent
+# through the reask function of the caller, so it goes through the caller's cache and rate control.
+# Every parse is counted per prompt type, see parseStats.
+# The same file is used by mainanalysis and demo_application.
+
+import json
+import threading
+
+
+class SchemaError(ValueError):
+    pass
+
+
+########################################################################################
+# Tolerant JSON extraction
+########################################################################################
+
+closing_brackets = {"{": "}", "[": "]"}
+python_literals = {"True": "true", "False": "false", "None": "null", "true": "true", "false": "false", "null": "null"}
+
+
+# Function to check if the quote at position i ends the string (and is not a quote inside the text)
+# A closing quote is followed by , : } ] (or a new key or value on the next line, or the end of the text)
+def isClosingQuote(text, i):
+    j = i + 1
+    while j < len(text) and text[j] in " \t\r\n":
+        j += 1
+    return j == len(text) or text[j] in ",:}]\"'" or (text[j] in "{[" and "\n" in text[i + 1:j])
+
+
+# Function to turn the JSON value starting at position start into strict JSON
+# Returns the JSON text, the end of the value in the text (None if it was cut off), the repairs that were needed,
+# and cut points (position in the JSON text, open brackets) after every complete element
+def scanJSON(text, start):
+    out = []
+    stack = []
+    repairs = set()
+    cut_points = []
+    quote = None
+    i = start
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if quote is not None:
+            if c == "\\":
+                escaped = text[i + 1:i + 2]
+                if escaped == "'":
+                    out.append("'")
+                elif escaped:
+                    out.append(c + escaped)
+                i += 2
+                continue
+            if c == quote and isClosingQuote(text, i):
+                out.append('"')
+                quote = None
+            elif c == '"':
+                out.append('\\"')
+                if quote == '"':
+                    repairs.add("unescaped quote")
+            elif c == "\n":
+                out.append("\\n")
+            elif c == "\t":
+                out.append("\\t")
+            elif ord(c) < 0x20:
+                out.append(f"\\u{ord(c):04x}")
+            else:
+                out.append(c)
+            i += 1
+            continue
+
+        if c in "\"'{[-_" or c.isalnum():
+            # A new value right after a complete one: the comma is missing
+            last = next((o for o in reversed(out) if o.strip()), "")
+            if stack and last and (last[-1] in "\"}]" or last[-1].isalnum()):
+                cut_points.append((len(out), tuple(stack)))
+                out.append(",")
+                repairs.add("missing comma")
+
+        if c in "\"'":
+            if c == "'":
+                repairs.add("single quotes")
+            quote = c
+            out.append('"')
+        elif c in "{[":
+            stack.append(c)
+            out.append(c)
+        elif c in "}]":
+            # Drop a trailing comma before the closing bracket
+            while out and not out[-1].strip():
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()
+                cut_points.pop()
+                repairs.add("trailing comma")
+            if closing_brackets[stack[-1]] != c:
+                repairs.add("mismatched bracket")
+            out.append(closing_brackets[stack.pop()])
+            if not stack:
+                return "".join(out), i + 1, repairs, cut_points
+        elif c == ",":
+            cut_points.append((len(out), tuple(stack)))
+            out.append(c)
+        elif c.isdigit() or c == "-":
+            j = i + 1
+            while j < n and (text[j].isdigit() or text[j] in ".eE+-"):
+                j += 1
+            out.append(text[i:j])
+            i = j
+            continue
+        elif c.isalpha() or c == "_":
+            j = i
+            while j < n and (text[j].isalnum() or text[j] == "_"):
+                j += 1
+            word = text[i:j]
+            if word in python_literals:
+                if python_literals[word] != word:
+                    repairs.add("python literal")
+                out.append(python_literals[word])
+            else:
+                # Unquoted key or text
+                out.append(json.dumps(word))
+                repairs.add("unquoted text")
+            i = j
+            continue
+        elif c == "/" and text[i + 1:i + 2] == "/":
+            while i < n and text[i] != "\n":
+                i += 1
+            repairs.add("comment")
+            continue
+        elif c == "`":
+            repairs.add("code fence")
+        else:
+            out.append(c)
+        i += 1
+
+    # The text ended before the value was closed: the answer was cut off
+    if quote is not None:
+        out.append('"')
+    repairs.add("truncated")
+    return "".join(out), None, repairs, cut_points
+
+
+# Function to list the ways to close a cut-off JSON text: as it is, then dropping the last elements one by one
+def truncatedCandidates(json_text, cut_points):
+    candidates = [(json_text.rstrip().rstrip(",:"), openBrackets(json_text))]
+    candidates += [(json_text[:pos], open_brackets) for pos, open_brackets in reversed(cut_points[-50:])]
+    return [candidate + "".join(closing_brackets[b] for b in reversed(open_brackets)) for candidate, open_brackets in candidates]
+
+
+# Function to get the open brackets at the end of a JSON text, ignoring brackets in strings
+def openBrackets(json_text):
+    stack = []
+    in_string = False
+    escaped = False
+    for c in json_text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c in "{[":
+            stack.append(c)
+        elif c in "}]" and stack:
+            stack.pop()
+    return stack
+
+
+# Function to extract the first JSON value of the expected container type ("object", "array" or "any") from a text
+# that passes validate (a schema function that returns the normalized value or raises SchemaError)
+# Returns the value and the repairs that were needed (empty if the text was valid JSON), raises ValueError if nothing fits
+def extractJSON(text, container="any", validate=lambda value: value):
+    if not isinstance(text, str):
+        raise ValueError("No answer")
+    errors = []
+    try:
+        return validate(json.loads(text)), set()
+    except json.JSONDecodeError:
+        pass
+    except SchemaError as e:
+        errors.append(str(e))
+
+    # Try the first few opening brackets, the first one can be part of the text before the JSON
+    openers = {"object": "{", "array": "[", "any": "{["}[container]
+    starts = [i for i, c in enumerate(text) if c in openers][:5]
+    for start in starts:
+        json_text, end, repairs, cut_points = scanJSON(text, start)
+        candidates = [json_text] if end is not None else truncatedCandidates(json_text, cut_points)
+        for candidate in candidates:
+            try:
+                value = validate(json.loads(candidate, strict=False))
+            except json.JSONDecodeError as e:
+                errors.append(f"Invalid JSON: {e}")
+                continue
+            except SchemaError as e:
+                errors.append(str(e))
+                continue
+            if text[:start].strip() or (end is not None and text[end:].strip()):
+                repairs.add("surrounding text")
+            return value, repairs or {"reformatted"}
+
+    if not errors:
+        raise ValueError("No JSON " + (container if container != "any" else "value") + " found")
+    # A schema error says more about the answer than a syntax error of a cut-off part
+    raise ValueError(next((e for e in errors if not e.startswith("Invalid JSON")), errors[0]))
+
+
+########################################################################################
+# Schemas per prompt type
+########################################################################################
+
+# Function to coerce a rating to an int within minimum..maximum
+def toRating(value, minimum, maximum, name):
+    if isinstance(value, bool):
+        raise SchemaError(f"{name}: rating must be an integer, got {value!r}")
+    try:
+        rating = int(float(value))
+    except (TypeError, ValueError):
+        raise SchemaError(f"{name}: rating must be an integer, got {value!r}")
+    if rating != float(value) or not minimum <= rating <= maximum:
+        raise SchemaError(f"{name}: rating must be an integer from {minimum} to {maximum}, got {value!r}")
+    return rating
+
+
+def requireObject(value):
+    if not isinstance(value, dict):
+        raise SchemaError(f"expected a JSON object, got {type(value).__name__}")
+    return value
+
+
+def requireList(value):
+    if not isinstance(value, list):
+        raise SchemaError(f"expected a JSON list, got {type(value).__name__}")
+    return value
+
+
+# C-SSRS answer: Yes/No per question and the frequency 0-4
+def validateCSSRS(value):
+    requireObject(value)
+    answer = {"brief_reasoning": str(value.get("brief_reasoning", ""))}
+    for field in ["answer1", "answer2", "answer3", "answer4", "answer5"]:
+        if field not in value:
+            raise SchemaError(f"missing {field}")
+        yes_no = value[field]
+        if isinstance(yes_no, bool):
+            yes_no = "Yes" if yes_no else "No"
+        yes_no = str(yes_no).strip().capitalize()
+        if yes_no not in ("Yes", "No"):
+            raise SchemaError(f"{field} must be Yes or No, got {value[field]!r}")
+        answer[field] = yes_no
+    if "frequency" not in value:
+        raise SchemaError("missing frequency")
+    answer["frequency"] = toRating(value["frequency"], 0, 4, "frequency")
+    return answer
+
+
+# Feature ratings of one category: [{"featureid": ..., "rating": 0-3}, ...]
+# An object of featureid -> rating is accepted as well
+def validateRatings(value):
+    if isinstance(value, dict) and value and all(not isinstance(v, (dict, list)) for v in value.values()):
+        value = [{"featureid": key, "rating": rating} for key, rating in value.items()]
+    ratings = []
+    for entry in requireList(value):
+        if not isinstance(entry, dict) or "featureid" not in entry or "rating" not in entry:
+            raise SchemaError(f"every entry needs featureid and rating, got {entry!r}")
+        ratings.append({"featureid": str(entry["featureid"]), "rating": toRating(entry["rating"], 0, 3, str(entry["featureid"]))})
+    return ratings
+
+
+# Differences between two posts: [{"Category": ..., "Post 1": ..., "Post 2": ...}, ...]
+def validateCategoryDiffs(value):
+    diffs = []
+    for entry in requireList(value):
+        if not isinstance(entry, dict) or not entry.get("Category"):
+            raise SchemaError(f"every entry needs a Category, got {entry!r}")
+        diffs.append({"Category": str(entry["Category"]), "Post 1": str(entry.get("Post 1", "")), "Post 2": str(entry.get("Post 2", ""))})
+    return diffs
+
+
+# Feature definitions of a category: [{"featurename": ..., "short_description": ..., "rating": ...}, ...]
+def validateFeatureDefinitions(value):
+    if isinstance(value, dict) and len(value) == 1 and isinstance(next(iter(value.values())), list):
+        value = next(iter(value.values()))
+    definitions = []
+    for entry in requireList(value):
+        if not isinstance(entry, dict) or any(field not in entry for field in ["featurename", "short_description", "rating"]):
+            raise SchemaError(f"every entry needs featurename, short_description and rating, got {entry!r}")
+        definitions.append({field: str(entry[field]) for field in ["featurename", "short_description", "rating"]})
+    return definitions
+
+
+# Top categories after removing redundant ones: {"categories": [{"name": ...}, ...]}
+# A plain list of names (or of {"name": ...}) is accepted as well
+def validateRedundantCategories(value):
+    if isinstance(value, dict):
+        value = value.get("categories", next((v for v in value.values() if isinstance(v, list)), None))
+    categories = []
+    for entry in requireList(value):
+        name = entry.get("name") if isinstance(entry, dict) else entry
+        if not isinstance(name, str) or not name.strip():
+            raise SchemaError(f"every category needs a name, got {entry!r}")
+        categories.append({"name": name})
+    if not categories:
+        raise SchemaError("no categories")
+    return {"categories": categories}
+
+
+# Feature scores of the demo application: {"<feature_name>": rating, ...}
+# Numeric strings and whole floats are accepted (toRating), any other rating becomes None, so the caller can ask again
+# for those features only. Only an answer without a single valid rating is invalid.
+def validateFeatureScores(value):
+    scores = {}
+    for name, rating in requireObject(value).items():
+        try:
+            scores[str(name)] = toRating(rating, 0, 3, str(name))
+        except SchemaError:
+            scores[str(name)] = None
+    if all(rating is None for rating in scores.values()):
+        raise SchemaError("no valid feature ratings")
+    return scores
+
+
+# prompt type -> (JSON container, validator, description of the expected format used for re-asks)
+# The batch types only check the container, the entries are validated one by one by the caller
+schemas = {
+    "cssrs": ("object", validateCSSRS,
+              '{"brief_reasoning": "...", "answer1": "Yes" or "No", ..., "answer5": "Yes" or "No", "frequency": integer 0-4}'),
+    "cssrs_batch": ("object", requireObject,
+                    'an object with one C-SSRS answer {"brief_reasoning": "...", "answer1": "Yes" or "No", ..., "frequency": integer 0-4} for every post ID'),
+    "feature_ratings": ("array", validateRatings, '[{"featureid": "...", "rating": integer 0-3}, ...]'),
+    "category_ratings": ("object", requireObject,
+                         'an object with a list [{"featureid": "...", "rating": integer 0-3}, ...] for every category or text ID'),
+    "category_diffs": ("array", validateCategoryDiffs, '[{"Category": "...", "Post 1": "...", "Post 2": "..."}, ...]'),
+    "feature_definitions": ("array", validateFeatureDefinitions, '[{"featurename": "...", "short_description": "...", "rating": "..."}, ...]'),
+    "redundant_categories": ("any", validateRedundantCategories, '{"categories": [{"name": "..."}, ...]}'),
+    "feature_scores": ("object", validateFeatureScores, '{"<feature_name>": integer rating, ...}'),
+}
+
+
+########################################################################################
+# Parsing, re-asks and statistics
+########################################################################################
+
+# Outcomes that end the parsing of an answer, passed to the listeners
+final_outcomes = ("clean", "repaired", "reask_fixed", "failed")
+
+
+class ParseStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.listeners = []
+
+    def count(self, kind, outcome):
+        with self.lock:
+            counts = self.counts.setdefault(kind, {"parsed": 0, "clean": 0, "repaired": 0, "failed": 0, "reasked": 0, "reask_fixed": 0})
+            counts[outcome] += 1
+        if outcome in final_outcomes:
+            for listener in self.listeners:
+                listener(kind, outcome)
+
+
+parse_stats = ParseStats()
+
+
+# Function to register listener(kind, outcome), called with the final outcome of every answer parsed by parseStructured
+def onParsed(listener):
+    parse_stats.listeners.append(listener)
+
+
+# Function to validate a value against the schema of a prompt type, returns (normalized value, None) or (None, error)
+def validateStructured(value, kind):
+    try:
+        return schemas[kind][1](value), None
+    except SchemaError as e:
+        return None, str(e)
+
+
+# Function to parse an LLM answer of a prompt type once, without re-ask and without counting it
+# Returns (value, repairs, error)
+def parseOnce(output, kind):
+    container, validate, _ = schemas[kind]
+    try:
+        value, repairs = extractJSON(output, container, validate)
+    except ValueError as e:
+        return None, set(), str(e)
+    return value, repairs, None
+
+
+# Function to parse an LLM answer of a prompt type, returns (value, None) or (None, error message)
+# If the answer cannot be repaired locally and reask is given, reask(messages) is called with the
+# messages of reaskMessages and its answer is parsed instead
+def parseStructured(output, kind, reask=None):
+    value, repairs, error = parseOnce(output, kind)
+    parse_stats.count(kind, "parsed")
+    if error is None:
+        parse_stats.count(kind, "repaired" if repairs else "clean")
+        return value, None
+    if reask is not None:
+        parse_stats.count(kind, "reasked")
+        try:
+            value, _, error = parseOnce(reask(reaskMessages(output, kind, error)), kind)
+        except Exception as e:
+            error = f"Re-ask failed: {type(e).__name__}: {e}"
+        if error is None:
+            parse_stats.count(kind, "reask_fixed")
+            return value, None
+    parse_stats.count(kind, "failed")
+    return None, error
+
+
+# Async version of parseStructured for a coroutine function reask
+async def parseStructuredAsync(output, kind, reask=None):
+    value, repairs, error = parseOnce(output, kind)
+    parse_stats.count(kind, "parsed")
+    if error is None:
+        parse_stats.count(kind, "repaired" if repairs else "clean")
+        return value, None
+    if reask is not None:
+        parse_stats.count(kind, "reasked")
+        try:
+            value, _, error = parseOnce(await reask(reaskMessages(output, kind, error)), kind)
+        except Exception as e:
+            error = f"Re-ask failed: {type(e).__name__}: {e}"
+        if error is None:
+            parse_stats.count(kind, "reask_fixed")
+            return value, None
+    parse_stats.count(kind, "failed")
+    return None, error
+
+
+# Function to create the chat messages of a re-ask: the broken answer, what is wrong and the expected format
+# Much shorter than the original prompt, since the post and the instructions are not sent again
+def reaskMessages(output, kind, error):
+    content = f"""The following answer is not valid: {error}.
+Expected format: {schemas[kind][2]}
+Please return the corrected answer. Return ONLY the JSON, without any other text.
+
+Answer:
+{output}"""
+    return [{"role": "user", "content": content}]
+
+
+# Function to get the parse counters per prompt type with the repair and failure rates
+#   parsed: answers parsed, clean: valid JSON as is, repaired: valid after local repair,
+#   reasked: re-asks sent, reask_fixed: re-asks that gave a valid answer, failed: no valid answer in the end
+def parseStats():
+    with parse_stats.lock:
+        stats = {kind: dict(counts) for kind, counts in parse_stats.counts.items()}
+    for counts in stats.values():
+        parsed = counts["parsed"] or 1
+        counts["repair_rate"] = round(counts["repaired"] / parsed, 4)
+        counts["reask_rate"] = round(counts["reasked"] / parsed, 4)
+        counts["failure_rate"] = round(counts["failed"] / parsed, 4)
+    return stats
@@ -0,0 +1,78 @@
+# category_groups.py
+# Local grouping of the free-text difference categories of Part 2 before the redundancy filter.
+# The comparisons return many near-synonyms ("coping", "coping mechanisms", "coping strategy", ...). Labels are merged
+# into groups by their similarity: the higher of a fuzzy string ratio and the TF-IDF cosine of their words.
+# Labels are visited from the most to the least frequent, each joins the most similar group representative if it is
+# similar enough, otherwise it starts a group of its own. The representative is the most frequent label of the group.
+# Only the representatives (with the summed counts) are sent to the LLM, the mapping keeps the raw labels of each group.
+
+import difflib
+import math
+import re
+from collections import Counter
+
+import pandas as pd
+
+
+# Function to normalize a category label: lower case, punctuation removed, single spaces
+def normalizeCategory(label):
+    return " ".join(re.sub(r"[^\w\s]", " ", str(label).lower()).split())
+
+
+# Function to get the TF-IDF vectors of the words of labels, normalized to length 1
+def wordVectors(labels):
+    documents = [Counter(label.split()) for label in labels]
+    frequencies = Counter(word for document in documents for word in document)
+    vectors = []
+    for document in documents:
+        vector = {word: count * (math.log((1 + len(documents)) / (1 + frequencies[word])) + 1) for word, count in document.items()}
+        norm = math.sqrt(sum(value * value for value in vector.values())) or 1.0
+        vectors.append({word: value / norm for word, value in vector.items()})
+    return vectors
+
+
+# Function to get the similarity of two labels: the higher of the fuzzy string ratio and the cosine of their word vectors
+def categorySimilarity(label1, label2, vector1, vector2):
+    cosine = sum(value * vector2.get(word, 0.0) for word, value in vector1.items())
+    return max(cosine, difflib.SequenceMatcher(None, label1, label2).ratio())
+
+
+# Function to group category labels by similarity
+# counts: number of comparisons per raw label (e.g. the value_counts() of the categories), threshold: minimal similarity
+# Returns a DataFrame with one row per raw label: category, group (its representative), count
+def groupCategories(counts, threshold):
+    counts = counts.sort_values(ascending=False, kind="stable")
+    labels = [normalizeCategory(label) for label in counts.index]
+    vectors = wordVectors(labels)
+    representatives = []
+    groups = []
+    for idx, label in enumerate(labels):
+        similarities = [categorySimilarity(label, labels[rep], vectors[idx], vectors[rep]) for rep in representatives]
+        best = max(range(len(similarities)), key=similarities.__getitem__, default=None)
+        if best is not None and similarities[best] >= threshold:
+            groups.append(counts.index[representatives[best]])
+        else:
+            representatives.append(idx)
+            groups.append(counts.index[idx])
+    return pd.DataFrame({"category": counts.index, "group": groups, "count": counts.values})
+
+
+# Function to get the summed count of each group, most frequent first
+def groupCounts(category_groups):
+    return category_groups.groupby("group", sort=False)["count"].sum().sort_values(ascending=False, kind="stable")
+
+
+# Function to find the group of a category named by the LLM: the group of the same raw label, otherwise the group
+# whose representative is the most similar (at least threshold), None if there is none
+def findGroup(category_groups, category, threshold):
+    exact = category_groups[category_groups["category"] == category]
+    if len(exact):
+        return exact["group"].iloc[0]
+    representatives = list(category_groups["group"].unique())
+    labels = [normalizeCategory(label) for label in [category] + representatives]
+    vectors = wordVectors(labels)
+    similarities = [categorySimilarity(labels[0], labels[idx], vectors[0], vectors[idx]) for idx in range(1, len(labels))]
+    best = max(range(len(similarities)), key=similarities.__getitem__, default=None)
+    if best is None or similarities[best] < threshold:
+        return None
+    return representatives[best]
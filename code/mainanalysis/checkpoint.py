@@ -0,0 +1,41 @@
+# checkpoint.py
+# Append-only JSONL logs that make the long LLM loops in main.py resumable.
+# Every finished post is written as one line as soon as its result is available,
+# so a crashed run only loses the posts that were in flight. On restart the IDs
+# already in the log are skipped and the final tables are built from the log.
+
+import json
+import os
+
+
+# Function to append one finished record to the log and flush it to disk
+def appendCheckpoint(path, record):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+# Function to read all records from a log (a partially written last line from a crash is ignored)
+def readCheckpoint(path):
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                print(f"Skipping incomplete line in {path}")
+    return records
+
+
+# Function to get the IDs that already finished, if a post was logged twice the last record wins
+def loadCheckpoint(path, id_column="ID"):
+    finished = {}
+    for record in readCheckpoint(path):
+        finished[record[id_column]] = record
+    return finished
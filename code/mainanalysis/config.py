@@ -10,3 +10,96 @@ modelID = "meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo"
 train_data_path = os.path.join(data_path, "swmh_train.jsonl")
 output_path = "../data"
 
+# Sampling of the training data (streamed from train_data_path, stratify_by = "label" keeps the subreddit proportions)
+sample_size = 10000
+seed = 42
+stratify_by = None
+
+# Concurrency settings for the async scoring engine
+# (set TOGETHER_BASE_URL in .env to point the clients at a local stub server)
+max_in_flight = 32
+request_timeout = 60
+
+# Rate control of all LLM calls (rate_control.py): the number of requests in flight starts at initial_in_flight
+# and adapts between 1 and max_in_flight (more after successes, half after a 429 or an error)
+# requests_per_minute / tokens_per_minute: limits of the provider plan (None: not limited)
+initial_in_flight = 8
+requests_per_minute = None
+tokens_per_minute = None
+max_retries = 5
+
+# Persistent LLM response cache (set LLM_CACHE_DISABLED=1 to bypass it)
+llm_cache_path = os.getenv("LLM_CACHE_PATH", os.path.join(output_path, "llm_cache.sqlite"))
+llm_cache_max_bytes = 512 * 1024 * 1024
+llm_cache_enabled = os.getenv("LLM_CACHE_DISABLED", "0") != "1"
+
+# Instrumentation of the LLM calls (llm_metrics.py): one JSONL record per call and per parsed answer
+llm_metrics_path = os.getenv("LLM_METRICS_PATH", os.path.join(output_path, "llm_calls.jsonl"))
+
+# Tracing of the stages of main.py (tracing.py): Chrome trace JSON, open it in ui.perfetto.dev (None disables tracing)
+# Stages listed in profile_stages (e.g. ["cssrs_assembly", "feature_table"] or a stage of the runner) also run under cProfile, .prof files go to profile_path
+trace_path = os.getenv("TRACE_PATH", os.path.join(output_path, "trace.json"))
+profile_stages = []
+profile_path = os.path.join(output_path, "profiles")
+
+# Stage cache of main.py (stage_runner.py): the outputs of every stage, keyed by its inputs, parameters and prompts
+stage_cache_path = os.path.join(output_path, "stages")
+
+# Resumable runs: finished posts are appended to JSONL logs in checkpoint_path and skipped on restart
+resume = True
+checkpoint_path = os.path.join(output_path, "checkpoints")
+
+# Local pre-filter of the C-SSRS scoring (prefilter.py, requires scikit-learn), trained on the C-SSRS ratings of an earlier run
+# (e.g. a copy of its dataset_train_10k_CSSRS_ratings.csv, None disables the pre-filter). Posts it rates as clear negatives
+# are not sent to the LLM. prefilter_recall: share of the positive posts that must still be sent to the LLM,
+# prefilter_holdout: share of the ratings held out to compare the cascade with the full scoring
+prefilter_training_path = None
+prefilter_recall = 0.98
+prefilter_holdout = 0.2
+
+# Selection of the post pairs compared in Part 2: "random" compares max_pairs random pairs, "diverse" (pair_selection.py,
+# requires scikit-learn) compares contrasting pairs across pair_clusters clusters of posts and stops once fewer than
+# saturation_min_new new categories were found in the last saturation_window comparisons (at most max_pairs)
+pair_selection = "random"
+max_pairs = 100
+pair_clusters = 20
+saturation_window = 15
+saturation_min_new = 1
+
+# Grouping of the raw difference categories before the redundancy filter (category_groups.py): labels at least
+# category_similarity similar (fuzzy string ratio or TF-IDF cosine of their words) are merged, only the groups and their
+# counts are sent to the LLM (e.g. 0.7, None sends all raw labels as in the original analysis)
+category_similarity = None
+
+# Token budget of the example comparisons in the feature definition prompt of a category (tiktoken count, or an estimate
+# without tiktoken, e.g. 4000). Duplicate comparisons are dropped and the most diverse ones are kept (None: all examples
+# as in the original analysis)
+feature_examples_token_budget = None
+
+# Near-duplicate posts (near_duplicates.py): posts whose word shingles are at least near_duplicate_threshold similar
+# (MinHash estimate of the Jaccard similarity) are scored once, the other posts of the group take over the results and
+# name the scored post in a duplicate_of column (e.g. 0.9, None scores every post as in the original analysis)
+near_duplicate_threshold = None
+
+# Clustering of the evaluated features and marker features per cluster (marker_features.py, requires scikit-learn and scipy)
+# marker_clusters: number of k-means clusters (4 in downstream_analyses.R, None skips the stage), features missing for at
+# least marker_max_missing of the posts are dropped, marker_top_n markers are kept per cluster, mini-batch k-means is
+# used from marker_minibatch_rows posts on
+marker_clusters = None
+marker_max_missing = 0.5
+marker_top_n = 15
+marker_minibatch_rows = 50000
+
+# Sharded runs of cssrs_ratings and feature_evaluation (sharding.py, main.py --shards N): local workers that fail are
+# started again up to shard_retries times, the progress of the shards is printed every shard_poll_seconds
+shard_retries = 2
+shard_poll_seconds = 30
+
+# Feature evaluation: rate all categories of a post in one request (missing categories are re-asked one by one),
+# False asks one request per category as in the original analysis
+merged_feature_evaluation = False
+
+# Multi-post batching: pack several posts into one request up to a token budget (None disables batching)
+cssrs_batch_token_budget = None
+feature_batch_token_budget = None
+max_batch_size = 10
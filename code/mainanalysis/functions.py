@@ -5,11 +5,86 @@
 # Helper functions
 
 
+import asyncio
+import json
 import config
-from together import Together
+from together import Together, AsyncTogether
 import pandas as pd
+from llm_cache import LLMCache
+from llm_metrics import LLMMetrics, cacheStatus
+from rate_control import RateController, estimateRequestTokens, estimateTokens
+from structured_output import onParsed, parseStructured, parseStructuredAsync, validateStructured
+from tracing import tracer
+
+# Retries are done by the rate controller, which also adapts the number of calls in flight to 429s and errors
+llm_client = Together(max_retries=0)
+llm_cache = LLMCache(config.llm_cache_path, max_bytes=config.llm_cache_max_bytes, enabled=config.llm_cache_enabled)
+rate_controller = RateController(
+    requests_per_minute=config.requests_per_minute,
+    tokens_per_minute=config.tokens_per_minute,
+    initial_concurrency=config.initial_in_flight,
+    max_concurrency=config.max_in_flight,
+    max_retries=config.max_retries,
+)
+# One record per LLM call and per parsed answer in config.llm_metrics_path (see llm_metrics.py)
+llm_metrics = LLMMetrics(config.llm_metrics_path)
+onParsed(llm_metrics.parsed)
+
+
+# Function to send a chat request to the LLM, answered from the local response cache when possible
+# prompt_type: name of the prompt in the call records (not part of the request)
+def chatCompletion(messages, prompt_type="other", **params):
+    key = LLMCache.key(config.modelID, messages, params)
+    output = llm_cache.get(key)
+    with llm_metrics.call(prompt_type, config.modelID, cacheStatus(llm_cache, output)) as record, tracer.span(prompt_type, "llm"):
+        if output is not None:
+            return output
+        completion = rate_controller.call(
+            record.counted(lambda: llm_client.chat.completions.create(model=config.modelID, messages=messages, **params)),
+            estimateRequestTokens(messages, params.get("max_tokens")),
+        )
+        record.completed(completion)
+    output = completion.choices[0].message.content
+    llm_cache.put(key, output)
+    return output
+
+
+# Async version of chatCompletion for the concurrent scoring engine
+async def chatCompletionAsync(async_client, messages, prompt_type="other", **params):
+    key = LLMCache.key(config.modelID, messages, params)
+    # The SQLite cache is read and written in a worker thread, so its disk I/O does not block the other calls
+    output = await asyncio.to_thread(llm_cache.get, key)
+    with llm_metrics.call(prompt_type, config.modelID, cacheStatus(llm_cache, output)) as record, tracer.span(prompt_type, "llm"):
+        if output is not None:
+            return output
+        completion = await rate_controller.callAsync(
+            record.counted(lambda: async_client.chat.completions.create(model=config.modelID, messages=messages, **params)),
+            estimateRequestTokens(messages, params.get("max_tokens")),
+        )
+        record.completed(completion)
+    output = completion.choices[0].message.content
+    await asyncio.to_thread(llm_cache.put, key, output)
+    return output
+
+
+# Function to parse a structured LLM answer of a prompt type (see structured_output.py)
+# Answers that cannot be repaired locally are re-asked once through chatCompletion
+# Returns (value, None) or (None, error message)
+def parseLLMOutput(output, kind):
+    reask = lambda messages: chatCompletion(messages, prompt_type=kind + "_reask")
+    with tracer.span(kind, "parse"):
+        value, error = parseStructured(output, kind, reask=reask)
+    if error is not None:
+        print(f"Invalid {kind} answer: {error}")
+    return value, error
 
-llm_client = Together()
+
+# Async version of parseLLMOutput for the concurrent scoring engine
+async def parseLLMOutputAsync(async_client, output, kind):
+    reask = lambda messages: chatCompletionAsync(async_client, messages, prompt_type=kind + "_reask")
+    with tracer.span(kind, "parse"):
+        value, error = await parseStructuredAsync(output, kind, reask=reask)
+    return value, error
 
 
 
@@ -19,22 +94,8 @@ llm_client = Together()
 # Part 1: Functions to score the Columbia Suicide Risk Assessment questions
 ########################################################################################
 
-# Function to create the Columbia Suicide Risk Assessment questions prompt
-def createCSSRPrompt(text_input):
-    prompt = """
-
-            I will give you a social media post. Please answer the following questions as if you would have posted the post. 
-            **Please ONLY return your answer in JSON format**.
-
-            ----
-            Post begin->:
-            '"""
-    
-    prompt2 = """' 
-    :<-Post end 
-    ----
-            
-            ----
+# Questions of the Columbia Suicide Risk Assessment, shared by the single-post and the batch prompt
+cssrs_questions = """
             Questions:
             1. Wish to be Dead
             Subject endorses thoughts about a wish to be dead or not alive anymore, or wish to fall asleep and not wake up.
@@ -59,7 +120,25 @@ def createCSSRPrompt(text_input):
             (3) A lot 
             (4) All the time 
 
+            """
+
+
+# Function to create the Columbia Suicide Risk Assessment questions prompt
+def createCSSRPrompt(text_input):
+    prompt = """
+
+            I will give you a social media post. Please answer the following questions as if you would have posted the post. 
+            **Please ONLY return your answer in JSON format**.
+
+            ----
+            Post begin->:
+            '"""
+    
+    prompt2 = """' 
+    :<-Post end 
+    ----
             
+            ----""" + cssrs_questions + """
     Please ONLY return your answer in the following JSON format: 
    {"brief_reasoning":"...", "answer1": "...", "answer2": "...","answer3": "...","answer4": "..." ,  "answer5": "...", "frequency": int}
        """
@@ -67,12 +146,32 @@ def createCSSRPrompt(text_input):
     return prompt
 
 
-# Function to get the Answer from the LLM regarding the C-SSRS questions for a given post
-def getLLMAnswerSafeguard(text_input):
-    input_prompt = createCSSRPrompt(text_input=text_input)
-    completion = llm_client.chat.completions.create(
-        model=config.modelID,
-        messages=[
+# Function to create the C-SSRS prompt for several posts at once
+# posts: dict of batch-local ID -> text (the dataset IDs contain the label and are not sent to the LLM)
+def createCSSRBatchPrompt(posts):
+    prompt = """
+
+            I will give you several social media posts, each with an ID. For every post, please answer the following questions as if you would have posted the post. 
+            **Please ONLY return your answer in JSON format**.
+"""
+    for post_id, text_input in posts.items():
+        prompt += f"""
+            ----
+            Post {post_id} begin->:
+            '{text_input}' 
+            :<-Post {post_id} end 
+            ----
+"""
+    prompt += """            ----""" + cssrs_questions + """
+    Please ONLY return your answer in the following JSON format, with one entry for every post ID: 
+   {"<ID>": {"brief_reasoning":"...", "answer1": "...", "answer2": "...","answer3": "...","answer4": "..." ,  "answer5": "...", "frequency": int}, ...}
+       """
+    return prompt
+
+
+# Function to create the chat messages for a C-SSRS prompt
+def createSafeguardMessages(input_prompt):
+    messages = [
         {
             "role": "user",
             "content": input_prompt            
@@ -82,11 +181,122 @@ def getLLMAnswerSafeguard(text_input):
             "content": "Please do reach out for help. However, I can provide a response in the requested format:"
 
         }
+    ]
+    return messages
 
-        ],
+
+# Function to create the chat messages for the C-SSRS questions for a given post
+def createCSSRMessages(text_input):
+    return createSafeguardMessages(createCSSRPrompt(text_input=text_input))
+
+
+# Function to get the Answer from the LLM regarding the C-SSRS questions for a given post
+# Returns the validated answer as JSON string, raises ValueError if no valid answer could be obtained
+def getLLMAnswerSafeguard(text_input):
+    output = chatCompletion(createCSSRMessages(text_input), prompt_type="cssrs")
+    answer, error = parseLLMOutput(output, "cssrs")
+    if error is not None:
+        raise ValueError(f"Invalid C-SSRS answer: {error}")
+    return json.dumps(answer)
+
+
+# Async version of getLLMAnswerSafeguard, used by the concurrent scoring engine
+async def getLLMAnswerSafeguardAsync(async_client, text_input):
+    output = await chatCompletionAsync(async_client, createCSSRMessages(text_input), prompt_type="cssrs")
+    answer, error = await parseLLMOutputAsync(async_client, output, "cssrs")
+    if error is not None:
+        raise ValueError(f"Invalid C-SSRS answer: {error}")
+    return json.dumps(answer)
+
+
+# Function to run an async scoring function over a list of inputs with at most max_in_flight inputs at a time
+# (within that, rate_controller decides how many requests are really sent at once)
+# Returns the outputs in the order of the inputs; failed requests return None and their error message
+# on_result(idx, output, error) is called as soon as each request finishes (e.g. to checkpoint it)
+# timeout applies to the whole input including retries and waiting for the rate limits (None: no limit)
+async def runConcurrently(score_function, inputs, max_in_flight, timeout, on_result=None):
+    outputs = [None] * len(inputs)
+    errors = [None] * len(inputs)
+    queue = asyncio.Queue()
+    for idx, item in enumerate(inputs):
+        queue.put_nowait((idx, item))
+    done = 0
+
+    async def worker():
+        nonlocal done
+        while not queue.empty():
+            idx, item = queue.get_nowait()
+            with tracer.span("input", idx=idx):
+                try:
+                    outputs[idx] = await asyncio.wait_for(score_function(item), timeout=timeout)
+                except asyncio.TimeoutError:
+                    errors[idx] = f"Timeout after {timeout}s"
+                except Exception as e:
+                    errors[idx] = str(e)
+            if on_result is not None:
+                on_result(idx, outputs[idx], errors[idx])
+            done += 1
+            if done % 100 == 0:
+                print(f"{done}/{len(inputs)} requests done")
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(max_in_flight, len(inputs)))]
+    await asyncio.gather(*workers)
+    return outputs, errors
+
+
+# Function to score the C-SSRS questions for batches of posts concurrently
+# Every batch is one request; posts missing from a batch answer or with an incomplete answer are scored alone
+async def runCSSRSBatches(async_client, text_inputs, max_in_flight, timeout, on_result, token_budget, max_batch_size):
+    outputs = [None] * len(text_inputs)
+    errors = [None] * len(text_inputs)
+    retry = []
+    batches = packBatches(text_inputs, token_budget, estimateTokens(createCSSRBatchPrompt({})), max_batch_size)
+    print(f"{len(text_inputs)} posts packed into {len(batches)} batches")
+
+    def collectBatch(batch_idx, output, request_error):
+        with tracer.span("cssrs_batch", "parse"):
+            answers, _ = parseStructured(output, "cssrs_batch") if request_error is None else (None, None)
+        for k, idx in enumerate(batches[batch_idx]):
+            answer, error = validateStructured(answers.get(f"P{k+1}") if answers else None, "cssrs")
+            if error is not None:
+                retry.append(idx)
+                continue
+            outputs[idx] = json.dumps(answer)
+            if on_result is not None:
+                on_result(idx, outputs[idx], None)
+
+    def collectRetry(retry_idx, output, request_error):
+        idx = retry[retry_idx]
+        outputs[idx] = output
+        errors[idx] = request_error
+        if on_result is not None:
+            on_result(idx, output, request_error)
+
+    batch_function = lambda batch: chatCompletionAsync(
+        async_client, createSafeguardMessages(createCSSRBatchPrompt({f"P{k+1}": text_inputs[idx] for k, idx in enumerate(batch)})),
+        prompt_type="cssrs_batch",
     )
-    output = completion.choices[0].message.content
-    return output
+    await runConcurrently(batch_function, batches, max_in_flight, timeout, collectBatch)
+
+    print(f"{len(retry)} posts missing from the batch answers, scoring them alone")
+    retry_function = lambda text_input: getLLMAnswerSafeguardAsync(async_client, text_input)
+    await runConcurrently(retry_function, [text_inputs[idx] for idx in retry], max_in_flight, timeout, collectRetry)
+    return outputs, errors
+
+
+# Function to score the C-SSRS questions for many posts concurrently
+# With a batch_token_budget, several posts are packed into one request (see runCSSRSBatches)
+# timeout applies to every single request; retries of throttled and timed out requests are left to rate_controller
+def scoreCSSRSConcurrently(text_inputs, max_in_flight=config.max_in_flight, timeout=config.request_timeout, on_result=None,
+                           batch_token_budget=None, max_batch_size=config.max_batch_size):
+    text_inputs = list(text_inputs)
+    async def run():
+        async with AsyncTogether(timeout=timeout, max_retries=0) as async_client:
+            if batch_token_budget:
+                return await runCSSRSBatches(async_client, text_inputs, max_in_flight, None, on_result, batch_token_budget, max_batch_size)
+            score_function = lambda text_input: getLLMAnswerSafeguardAsync(async_client, text_input)
+            return await runConcurrently(score_function, text_inputs, max_in_flight, None, on_result)
+    return asyncio.run(run())
 
 
 
@@ -130,8 +340,8 @@ def getCategoriesSafeguard(post1, post2):
     """
     combined_prompt = prompt1 + prompt2
 
-    completion = llm_client.chat.completions.create(
-        model=config.modelID,
+    output = chatCompletion(
+        prompt_type="category_diffs",
         messages=[
         {
             "role": "user",
@@ -144,12 +354,11 @@ def getCategoriesSafeguard(post1, post2):
         }
         ],
     )
-    output = completion.choices[0].message.content
     return output
 
 
-# Function to identify specific features for a given category
-def getLLMFeatures(category_name, example_posts):
+# Function to create the messages to identify specific features for a given category
+def createFeaturesMessages(category_name, example_posts):
 
     prompt1 = f"""
     You are supposed to define measurable features that can later be used to analyze '{category_name}' in a given text.
@@ -180,10 +389,7 @@ def getLLMFeatures(category_name, example_posts):
     """
     combined_prompt = prompt1 + prompt2
 
-    completion = llm_client.chat.completions.create(
-        model=config.modelID,
-        max_tokens=5000,
-        messages=[
+    return [
         {
             "role": "user",
             "content": combined_prompt            
@@ -193,17 +399,69 @@ def getLLMFeatures(category_name, example_posts):
         #     "content": "Please do reach out for help. However, I can provide a response in the requested format:"
 
         # }
-        ], 
-    
-    )
-    output = completion.choices[0].message.content
-    return output
+        ]
+
+
+# Function to get the feature definitions of a category from the example comparisons
+def getLLMFeatures(category_name, example_posts):
+    return chatCompletion(createFeaturesMessages(category_name, example_posts), prompt_type="feature_definitions", max_tokens=5000)
+
+
+# Function to get the feature definitions of several categories concurrently
+# examples: list of (category_name, example_posts); returns the outputs and errors in the same order
+def getLLMFeaturesConcurrently(examples, max_in_flight=config.max_in_flight, timeout=config.request_timeout):
+    async def run():
+        async with AsyncTogether(timeout=timeout, max_retries=0) as async_client:
+            feature_function = lambda example: chatCompletionAsync(
+                async_client, createFeaturesMessages(*example), prompt_type="feature_definitions", max_tokens=5000)
+            return await runConcurrently(feature_function, examples, max_in_flight, None)
+    return asyncio.run(run())
+
+
+# Function to pack the example comparisons (Post 1, Post 2) of a category into the prompt within a token budget
+# Duplicate pairs are dropped, the others are added from the least similar to the pairs already packed (Jaccard
+# similarity of their words), pairs that do not fit are skipped (token_budget None: all pairs as they are)
+# Returns the example text (pairs in their original order) and the number of pairs and tokens before and after packing
+def packExamplePosts(pairs, token_budget=None):
+    formatPair = lambda post1, post2: post1 + "\n" + "------\n" + post2 + "\n" + "------\n"
+    pairs = list(pairs)
+    if token_budget is None:
+        tokens = sum(estimateTokens(formatPair(*pair)) for pair in pairs)
+        return "".join(formatPair(*pair) for pair in pairs), {"pairs": len(pairs), "packed_pairs": len(pairs), "tokens": tokens, "packed_tokens": tokens}
+    unique = {}
+    for post1, post2 in pairs:
+        unique.setdefault((" ".join(post1.lower().split()), " ".join(post2.lower().split())), (post1, post2))
+    candidates = list(unique.values())
+    words = [set((post1 + " " + post2).lower().split()) for post1, post2 in candidates]
+    tokens = [estimateTokens(formatPair(*pair)) for pair in candidates]
+
+    # Highest similarity of every remaining pair to the packed pairs
+    closest = [0.0] * len(candidates)
+    remaining = list(range(len(candidates)))
+    packed = []
+    used = 0
+    while remaining:
+        idx = min(remaining, key=lambda i: (closest[i], i))
+        remaining.remove(idx)
+        if token_budget is not None and used + tokens[idx] > token_budget:
+            continue
+        packed.append(idx)
+        used += tokens[idx]
+        for i in remaining:
+            closest[i] = max(closest[i], len(words[i] & words[idx]) / (len(words[i] | words[idx]) or 1))
+
+    example_posts = "".join(formatPair(*candidates[idx]) for idx in sorted(packed))
+    stats = {"pairs": len(pairs), "packed_pairs": len(packed),
+             "tokens": sum(estimateTokens(formatPair(*pair)) for pair in pairs), "packed_tokens": used}
+    return example_posts, stats
+
+
 
 
 # Function to Filter for redundant categories
 def identifyRedundantCategories(text_input):
-    completion = llm_client.chat.completions.create(
-        model=config.modelID,
+    output = chatCompletion(
+        prompt_type="redundant_categories",
         messages=[
         {
             "role": "user",
@@ -223,7 +481,6 @@ def identifyRedundantCategories(text_input):
         } 
         ],
     )
-    output = completion.choices[0].message.content
     return output
 
 
@@ -260,8 +517,159 @@ def evaluateFeatures(text_input, features):
     """
     combined_prompt = prompt1 + prompt2
 
-    completion = llm_client.chat.completions.create(
-        model=config.modelID,
+    output = chatCompletion(
+        prompt_type="feature_ratings",
+        messages=[
+        {
+            "role": "user",
+            "content": combined_prompt            
+        },
+        {
+            "role": "assistant",
+            "content": "Please do reach out for help. However, I can provide a response in the requested format:"
+
+        }
+        ],
+    )
+    return output
+
+
+# Function to evaluate the features of all categories for a given text in a single request
+def evaluateFeaturesMerged(text_input, features_strings_dict):
+    feature_blocks = ""
+    for category, features in features_strings_dict.items():
+        feature_blocks += f"Category: {category}\n{features}\n"
+
+    prompt1 = f"""
+    You are supposed to evaluate the features for the given text.
+    The features are grouped into categories, please rate every feature of every category.
+    Text: {text_input}
+
+
+
+    Features: 
+    
+    {feature_blocks}
+
+    Please return your answer in JSON format with one entry per category, for example:
+    """
+    prompt2 = """
+    {
+    "<category>": [
+        {
+            "featureid": "...",
+            "rating": int
+        },
+        ...
+    ],
+    ...
+    }
+    """
+    combined_prompt = prompt1 + prompt2
+
+    output = chatCompletion(
+        prompt_type="category_ratings",
+        messages=[
+        {
+            "role": "user",
+            "content": combined_prompt            
+        },
+        {
+            "role": "assistant",
+            "content": "Please do reach out for help. However, I can provide a response in the requested format:"
+
+        }
+        ],
+    )
+    return output
+
+
+# Function to split the answer of evaluateFeaturesMerged into the ratings per category
+# Categories that are missing from the answer or whose ratings are not a valid list are left out
+def parseMergedEvaluation(output, categories):
+    with tracer.span("category_ratings", "parse"):
+        loaded, error = parseStructured(output, "category_ratings")
+    if error is not None:
+        print(f"Merged evaluation could not be parsed: {error}")
+        return {}
+
+    # Match the categories regardless of case and spacing used by the LLM
+    answers = {str(key).lower().replace(" ", ""): value for key, value in loaded.items()}
+    parsed = {}
+    for category in categories:
+        feat, error = validateStructured(answers.get(category.lower().replace(" ", "")), "feature_ratings")
+        if error is None:
+            parsed[category] = feat
+    return parsed
+
+
+# Function to evaluate the features of all categories for a given text
+# In merged mode all categories are sent in one request and only the categories missing
+# from the answer are asked again one by one; otherwise every category is its own request
+# Returns the ratings per category and the number of LLM calls that were made
+def evaluateAllCategories(text_input, features_strings_dict, merged=True):
+    feature_evaluation_dict = {}
+    calls = 0
+    if merged:
+        output = evaluateFeaturesMerged(text_input, features_strings_dict)
+        calls += 1
+        feature_evaluation_dict = parseMergedEvaluation(output, features_strings_dict.keys())
+
+    # Evaluate the (remaining) categories individually
+    for category, feat_string in features_strings_dict.items():
+        if category in feature_evaluation_dict:
+            continue
+        output = evaluateFeatures(text_input, feat_string)
+        calls += 1
+        feat, error = parseLLMOutput(output, "feature_ratings")
+        if error is None:
+            feature_evaluation_dict[category] = feat
+        else:
+            print(f"Error in category {category}")
+    return feature_evaluation_dict, calls
+
+
+# Function to create the feature evaluation prompt for several texts at once
+# posts: dict of batch-local ID -> text
+def createFeaturesBatchPrompt(posts, features):
+    texts = ""
+    for post_id, text_input in posts.items():
+        texts += f"Text {post_id} begin->:\n{text_input}\n:<-Text {post_id} end\n\n"
+
+    prompt1 = f"""
+    You are supposed to evaluate the features for each of the given texts.
+    Every text has an ID.
+
+    {texts}
+
+    Features: 
+    
+    {features}
+
+    Please return your answer in JSON format with one entry for every text ID, for example:
+    """
+    prompt2 = """
+    {
+    "<ID>": [
+        {
+            "featureid": "...",
+            "rating": int
+        },
+        ...
+    ],
+    ...
+    }
+    """
+    combined_prompt = prompt1 + prompt2
+    return combined_prompt
+
+
+# Function to evaluate the features of one category for several texts at once
+def evaluateFeaturesBatch(posts, features):
+    combined_prompt = createFeaturesBatchPrompt(posts, features)
+
+    output = chatCompletion(
+        prompt_type="feature_ratings_batch",
         messages=[
         {
             "role": "user",
@@ -274,10 +682,35 @@ def evaluateFeatures(text_input, features):
         }
         ],
     )
-    output = completion.choices[0].message.content
     return output
 
 
+# Function to evaluate the features of one category for many texts in batches that stay within a token budget
+# Texts missing from a batch answer or with invalid ratings are evaluated alone with evaluateFeatures
+# Returns the ratings in the order of the texts (None if even the single request failed) and the number of LLM calls
+def evaluateFeaturesBatched(text_inputs, features, token_budget, max_batch_size=config.max_batch_size):
+    ratings = [None] * len(text_inputs)
+    calls = 0
+    retry = []
+    for batch in packBatches(text_inputs, token_budget, estimateTokens(createFeaturesBatchPrompt({}, features)), max_batch_size):
+        output = evaluateFeaturesBatch({f"P{k+1}": text_inputs[idx] for k, idx in enumerate(batch)}, features)
+        calls += 1
+        with tracer.span("category_ratings", "parse"):
+            answers, _ = parseStructured(output, "category_ratings")
+        for k, idx in enumerate(batch):
+            feat, error = validateStructured((answers or {}).get(f"P{k+1}"), "feature_ratings")
+            if error is None:
+                ratings[idx] = feat
+            else:
+                retry.append(idx)
+
+    for idx in retry:
+        output = evaluateFeatures(text_inputs[idx], features)
+        calls += 1
+        ratings[idx], _ = parseLLMOutput(output, "feature_ratings")
+    return ratings, calls
+
+
 
 
 
@@ -300,10 +733,21 @@ def getFeaturesAsString(feature_df):
     return features_string
 
 
-# Function to clean the string output from the LLM in case the JSON format is not correct (e.g., with additional text)
-def clean_string(string_input):
-    first_bracket_index = string_input.find('[')
-    last_bracket_index = string_input.rfind(']')
-    return string_input[first_bracket_index:last_bracket_index+1]
-
-
+# Function to pack texts into batches of indices that stay within a token budget
+# fixed_tokens: tokens of the prompt without any text (instructions, questions, feature definitions)
+def packBatches(text_inputs, token_budget, fixed_tokens, max_batch_size):
+    batches = []
+    batch = []
+    used = fixed_tokens
+    for idx, text_input in enumerate(text_inputs):
+        # Add a few tokens for the ID and delimiters around every text
+        tokens = estimateTokens(text_input) + 20
+        if batch and (used + tokens > token_budget or len(batch) >= max_batch_size):
+            batches.append(batch)
+            batch = []
+            used = fixed_tokens
+        batch.append(idx)
+        used += tokens
+    if batch:
+        batches.append(batch)
+    return batches
@@ -0,0 +1,130 @@
+# llm_cache.py
+# Persistent, content-addressed cache for LLM responses (SQLite file on disk).
+# Responses are keyed on a hash of the model id, the chat messages and the sampling parameters,
+# so a rerun of the pipeline or a repeated submission in the web tool is answered locally.
+# The same file is used by mainanalysis/ and demo_application/ (each folder keeps its own copy,
+# since the demo is built with its own folder as Docker context) - keep both copies in sync.
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Number of least recently used responses read at a time when the cache is above its size cap
+evict_batch = 64
+
+
+class LLMCache:
+    # path: SQLite file, max_bytes: size cap on the stored responses (least recently used are evicted first)
+    # enabled: bypass switch, when False every lookup is a miss and nothing is stored
+    def __init__(self, path, max_bytes=512 * 1024 * 1024, enabled=True):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    # Open the database lazily, so importing a module with a cache never touches the disk
+    def _connection(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+            # Running size and number of the responses, kept up to date by triggers (also for other processes sharing
+            # the file), so a write does not sum the whole table. A cache created without it is summed once.
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_size ("
+                "id INTEGER PRIMARY KEY CHECK (id = 1), bytes INTEGER NOT NULL, entries INTEGER NOT NULL)"
+            )
+            self._conn.execute("INSERT OR IGNORE INTO cache_size SELECT 1, COALESCE(SUM(size), 0), COUNT(*) FROM responses")
+            self._conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS responses_insert AFTER INSERT ON responses BEGIN "
+                "UPDATE cache_size SET bytes = bytes + NEW.size, entries = entries + 1; END"
+            )
+            self._conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS responses_update AFTER UPDATE OF size ON responses BEGIN "
+                "UPDATE cache_size SET bytes = bytes + NEW.size - OLD.size; END"
+            )
+            self._conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS responses_delete AFTER DELETE ON responses BEGIN "
+                "UPDATE cache_size SET bytes = bytes - OLD.size, entries = entries - 1; END"
+            )
+            self._conn.commit()
+        return self._conn
+
+    # Function to create the cache key for a request
+    @staticmethod
+    def key(model, messages, params):
+        payload = json.dumps({"model": model, "messages": messages, "params": params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    # Function to look up a response, returns None on a miss
+    def get(self, key):
+        if not self.enabled:
+            self.misses += 1
+            return None
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+            self.hits += 1
+            return row[0]
+
+    # Function to store a response and evict the least recently used ones above the size cap
+    def put(self, key, response):
+        if not self.enabled or response is None:
+            return
+        size = len(response.encode("utf-8"))
+        with self._lock:
+            conn = self._connection()
+            # An upsert instead of INSERT OR REPLACE, whose implicit delete would not fire the size trigger
+            conn.execute(
+                "INSERT INTO responses (key, response, size, last_used) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET response = excluded.response, size = excluded.size, last_used = excluded.last_used",
+                (key, response, size, time.time()),
+            )
+            total = conn.execute("SELECT bytes FROM cache_size").fetchone()[0]
+            while total > self.max_bytes:
+                rows = conn.execute("SELECT key, size FROM responses ORDER BY last_used ASC LIMIT ?", (evict_batch,)).fetchall()
+                if not rows:
+                    break
+                evict = []
+                for old_key, old_size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    evict.append((old_key,))
+                    total -= old_size
+                conn.executemany("DELETE FROM responses WHERE key = ?", evict)
+            conn.commit()
+
+    # Function to summarize the cache usage
+    def stats(self):
+        entries, size = 0, 0
+        if self.enabled:
+            with self._lock:
+                entries, size = self._connection().execute("SELECT entries, bytes FROM cache_size").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "entries": entries,
+            "bytes": size,
+        }
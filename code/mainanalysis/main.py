@@ -1,3 +1,5 @@
+import argparse
+import atexit
 import os
 import json
 import pandas as pd
@@ -6,66 +8,268 @@ from datetime import datetime
 
 # Importing configuration and functions
 import config
-from functions import createCSSRPrompt, getLLMAnswerSafeguard, getLLMFeatures, getFeaturesAsString, clean_string
-
-
-# Load data path from config
-train_data_path = config.train_data_path
-
-# Load data and add unique identifier for each post, downsample 
-train_dataset = pd.read_json(train_data_path, lines=True)
-train_dataset["ID"] = "ID" + train_dataset.index.astype(str) +"_"+ train_dataset["label"]
-train_dataset = train_dataset.sample(10000)
-train_dataset.to_csv(os.path.join(config.output_path, "dataset_train_10k.csv"))
+import functions
+from category_groups import groupCategories, groupCounts, findGroup
+from checkpoint import appendCheckpoint
+from near_duplicates import shingles, MinHashIndex, findNearDuplicates
+from rating_store import RatingMatrix
+from sharding import shardOf, shardSuffix, stageLogPath, loadStageCheckpoint, clearStageLogs, markShardDone, readShardDone, shardProgress, runLocalWorkers, workerCommand
+from stage_runner import StageRunner, StageIncomplete
+from utils import loadSampledDataset
+from structured_output import parseOnce, parseStats
+from tracing import tracer
+from functions import createCSSRPrompt, createCSSRBatchPrompt, createSafeguardMessages, scoreCSSRSConcurrently, getCategoriesSafeguard, createFeaturesMessages, getLLMFeaturesConcurrently, packExamplePosts, identifyRedundantCategories, getFeaturesAsString, parseLLMOutput, evaluateFeatures, evaluateFeaturesMerged, createFeaturesBatchPrompt, evaluateAllCategories, evaluateFeaturesBatched, llm_cache, llm_metrics
+
+
+# Stages that can be split into shards of posts (by a hash of the post ID)
+sharded_stages = ["cssrs_ratings", "feature_evaluation"]
+
+
+# Function to parse the shard of a worker, e.g. "0/4" (shards are numbered from 0)
+def parseShard(value):
+    index, num_shards = (int(part) for part in value.split("/"))
+    if not 0 <= index < num_shards:
+        raise argparse.ArgumentTypeError(f"invalid shard {value}")
+    return index, num_shards
+
+
+# Stages to run: by default all of them, stages whose inputs, parameters and prompts did not change are restored from the cache
+parser = argparse.ArgumentParser(description="LLM interaction analysis workflow")
+parser.add_argument("targets", nargs="*", help="stages to run, together with the stages they depend on (default: all)")
+parser.add_argument("--force", nargs="+", default=[], help="stages to run even if their outputs are cached")
+parser.add_argument("--shards", type=int, help="split cssrs_ratings and feature_evaluation into N shards, run as local worker processes and merged")
+parser.add_argument("--merge", action="store_true", help="with --shards: do not start workers, merge the shards if all are finished, else print their progress")
+parser.add_argument("--shard", type=parseShard, metavar="I/N", help="worker: score shard I of N of the target stage (e.g. on another host sharing the output folder)")
+args = parser.parse_args()
+if args.shard is not None and (len(args.targets) != 1 or args.targets[0] not in sharded_stages):
+    parser.error(f"--shard needs one target stage out of {', '.join(sharded_stages)}")
+if args.merge and args.shards is None:
+    parser.error("--merge needs --shards")
+
+# Workers write their own trace and LLM call log
+if args.shard is not None:
+    if config.trace_path is not None:
+        config.trace_path = shardSuffix(config.trace_path, *args.shard)
+    if llm_metrics.log_path is not None:
+        llm_metrics.log_path = shardSuffix(llm_metrics.log_path, *args.shard)
+
+# Trace the stages of the pipeline, the trace is also written when the run stops early
+if config.trace_path is not None:
+    tracer.enable(config.profile_stages, config.profile_path)
+    atexit.register(tracer.save, config.trace_path)
+
+# The outputs of every stage are cached in config.stage_cache_path, keyed by its inputs, parameters and prompts
+# A worker always runs its stage: restoring it from the cache would neither score its shard nor mark it as done
+runner = StageRunner(config.output_path, config.stage_cache_path, force=args.force + (args.targets if args.shard is not None else []))
+
+
+# Function to score the posts of a stage that are not in its checkpoint logs yet
+# The logs are specific to the cache key of the stage, so a changed prompt or model does not resume from the answers of the old one
+# score(pending, log_file) scores the pending posts, appends their records to log_file and returns the failed posts {ID: error}
+# Returns the records of all logged posts and the failed posts, by ID
+def runShardedStage(stage, dataset, score):
+    key = runner.key(stage)
+
+    # Worker: score the posts of its shard, the run stops after the stage (the merge builds the outputs)
+    if args.shard is not None:
+        index, num_shards = args.shard
+        log_file = stageLogPath(config.checkpoint_path, stage, key, index, num_shards)
+        finished = loadStageCheckpoint(config.checkpoint_path, stage, key)
+        pending = dataset[[shardOf(post_id, num_shards) == index and post_id not in finished for post_id in dataset["ID"]]]
+        print(f"{stage}: shard {index}/{num_shards}, {len(pending)} posts to go")
+        errors = score(pending, log_file)
+        markShardDone(log_file, len(pending), errors)
+        raise StageIncomplete(f"shard {index}/{num_shards} finished, {len(errors)} posts failed")
+
+    # Sharded: run the workers locally (unless merging shards run elsewhere), merge once every shard is finished
+    # Sharded runs always resume, finished posts of a failed or repeated shard are not scored again
+    if args.shards is not None:
+        post_ids = dataset["ID"].tolist()
+        printProgress = lambda: print(shardProgress(config.checkpoint_path, stage, key, post_ids, args.shards).to_string())
+        if not args.merge:
+            failed = runLocalWorkers(lambda index: workerCommand(stage, index, args.shards),
+                                     stageLogPath(config.checkpoint_path, stage, key), args.shards,
+                                     retries=config.shard_retries, poll_seconds=config.shard_poll_seconds, on_poll=printProgress)
+            if failed:
+                print(f"{stage}: shards {failed} failed, see their .log files in {config.checkpoint_path}")
+        printProgress()
+        errors = {}
+        for index in range(args.shards):
+            done = readShardDone(stageLogPath(config.checkpoint_path, stage, key, index, args.shards))
+            if done is None:
+                raise StageIncomplete(f"shard {index}/{args.shards} is not finished, merge again when it is")
+            errors.update(done["errors"])
+        return loadStageCheckpoint(config.checkpoint_path, stage, key), errors
+
+    # Single process, skipping posts finished in an interrupted run (the logs are removed first when not resuming)
+    if not config.resume:
+        clearStageLogs(config.checkpoint_path, stage, key)
+    finished = loadStageCheckpoint(config.checkpoint_path, stage, key)
+    pending = dataset[~dataset["ID"].isin(finished.keys())]
+    print(f"{stage}: {len(finished)} posts already finished, {len(pending)} to go")
+    errors = score(pending, stageLogPath(config.checkpoint_path, stage, key))
+    return loadStageCheckpoint(config.checkpoint_path, stage, key), errors
+
+
+# Load data and add unique identifier for each post, downsample
+@runner.stage("train_sample", inputs=[config.train_data_path], outputs=["dataset_train_10k.csv"],
+              params={"sample_size": config.sample_size, "seed": config.seed, "stratify_by": config.stratify_by},
+              code=[loadSampledDataset])
+def sampleTrainDataset():
+    # Stream the JSONL file and keep a seeded reservoir sample, so the full corpus is never held in memory
+    train_dataset = loadSampledDataset(config.train_data_path, config.sample_size, seed=config.seed, stratify=config.stratify_by)
+    train_dataset.to_csv(os.path.join(config.output_path, "dataset_train_10k.csv"))
+
+
+# Function to get the post whose results a post takes: the post it is a near-duplicate of, or the post itself
+def sourceIDs(dataset):
+    if "duplicate_of" not in dataset:
+        return dataset["ID"]
+    return dataset["duplicate_of"].fillna(dataset["ID"])
+
+
+# Function to print how many LLM calls the near-duplicates of a dataset save (one call per group instead of per post)
+def printNearDuplicateStats(name, dataset):
+    groups = sourceIDs(dataset).nunique()
+    print(f"{name}: {len(dataset)} posts in {groups} near-duplicate groups, {len(dataset) - groups} LLM calls saved")
+
+
+# Find near-duplicate posts in the sample (reposts, cross-posts), only the first post of each group is scored
+if config.near_duplicate_threshold is not None:
+    @runner.stage("near_duplicates", inputs=["dataset_train_10k.csv"], outputs=["near_duplicates.csv"],
+                  params={"near_duplicate_threshold": config.near_duplicate_threshold},
+                  code=[shingles, MinHashIndex])
+    def findDuplicatePosts():
+        train_dataset = pd.read_csv(os.path.join(config.output_path, "dataset_train_10k.csv"), index_col=0)
+        near_duplicates = pd.DataFrame({"ID": train_dataset["ID"],
+                                        "duplicate_of": findNearDuplicates(train_dataset["ID"], train_dataset["text"].fillna(""), config.near_duplicate_threshold)})
+        near_duplicates.to_csv(os.path.join(config.output_path, "near_duplicates.csv"))
+        printNearDuplicateStats("dataset_train_10k", near_duplicates)
 
 
 ########################################################################################
 # Part 1: Evaluate C-SSRS questions
 ########################################################################################
 
-# Loop through the dataset and evaluate the CSSRS questions
-train_dataset["output"] = None
-train_dataset["CSSRS_1"] = None
-train_dataset["CSSRS_2"] = None
-train_dataset["CSSRS_3"] = None
-train_dataset["CSSRS_4"] = None
-train_dataset["CSSRS_5"] = None
-train_dataset["CSSRS_freq"] = None
-train_dataset["brief_reasoning"] = None
-train_dataset["error"] = None
-count = 0
-
-for i, row in train_dataset.iterrows():
-    print(count, i)
-    count += 1
-    text_input = row["text"]
-    label = row["label"]
-    output = getLLMAnswerSafeguard(text_input)
-    train_dataset.at[i, "output"] = output
-
-    try:
-        output = json.loads(output)
-        train_dataset.at[i, "brief_reasoning"] = output["brief_reasoning"]
-        train_dataset.at[i, "CSSRS_1"] = output["answer1"]
-        train_dataset.at[i, "CSSRS_2"] = output["answer2"]
-        train_dataset.at[i, "CSSRS_3"] = output["answer3"]
-        train_dataset.at[i, "CSSRS_4"] = output["answer4"]
-        train_dataset.at[i, "CSSRS_5"] = output["answer5"]
-        train_dataset.at[i, "CSSRS_freq"] = output["frequency"]
-    except Exception as e: 
-        print(i)
-        print(str(e))
-        print(output)
-        train_dataset.at[i, "error"] = str(e)
-
-# Add column to indicate if any of the CSSRS questions is "Yes"
-train_dataset["CSSRS_any"] = train_dataset[["CSSRS_1", "CSSRS_2", "CSSRS_3", "CSSRS_4", "CSSRS_5"]].apply(lambda x: 1 if "Yes" in x.values else 0, axis=1)
-train_dataset.to_csv(os.path.join(config.output_path, "dataset_train_10k_CSSRS_ratings.csv"))
-
-# Filter for posts with suicidal ideation, save dataset
-si_dataset = train_dataset[train_dataset["CSSRS_any"] ==1]
-si_dataset = si_dataset.reset_index(drop=True)
-si_dataset.to_csv(os.path.join(config.output_path, "si_dataset_v1.csv"))
+# Optional cascade: a local classifier trained on earlier C-SSRS ratings answers the clear negatives
+if config.prefilter_training_path is not None:
+    from prefilter import createPrefilter, trainPrefilter
+
+    @runner.stage("cssrs_prefilter", inputs=["dataset_train_10k.csv", config.prefilter_training_path], outputs=["cssrs_prefilter.csv", "cssrs_prefilter_report.json"],
+                  params={"prefilter_recall": config.prefilter_recall, "prefilter_holdout": config.prefilter_holdout, "seed": config.seed},
+                  code=[createPrefilter, trainPrefilter])
+    def prefilterCSSRS():
+        # Train on the posts that were scored without errors, CSSRS_any is the label
+        rated = pd.read_csv(config.prefilter_training_path, index_col=0)
+        rated = rated[rated["error"].isna()]
+        prefilter, threshold, report = trainPrefilter(rated["text"].fillna("").tolist(), rated["CSSRS_any"].tolist(), config.prefilter_recall,
+                                                      holdout=config.prefilter_holdout, seed=config.seed)
+
+        # Posts of this sample below the threshold are answered locally
+        train_dataset = pd.read_csv(os.path.join(config.output_path, "dataset_train_10k.csv"), index_col=0)
+        probabilities = prefilter.predict_proba(train_dataset["text"].fillna("").tolist())[:, 1]
+        prefiltered = pd.DataFrame({"ID": train_dataset["ID"], "probability": probabilities, "local_negative": probabilities < threshold})
+        prefiltered.to_csv(os.path.join(config.output_path, "cssrs_prefilter.csv"))
+        report["sample"] = {"posts": len(prefiltered), "llm_calls_saved": int(prefiltered["local_negative"].sum())}
+        with open(os.path.join(config.output_path, "cssrs_prefilter_report.json"), "w") as f:
+            json.dump(report, f, indent=1)
+        print("C-SSRS pre-filter:")
+        print(json.dumps(report, indent=1))
+
+
+@runner.stage("cssrs_ratings", inputs=["dataset_train_10k.csv"] + (["cssrs_prefilter.csv"] if config.prefilter_training_path is not None else [])
+              + (["near_duplicates.csv"] if config.near_duplicate_threshold is not None else []), outputs=["dataset_train_10k_CSSRS_ratings.csv", "si_dataset_v1.csv"],
+              params={"modelID": config.modelID, "cssrs_batch_token_budget": config.cssrs_batch_token_budget, "max_batch_size": config.max_batch_size},
+              code=[functions.cssrs_questions, createCSSRPrompt, createCSSRBatchPrompt, createSafeguardMessages])
+def scoreCSSRS():
+    train_dataset = pd.read_csv(os.path.join(config.output_path, "dataset_train_10k.csv"), index_col=0)
+
+    # Loop through the dataset and evaluate the CSSRS questions
+    train_dataset["output"] = None
+    train_dataset["CSSRS_1"] = None
+    train_dataset["CSSRS_2"] = None
+    train_dataset["CSSRS_3"] = None
+    train_dataset["CSSRS_4"] = None
+    train_dataset["CSSRS_5"] = None
+    train_dataset["CSSRS_freq"] = None
+    train_dataset["brief_reasoning"] = None
+    train_dataset["error"] = None
+
+    # Near-duplicates take the answer of the post they duplicate
+    if config.near_duplicate_threshold is not None:
+        near_duplicates = pd.read_csv(os.path.join(config.output_path, "near_duplicates.csv"), index_col=0)
+        train_dataset["duplicate_of"] = train_dataset["ID"].map(dict(zip(near_duplicates["ID"], near_duplicates["duplicate_of"])))
+        printNearDuplicateStats("C-SSRS", train_dataset)
+    source_ids = sourceIDs(train_dataset)
+
+    # Score the pending posts concurrently (config.max_in_flight requests at a time)
+    # (with config.cssrs_batch_token_budget, several posts share one request)
+    def scorePosts(pending, log_file):
+        pending_ids = pending["ID"].tolist()
+
+        # Write every successful answer to the checkpoint log as soon as it arrives
+        def checkpointCSSRS(idx, output, request_error):
+            if request_error is None:
+                appendCheckpoint(log_file, {"ID": pending_ids[idx], "output": output})
+
+        outputs, errors = scoreCSSRSConcurrently(pending["text"].tolist(), on_result=checkpointCSSRS, batch_token_budget=config.cssrs_batch_token_budget)
+        return {post_id: request_error for post_id, request_error in zip(pending_ids, errors) if request_error is not None}
+
+    # Posts the pre-filter rates as clear negatives are answered locally, only the others are sent to the LLM
+    local_negatives = set()
+    if config.prefilter_training_path is not None:
+        prefiltered = pd.read_csv(os.path.join(config.output_path, "cssrs_prefilter.csv"), index_col=0)
+        local_negatives = set(prefiltered.loc[prefiltered["local_negative"], "ID"])
+        train_dataset["cssrs_source"] = "llm"
+        print(f"C-SSRS pre-filter: {len(local_negatives)} of {len(train_dataset)} posts answered locally")
+
+    # Skip posts that were already scored in an interrupted run (or in another shard)
+    tracer.begin("cssrs_scoring")
+    to_score = (source_ids == train_dataset["ID"]) & ~train_dataset["ID"].isin(local_negatives)
+    finished, request_errors = runShardedStage("cssrs_ratings", train_dataset[to_score], scorePosts)
+    tracer.end()
+
+    # Collect the answers of all posts from the logs, failed requests are kept as errors
+    tracer.begin("cssrs_assembly")
+    for i, source_id in zip(train_dataset.index, source_ids):
+        if source_id in local_negatives:
+            train_dataset.loc[i, ["CSSRS_1", "CSSRS_2", "CSSRS_3", "CSSRS_4", "CSSRS_5"]] = "No"
+            train_dataset.at[i, "cssrs_source"] = "prefilter"
+            continue
+        if source_id not in finished:
+            request_error = request_errors.get(source_id, "Not scored")
+            print(i)
+            print(request_error)
+            train_dataset.at[i, "error"] = request_error
+            continue
+        output = finished[source_id]["output"]
+        train_dataset.at[i, "output"] = output
+
+        # The logged answers were validated when they were scored (logs of older runs are repaired here)
+        answer, _, parse_error = parseOnce(output, "cssrs")
+        if parse_error is not None:
+            print(i)
+            print(parse_error)
+            print(output)
+            train_dataset.at[i, "error"] = parse_error
+            continue
+        train_dataset.at[i, "brief_reasoning"] = answer["brief_reasoning"]
+        train_dataset.at[i, "CSSRS_1"] = answer["answer1"]
+        train_dataset.at[i, "CSSRS_2"] = answer["answer2"]
+        train_dataset.at[i, "CSSRS_3"] = answer["answer3"]
+        train_dataset.at[i, "CSSRS_4"] = answer["answer4"]
+        train_dataset.at[i, "CSSRS_5"] = answer["answer5"]
+        train_dataset.at[i, "CSSRS_freq"] = answer["frequency"]
+
+    # Add column to indicate if any of the CSSRS questions is "Yes"
+    train_dataset["CSSRS_any"] = train_dataset[["CSSRS_1", "CSSRS_2", "CSSRS_3", "CSSRS_4", "CSSRS_5"]].apply(lambda x: 1 if "Yes" in x.values else 0, axis=1)
+    train_dataset.to_csv(os.path.join(config.output_path, "dataset_train_10k_CSSRS_ratings.csv"))
+
+    # Filter for posts with suicidal ideation, save dataset
+    si_dataset = train_dataset[train_dataset["CSSRS_any"] ==1]
+    si_dataset = si_dataset.reset_index(drop=True)
+    si_dataset.to_csv(os.path.join(config.output_path, "si_dataset_v1.csv"))
+    tracer.end()
 
 
 
@@ -80,77 +284,122 @@ si_dataset.to_csv(os.path.join(config.output_path, "si_dataset_v1.csv"))
 #---------------------#
 
 # Task: Compare the different ways in which each post expresses suicidal ideation.
-# First sample 200 unique pairs of rows, then compare the ways in which each post expresses suicidal ideation.
-
-# Sample 200 unique pairs of rows
-sampled_indices = random.sample(range(1, len(si_dataset.index)), 200)
-sampled_pairs = [(sampled_indices[i], sampled_indices[i+100]) for i in range(100)]
-
-# Save sampled_pairs to a file
-sampled_pairs_file = os.path.join(config.output_path, "sampled_pairs.json")
-with open(sampled_pairs_file, "w") as f:
-    json.dump(sampled_pairs, f)
- 
-# Now compare the ways in which each post expresses suicidal ideation, please list any differences you notice.
-categories = []
-for idx, pair in enumerate(sampled_pairs):
-    print(idx, pair)
-    post1 = train_dataset.iloc[pair[0]]
-    post2 = train_dataset.iloc[pair[1]]
-
-    post1_text = post1["text"]
-    post2_text = post2["text"]
-    output = getCategoriesSafeguard(post1_text, post2_text)
-    print(output)
-
-    try:
-        loaded = json.loads(output)
-        categories.append(loaded)
-        print("Loading worked instantly")
-    except Exception as e:
-        print("Loading didnt work, try differently")
-        print(str(e))
-
-        try: 
-            last_bracket_index = output.rfind(']')
-            output[:last_bracket_index+1]
-            loaded = json.loads(output[:last_bracket_index+1])
+# First sample unique pairs of rows, then compare the ways in which each post expresses suicidal ideation.
+if config.pair_selection == "diverse":
+    from pair_selection import embedPosts, contrastingPairs, isSaturated
+pair_selection_code = [embedPosts, contrastingPairs, isSaturated] if config.pair_selection == "diverse" else []
+
+
+@runner.stage("category_comparisons", inputs=["si_dataset_v1.csv"], outputs=["sampled_pairs.json", "categories_comparisons.csv"],
+              params={"modelID": config.modelID, "seed": config.seed, "pair_selection": config.pair_selection, "max_pairs": config.max_pairs,
+                      "pair_clusters": config.pair_clusters, "saturation_window": config.saturation_window, "saturation_min_new": config.saturation_min_new},
+              code=[getCategoriesSafeguard] + pair_selection_code)
+def compareSampledPairs():
+    si_dataset = pd.read_csv(os.path.join(config.output_path, "si_dataset_v1.csv"), index_col=0)
+
+    # Diverse: contrasting pairs across clusters of locally embedded posts, generated until the categories saturate
+    if config.pair_selection == "diverse":
+        embeddings = embedPosts(si_dataset["text"].fillna("").tolist(), seed=config.seed)
+        candidate_pairs = contrastingPairs(embeddings, config.pair_clusters, seed=config.seed)
+    # Random: sample unique pairs of rows (seeded, so a rerun compares the same pairs)
+    else:
+        sampled_indices = random.Random(config.seed).sample(range(1, len(si_dataset.index)), 2 * config.max_pairs)
+        candidate_pairs = [(sampled_indices[i], sampled_indices[i + config.max_pairs]) for i in range(config.max_pairs)]
+
+    # Now compare the ways in which each post expresses suicidal ideation, please list any differences you notice.
+    categories = []
+    sampled_pairs = []
+    seen_categories = set()
+    new_counts = []
+    for idx, pair in enumerate(candidate_pairs):
+        if idx == config.max_pairs:
+            break
+        sampled_pairs.append(pair)
+        print(idx, pair)
+        post1 = si_dataset.iloc[pair[0]]
+        post2 = si_dataset.iloc[pair[1]]
+
+        post1_text = post1["text"]
+        post2_text = post2["text"]
+        with tracer.span("pair", idx=idx):
+            output = getCategoriesSafeguard(post1_text, post2_text)
+            print(output)
+
+            # Parse the differences (repaired locally or re-asked if the JSON is broken)
+            loaded, parse_error = parseLLMOutput(output, "category_diffs")
+        if parse_error is None:
             categories.append(loaded)
-            print("Loading worked after cutting")
-        except Exception as e2:
-            print("Cutting didnt work!")
-            print(str(e))
+
+        # Count the categories this pair added, stop once the comparisons stop finding new ones
+        found = {str(item["Category"]).lower() for item in loaded} if parse_error is None else set()
+        new_counts.append(len(found - seen_categories))
+        seen_categories |= found
+        if config.pair_selection == "diverse" and isSaturated(new_counts, config.saturation_window, config.saturation_min_new):
+            print(f"Categories saturated after {len(sampled_pairs)} pairs ({len(seen_categories)} categories)")
+            break
+
+    # Save the compared pairs to a file
+    with open(os.path.join(config.output_path, "sampled_pairs.json"), "w") as f:
+        json.dump(sampled_pairs, f)
+
+    # Flatten the nested list of categories
+    flattened_categories = [item for sublist in categories for item in sublist]
+
+    # Save flattened categories as a DataFrame
+    categories_df = pd.DataFrame(flattened_categories)
+    categories_df["Category"] = categories_df["Category"].str.lower()
+    categories_df.to_csv(os.path.join(config.output_path, "categories_comparisons.csv"))
 
 
-# Flatten the nested list of categories
-flattened_categories = [item for sublist in categories for item in sublist]
+# Function to load the comparisons saved by the category_comparisons stage
+# Empty posts and categories stay empty strings as in the frame that was saved (read_csv would turn them into NaN)
+def readCategoriesComparisons():
+    return pd.read_csv(os.path.join(config.output_path, "categories_comparisons.csv"), index_col=0, keep_default_na=False)
 
-# Save flattened categories as a DataFrame
-categories_df = pd.DataFrame(flattened_categories)
-categories_df["Category"] = categories_df["Category"].str.lower()
-categories_comparison_file = os.path.join(config.output_path, "categories_comparisons.csv")
-categories_df.to_csv(categories_comparison_file)
 
 
 #---------------------#
 # Select top 10 categories
 #---------------------#
 # Get top 10 redundant categories using identifyRedundantCategories function
-
-# Calculate category counts and convert to a list of category names
-vals = categories_df["Category"].value_counts()
-output = identifyRedundantCategories(str(vals.index.tolist()))
-# Save filtered top 10 categories to JSON file
-filtered_categories_file = os.path.join(config.output_path, "filtered_top10_categories.json")
-with open(filtered_categories_file, "w") as f:
-    json.dump(output, f)
-# Save filtered top 10 categories to JSON file
-filtered_categories_file = os.path.join(config.output_path, "filtered_top10_categories.json")
-with open(filtered_categories_file, "w") as f:
-    json.dump(output, f)
-filtered_categories = json.loads(output)
-# Get the top 10 categories
-target_categories = [cat["name"].lower() for cat in filtered_categories["categories"]][:10]
+@runner.stage("top_categories", inputs=["categories_comparisons.csv"], outputs=["category_groups.csv", "filtered_top10_categories.json", "target_categories.json"],
+              params={"modelID": config.modelID, "category_similarity": config.category_similarity},
+              code=[identifyRedundantCategories, groupCategories])
+def selectTopCategories():
+    categories_df = readCategoriesComparisons()
+
+    # Calculate category counts
+    vals = categories_df["Category"].value_counts()
+
+    # Merge near-synonym categories locally and send the groups with their counts (or the list of all category names)
+    if config.category_similarity is not None:
+        category_groups = groupCategories(vals, config.category_similarity)
+        group_counts = groupCounts(category_groups)
+        print(f"Categories: {len(vals)} labels merged into {len(group_counts)} groups")
+        text_input = str(group_counts.to_dict())
+    else:
+        category_groups = pd.DataFrame({"category": vals.index, "group": vals.index, "count": vals.values})
+        text_input = str(vals.index.tolist())
+    # Save the group of every raw category, used to collect the comparisons of a category
+    category_groups.to_csv(os.path.join(config.output_path, "category_groups.csv"))
+    output = identifyRedundantCategories(text_input)
+    # Save filtered top 10 categories to JSON file
+    with open(os.path.join(config.output_path, "filtered_top10_categories.json"), "w") as f:
+        json.dump(output, f)
+    filtered_categories, parse_error = parseLLMOutput(output, "redundant_categories")
+    if parse_error is not None:
+        raise RuntimeError(f"Stage top_categories: the top categories answer could not be parsed ({parse_error}), "
+                           f"raw answer (also in filtered_top10_categories.json): {str(output)[:500]!r}")
+    # Get the top 10 categories, saved for the later stages (the raw answer may have needed a re-ask)
+    target_categories = [cat["name"].lower() for cat in filtered_categories["categories"]][:10]
+    with open(os.path.join(config.output_path, "target_categories.json"), "w") as f:
+        json.dump(target_categories, f)
+
+
+# Function to load the top 10 categories selected by the top_categories stage
+def loadTargetCategories():
+    with open(os.path.join(config.output_path, "target_categories.json")) as f:
+        return json.load(f)
 
 
 
@@ -159,90 +408,97 @@ target_categories = [cat["name"].lower() for cat in filtered_categories["categor
 # Create features for each category
 #---------------------#
 
-# Initialize dictionary to store feature definitions for each category
-features_dict = {}
-# Loop through each target category and retrieve example comparisons for feature definitions
-for category in target_categories:
-    print(category)
-    # Filter category-specific rows from categories_df
-    category_df = categories_df[categories_df["Category"] == category]
-    example_posts = ""
-    
-    # Concatenate example post pairs for the current category
-    for i, row in category_df.iterrows():
-        example_posts += row["Post 1"] + "\n"
-        example_posts += "------\n"
-        example_posts += row["Post 2"] + "\n"
-        example_posts += "------\n"
-    
-    # Generate feature definitions using the LLM for the current category
-    output = getLLMFeatures(category, example_posts)
-    features_dict[category] = output    
-    print(output)  
-
-# Clean the LLM output to ensure valid JSON format for each category's feature definitions
-for key in features_dict.keys():
-    print(key)
-    clean = clean_string(features_dict[key])
-    try:
-        # Parse JSON-formatted string to Python dictionary
-        loaded = json.loads(clean)
-        features_dict[key] = loaded
-        print(loaded)
-    except Exception as e:
-        print(str(e))  # Log any errors in JSON parsing
-
-
+@runner.stage("feature_definitions", inputs=["categories_comparisons.csv", "category_groups.csv", "target_categories.json"], outputs=["feature_definitions_final.csv"],
+              params={"modelID": config.modelID, "category_similarity": config.category_similarity,
+                      "feature_examples_token_budget": config.feature_examples_token_budget},
+              code=[createFeaturesMessages, packExamplePosts, findGroup])
+def createFeatureDefinitions():
+    categories_df = readCategoriesComparisons()
+    category_groups = pd.read_csv(os.path.join(config.output_path, "category_groups.csv"), index_col=0, keep_default_na=False)
+    target_categories = loadTargetCategories()
+
+    # Loop through each target category and retrieve example comparisons for feature definitions
+    examples = []
+    packing = {}
+    for category in target_categories:
+        print(category)
+        # Filter category-specific rows from categories_df: all raw categories of its group (the same name without grouping)
+        group = findGroup(category_groups, category, config.category_similarity) if config.category_similarity is not None else category
+        category_df = categories_df[categories_df["Category"].isin(category_groups.loc[category_groups["group"] == group, "category"])]
+
+        # Concatenate example post pairs for the current category (unique and diverse pairs within the token budget)
+        example_posts, packing[category] = packExamplePosts(zip(category_df["Post 1"], category_df["Post 2"]), config.feature_examples_token_budget)
+        examples.append((category, example_posts))
+
+    # Report the example tokens saved by the packing
+    packing = pd.DataFrame(packing).T
+    packing.loc["total"] = packing.sum()
+    print(packing.to_string())
+    print(f"Example tokens: {packing.at['total', 'packed_tokens']} of {packing.at['total', 'tokens']} ({1 - packing.at['total', 'packed_tokens'] / max(packing.at['total', 'tokens'], 1):.0%} saved)")
+
+    # Generate feature definitions using the LLM for all categories concurrently
+    start = datetime.now()
+    outputs, errors = getLLMFeaturesConcurrently(examples)
+    print(f"Feature definitions of {len(examples)} categories: {datetime.now() - start}")
+    failed = {category: error for (category, _), error in zip(examples, errors) if error is not None}
+    if failed:
+        raise RuntimeError(f"Feature definitions failed: {failed}")
+    features_dict = {category: output for (category, _), output in zip(examples, outputs)}
+    for output in outputs:
+        print(output)
 
+    # Parse the feature definitions of each category (repaired locally or re-asked if the JSON is broken)
+    for key in features_dict.keys():
+        print(key)
+        loaded, parse_error = parseLLMOutput(features_dict[key], "feature_definitions")
+        if parse_error is None:
+            features_dict[key] = loaded
+            print(loaded)
 
 
+    #---------------------#
+    # Reformat extracted features into structured dataframes
+    #---------------------#
 
-#---------------------#
-# Reformat extracted features into structured dataframes
-#---------------------#
+    # Initialize a list to store dataframes for each category's feature definitions
+    tracer.begin("feature_table")
+    df_list = []
 
-# Initialize a list to store dataframes for each category's feature definitions
-df_list = []
-
-# Convert each category's feature definitions into a structured dataframe
-for key in features_dict.keys():
-    print(key)
-    try:
-        # Load the current category's feature list into a DataFrame
-        cur_list = features_dict[key]
-        cur_df = pd.DataFrame.from_dict(cur_list)
-        
-        # Add the category as a new column to each row in the current DataFrame
-        cur_df["category"] = key
-        
-        # Relocate the 'category' column to the first position for better readability
-        cols = cur_df.columns.tolist()
-        cols = cols[-1:] + cols[:-1]
-        cur_df = cur_df[cols]
-        
-        # Append the current DataFrame to the list
-        df_list.append(cur_df)
-    except Exception as e:
-        print(str(e))  # Log any errors encountered during DataFrame creation
+    # Convert each category's feature definitions into a structured dataframe
+    for key in features_dict.keys():
         print(key)
-        print(features_dict[key])
+        try:
+            # Load the current category's feature list into a DataFrame
+            cur_list = features_dict[key]
+            cur_df = pd.DataFrame.from_dict(cur_list)
 
+            # Add the category as a new column to each row in the current DataFrame
+            cur_df["category"] = key
 
+            # Relocate the 'category' column to the first position for better readability
+            cols = cur_df.columns.tolist()
+            cols = cols[-1:] + cols[:-1]
+            cur_df = cur_df[cols]
+
+            # Append the current DataFrame to the list
+            df_list.append(cur_df)
+        except Exception as e:
+            print(str(e))  # Log any errors encountered during DataFrame creation
+            print(key)
+            print(features_dict[key])
 
-#---------------------#
-# Definition of final feature dataframe
-#---------------------#
 
+    #---------------------#
+    # Definition of final feature dataframe
+    #---------------------#
 
-# Concatenate all dataframes into a single DataFrame
-final_df = pd.concat(df_list)
-final_df["featurename"].value_counts()
-final_df["category"] = final_df["category"].str.replace(" ", "")
-final_df["category"].value_counts()
-final_df["feature_id"] = final_df["category"] + "_" + final_df["featurename"]
-final_df["feature_id"] = final_df["feature_id"].str.replace(" ", "_")
-final_df["feature_id"].tolist()
-final_df.to_csv(f"{config.output_path}/feature_definitions_final.csv")
+    # Concatenate all dataframes into a single DataFrame
+    final_df = pd.concat(df_list)
+    final_df["category"] = final_df["category"].str.replace(" ", "")
+    final_df["feature_id"] = final_df["category"] + "_" + final_df["featurename"]
+    final_df["feature_id"] = final_df["feature_id"].str.replace(" ", "_")
+    final_df.to_csv(f"{config.output_path}/feature_definitions_final.csv")
+    tracer.end()
 
 
 
@@ -252,72 +508,159 @@ final_df.to_csv(f"{config.output_path}/feature_definitions_final.csv")
 # Part 3: Evaluation of features
 ########################################################################################
 
-#---------------------#
-# Prepare features for providing it to the LLM
-#---------------------#
-
-
-# Split final_df into a list of DataFrames for each category
-category_dfs = {}
-for category in target_categories:
-    category_dfs[category] = final_df[final_df["category"] == category.replace(" ", "")]
-    print(category_dfs[category].shape)
-
-# Build feature strings for each category to be used in the LLM
-features_strings_dict = {category: getFeaturesAsString(category_dfs[category]) for category in category_dfs.keys()}
-
 # Sample 1000 rows from si_dataset and save to CSV
-si_dataset_1k = si_dataset.sample(1000)
-si_dataset_1k.to_csv(f"{config.output_path}/si_dataset_1k.csv")
-
+@runner.stage("si_sample_1k", inputs=["si_dataset_v1.csv"], outputs=["si_dataset_1k.csv"], params={"seed": config.seed})
+def sampleSIDataset():
+    si_dataset = pd.read_csv(os.path.join(config.output_path, "si_dataset_v1.csv"), index_col=0)
+    si_dataset_1k = si_dataset.sample(1000, random_state=config.seed)
+    si_dataset_1k.to_csv(f"{config.output_path}/si_dataset_1k.csv")
+    printNearDuplicateStats("si_dataset_1k", si_dataset_1k)
+
+
+@runner.stage("feature_evaluation", inputs=["si_dataset_v1.csv", "feature_definitions_final.csv", "target_categories.json"],
+              outputs=["evaluated_features_f1000.csv"],
+              params={"modelID": config.modelID, "merged_feature_evaluation": config.merged_feature_evaluation,
+                      "feature_batch_token_budget": config.feature_batch_token_budget, "max_batch_size": config.max_batch_size},
+              code=[getFeaturesAsString, evaluateFeatures, evaluateFeaturesMerged, createFeaturesBatchPrompt])
+def evaluateFeatureDefinitions():
+    si_dataset = pd.read_csv(os.path.join(config.output_path, "si_dataset_v1.csv"), index_col=0)
+    final_df = pd.read_csv(os.path.join(config.output_path, "feature_definitions_final.csv"), index_col=0)
+
+    #---------------------#
+    # Prepare features for providing it to the LLM
+    #---------------------#
+
+    # Split final_df into a list of DataFrames for each category
+    category_dfs = {}
+    for category in loadTargetCategories():
+        category_dfs[category] = final_df[final_df["category"] == category.replace(" ", "")]
+        print(category_dfs[category].shape)
+
+    # Build feature strings for each category to be used in the LLM
+    features_strings_dict = {category: getFeaturesAsString(category_dfs[category]) for category in category_dfs.keys()}
+
+
+    #---------------------#
+    # Evaluate all features
+    #---------------------#
+
+    # Batch mode: evaluate every category for a chunk of posts in token-budgeted multi-post requests
+    def evaluatePostsBatched(pending, log_file):
+        chunk_size = config.max_batch_size * 10
+        for chunk_start in range(0, len(pending), chunk_size):
+            start = datetime.now()
+            chunk = pending.iloc[chunk_start:chunk_start + chunk_size]
+            texts = chunk["text"].tolist()
+            clean_dicts = [{"ID": id} for id in chunk["ID"]]
+            calls = 0
+            for category, feat_string in features_strings_dict.items():
+                with tracer.span("category", category=category, posts=len(texts)):
+                    ratings, category_calls = evaluateFeaturesBatched(texts, feat_string, config.feature_batch_token_budget)
+                calls += category_calls
+                for clean_dict, features in zip(clean_dicts, ratings):
+                    for feature in features or []:
+                        clean_dict[feature["featureid"]] = feature["rating"]
+
+            # Append the evaluated features of the posts to the checkpoint log
+            for clean_dict in clean_dicts:
+                appendCheckpoint(log_file, clean_dict)
+            end = datetime.now()
+            print(f"{chunk_start + len(chunk)}/{len(pending)} posts, evaluation time: {end - start}, LLM calls: {calls}")
+
+    # Otherwise evaluate post by post
+    def evaluatePostsOneByOne(pending, log_file):
+        count = 0
+        for idx, row in pending.iterrows():
+            start = datetime.now()
+
+            # Retrieve post details
+            text_input = row["text"]
+            id = row["ID"]
+            print(idx, id, count)
+            count += 1
+
+            # Evaluate the features of all categories (in one request when merged, missing categories are re-asked individually)
+            with tracer.span("post", id=id):
+                feature_evaluation_dict, calls = evaluateAllCategories(text_input, features_strings_dict, merged=config.merged_feature_evaluation)
+
+            # Create a dictionary for current post's evaluated features
+            clean_dict = {"ID": id}
+            for category, features in feature_evaluation_dict.items():
+                for feature in features:
+                    clean_dict[feature["featureid"]] = feature["rating"]
+
+            # Append the evaluated features of the post to the checkpoint log
+            appendCheckpoint(log_file, clean_dict)
+            end = datetime.now()
+            print(f"Evaluation time: {end - start}, LLM calls: {calls}")
+
+    # Function to evaluate the features of the pending posts and append them to the checkpoint log (failed categories are left unrated)
+    def evaluatePosts(pending, log_file):
+        if config.feature_batch_token_budget:
+            evaluatePostsBatched(pending, log_file)
+        else:
+            evaluatePostsOneByOne(pending, log_file)
+        return {}
+
+    # Loop through posts in si_dataset for feature evaluation, skipping posts finished in an interrupted run (or in another shard)
+    # (near-duplicates are not evaluated, they take the features of the post they duplicate)
+    source_ids = sourceIDs(si_dataset)
+    printNearDuplicateStats("Features", si_dataset)
+    finished, _ = runShardedStage("feature_evaluation", si_dataset[source_ids == si_dataset["ID"]], evaluatePosts)
+
+    # Build the evaluated feature matrix (posts x feature_id, int8) of all posts from the checkpoint logs and save as CSV
+    tracer.begin("feature_matrix")
+    rated = [(post_id, source_id) for post_id, source_id in zip(si_dataset["ID"], source_ids) if source_id in finished]
+    rating_matrix = RatingMatrix([post_id for post_id, _ in rated], final_df["feature_id"].tolist())
+    for post_id, source_id in rated:
+        rating_matrix.setRatings(post_id, finished[source_id])
+    print(f"Ratings for unknown features: {rating_matrix.unknown_features}, invalid ratings: {rating_matrix.invalid_ratings}")
+    rating_matrix.toCSV(f"{config.output_path}/evaluated_features_f1000.csv")
+    tracer.end()
 
 
+########################################################################################
+# Clusters and marker features
+########################################################################################
 
-
-
-#---------------------#
-# Evaluate all features
-#---------------------#
-
-# Loop through posts in si_dataset for feature evaluation
-evaluated_feature_dfs = []
-count = 0
-for idx, row in si_dataset.iterrows():
-    start = datetime.now()
-    
-    # Retrieve post details
-    text_input = row["text"]
-    id = row["ID"]
-    print(idx, id, count)
-    count += 1
-
-    feature_evaluation_dict = {}
-
-    # Loop through different feature categories
-    for category, feat_string in features_strings_dict.items():
-        # Evaluate features for the specific category
-        output = evaluateFeatures(text_input, feat_string)
-        
-        # Parse and clean LLM output
-        try:
-            feat = json.loads(clean_string(output))
-            feature_evaluation_dict[category] = feat
-        except Exception as e:
-            print(f"Error in category {category}: {e}")
-            print("Output:", output)
-
-    # Create a dictionary for current post's evaluated features
-    clean_dict = {"ID": id}
-    for category, features in feature_evaluation_dict.items():
-        for feature in features:
-            clean_dict[feature["featureid"]] = feature["rating"]
-
-    # Append the evaluated features to the DataFrame list
-    post_df = pd.DataFrame.from_dict(clean_dict, orient='index').T
-    evaluated_feature_dfs.append(post_df)
-    end = datetime.now()
-    print(f"Evaluation time: {end - start}")
-
-# Concatenate all evaluated feature DataFrames and save as CSV
-bound = pd.concat(evaluated_feature_dfs)
-bound.to_csv(f"{config.output_path}/evaluated_features_f1000.csv", index=False)
+# Optional Python counterpart of the clustering and marker features of downstream_analyses.R
+if config.marker_clusters is not None:
+    from marker_features import loadFeatureMatrix, scaleMatrix, clusterPosts, elbowCurve, markerStatistics, topMarkers, clusterProfiles
+
+    @runner.stage("marker_features", inputs=["evaluated_features_f1000.csv"],
+                  outputs=["clusters.csv", "cluster_profiles.csv", "marker_statistics.csv", "top_markers.csv"],
+                  params={"marker_clusters": config.marker_clusters, "seed": config.seed, "marker_max_missing": config.marker_max_missing,
+                          "marker_top_n": config.marker_top_n, "marker_minibatch_rows": config.marker_minibatch_rows},
+                  code=[loadFeatureMatrix, clusterPosts, markerStatistics, topMarkers])
+    def findMarkerFeatures():
+        matrix = loadFeatureMatrix(os.path.join(config.output_path, "evaluated_features_f1000.csv"), config.marker_max_missing)
+        scaled = scaleMatrix(matrix)
+        print("Total within-cluster sum of squares per number of clusters:")
+        print(pd.Series(elbowCurve(scaled, seed=config.seed, minibatch_rows=config.marker_minibatch_rows)).round(1).to_string())
+
+        clusters = clusterPosts(scaled, config.marker_clusters, seed=config.seed, minibatch_rows=config.marker_minibatch_rows)
+        pd.DataFrame({"ID": matrix.index, "cluster": clusters}).to_csv(os.path.join(config.output_path, "clusters.csv"))
+        clusterProfiles(matrix, clusters).to_csv(os.path.join(config.output_path, "cluster_profiles.csv"))
+
+        marker_statistics = markerStatistics(matrix, clusters)
+        marker_statistics.to_csv(os.path.join(config.output_path, "marker_statistics.csv"))
+        top_markers = topMarkers(marker_statistics, config.marker_top_n)
+        top_markers.to_csv(os.path.join(config.output_path, "top_markers.csv"))
+        print(f"Marker features of {matrix.shape[0]} posts and {matrix.shape[1]} features:")
+        print(top_markers.groupby("cluster_name").agg(markers=("feature", "size"), top_marker=("feature", "first")).to_string())
+
+
+# Run the stages (only the ones whose inputs, parameters or prompts changed since their outputs were cached)
+# A shard worker only runs its stage, the stages before it must have been run (they are restored from the cache)
+runner.run(args.targets, cached_only=args.shard is not None)
+
+# Report how many LLM requests were answered from the local response cache
+print("LLM cache:", llm_cache.stats())
+
+# Report how many LLM answers were valid JSON, repaired locally, re-asked or failed (per prompt type)
+print("Structured output parsing:")
+print(pd.DataFrame(parseStats()).T.to_string())
+
+# Report where the time and the tokens of the LLM calls went (per prompt type, details per call in config.llm_metrics_path)
+print("LLM calls:")
+print(pd.DataFrame(llm_metrics.summary()).T.to_string())
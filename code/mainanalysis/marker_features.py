@@ -0,0 +1,118 @@
+# marker_features.py
+# Cluster profiling of the evaluated feature matrix (Part 3), the Python counterpart of the clustering and
+# marker-feature section of downstream_analyses.R (requires scikit-learn and scipy).
+# Features missing for too many posts are dropped, the other missing ratings are replaced by the feature median.
+# Posts are clustered with k-means on the scaled matrix (mini-batch k-means for large corpora). The one-vs-rest
+# statistics of every feature and cluster (in-cluster and out-of-cluster means, log2FC, one-way ANOVA F and p) are
+# computed from per-cluster sums in one matrix pass, instead of one test per feature and cluster.
+# top_markers.csv has the columns of the file written by downstream_analyses.R.
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+
+# Function to load the evaluated feature matrix (posts x features): features missing for at least max_missing of the
+# posts are dropped, missing ratings of the other features are replaced by the median of the feature
+def loadFeatureMatrix(path, max_missing=0.5):
+    features = pd.read_csv(path).set_index("ID")
+    features = features.loc[:, features.isna().mean() < max_missing]
+    return features.fillna(features.median())
+
+
+# Function to scale the features to mean 0 and standard deviation 1 (constant features become 0)
+def scaleMatrix(matrix):
+    values = np.asarray(matrix, dtype=float)
+    deviations = values.std(axis=0, ddof=1)
+    deviations[~(deviations > 0)] = 1.0
+    return (values - values.mean(axis=0)) / deviations
+
+
+# Function to cluster the posts with k-means, with mini-batch k-means from minibatch_rows posts on
+# Returns the cluster of every post, numbered from 1 as in R
+def clusterPosts(scaled, n_clusters, seed=None, minibatch_rows=50000):
+    if len(scaled) >= minibatch_rows:
+        model = MiniBatchKMeans(n_clusters, batch_size=4096, n_init=3, random_state=seed)
+    else:
+        model = KMeans(n_clusters, n_init=10, random_state=seed)
+    return model.fit_predict(scaled) + 1
+
+
+# Function to get the total within-cluster sum of squares for 1 to max_clusters clusters (elbow plot)
+def elbowCurve(scaled, max_clusters=10, seed=None, minibatch_rows=50000):
+    model = lambda k: MiniBatchKMeans(k, batch_size=4096, n_init=3, random_state=seed) if len(scaled) >= minibatch_rows else KMeans(k, n_init=10, random_state=seed)
+    return {k: float(model(k).fit(scaled).inertia_) for k in range(1, max_clusters + 1)}
+
+
+# Function to get the one-vs-rest statistics of every feature in every cluster from per-cluster sums
+# matrix: posts x features (unscaled ratings), clusters: cluster of every post
+# Returns one row per cluster and feature with the columns of the marker table of downstream_analyses.R
+def markerStatistics(matrix, clusters):
+    values = np.asarray(matrix, dtype=float)
+    clusters = np.asarray(clusters)
+    cluster_ids = np.unique(clusters)
+    membership = (clusters[:, None] == cluster_ids[None, :]).astype(float)
+
+    # Sums and sums of squares per cluster (clusters x features) and over all posts
+    n = len(values)
+    n_in = membership.sum(axis=0)[:, None]
+    n_out = n - n_in
+    sums_in = membership.T @ values
+    squares = (values ** 2).sum(axis=0)
+    sums = values.sum(axis=0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_in = sums_in / n_in
+        mean_out = (sums - sums_in) / n_out
+        grand_mean = sums / n
+        # One-way ANOVA of in-cluster vs out-of-cluster (1 and n - 2 degrees of freedom)
+        ss_between = n_in * (mean_in - grand_mean) ** 2 + n_out * (mean_out - grand_mean) ** 2
+        ss_total = np.broadcast_to(squares - n * grand_mean ** 2, ss_between.shape)
+        ss_within = np.clip(ss_total - ss_between, 0, None)
+        f_values = ss_between / (ss_within / (n - 2))
+        p_values = stats.f.sf(f_values, 1, n - 2)
+        ges = ss_between / ss_total
+        log2fc = np.log2(mean_in / mean_out)
+
+    feature_names = list(matrix.columns) if hasattr(matrix, "columns") else [f"feature{idx}" for idx in range(values.shape[1])]
+    n_features = len(feature_names)
+    table = pd.DataFrame({
+        "feature": np.tile(feature_names, len(cluster_ids)),
+        "mean_in_cluster": mean_in.ravel(),
+        "mean_out_cluster": mean_out.ravel(),
+        "Effect": "group",
+        "DFn": 1,
+        "DFd": n - 2,
+        "F": f_values.ravel(),
+        "p": p_values.ravel(),
+        "p..05": np.where(p_values.ravel() < 0.05, "*", ""),
+        "ges": ges.ravel(),
+        # Bonferroni correction over the features tested for a cluster
+        "bonferroni_threshold": 0.05 / n_features,
+        "cluster": np.repeat(cluster_ids, n_features),
+    })
+    table["p.adj.sig"] = table["p"] < table["bonferroni_threshold"]
+    table["log2FC"] = log2fc.ravel()
+    return table
+
+
+# Function to get the top marker features of every cluster: significant after Bonferroni correction, higher in the
+# cluster than outside (log2FC > 0), the top_n smallest p-values per cluster (ties are kept, as slice_min in R)
+def topMarkers(marker_table, top_n=15):
+    markers = marker_table[marker_table["p.adj.sig"] & (marker_table["log2FC"] > 0)]
+    markers = markers[markers.groupby("cluster")["p"].rank(method="min") <= top_n]
+    markers = markers.sort_values(["cluster", "p"], kind="stable").reset_index(drop=True)
+    markers["group"] = markers["feature"].str.split("_").str[0]
+    markers["cluster_name"] = "Cluster " + markers["cluster"].astype(str)
+    markers["feature_name"] = markers["feature"].str.replace("_", " ")
+    markers.index = markers.index + 1
+    return markers
+
+
+# Function to get the size of every cluster and the mean rating of every feature in it (clusters x features)
+def clusterProfiles(matrix, clusters):
+    profiles = pd.DataFrame(matrix).groupby(np.asarray(clusters)).mean()
+    profiles.insert(0, "posts", pd.Series(np.asarray(clusters)).value_counts().sort_index().values)
+    profiles.index.name = "cluster"
+    return profiles
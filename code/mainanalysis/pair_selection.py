@@ -0,0 +1,55 @@
+# pair_selection.py
+# Selection of the post pairs compared in Part 2 (requires scikit-learn).
+# Posts are embedded locally (TF-IDF reduced with SVD) and grouped into clusters. Pairs are drawn across clusters,
+# the least used clusters first, with the partner that is least similar to the first post. Near-duplicate pairs are
+# avoided and rare kinds of posts are compared early. Pairs are generated one at a time, so the comparisons can stop
+# as soon as they stop finding new categories.
+
+import numpy as np
+from sklearn.cluster import KMeans
+from sklearn.decomposition import TruncatedSVD
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.preprocessing import normalize
+
+
+# Function to embed posts locally: TF-IDF reduced to dimensions with SVD, rows normalized (dot product = cosine similarity)
+def embedPosts(texts, dimensions=100, seed=None):
+    tfidf = TfidfVectorizer(sublinear_tf=True, min_df=2, max_df=0.5, stop_words="english").fit_transform(texts)
+    dimensions = max(1, min(dimensions, tfidf.shape[1] - 1))
+    return normalize(TruncatedSVD(dimensions, random_state=seed).fit_transform(tfidf))
+
+
+# Function to generate contrasting pairs of posts (positions in embeddings), every post is used at most once
+# The first post comes from the least used cluster, its partner from the least used other cluster (ties: the cluster
+# least similar to the first one) and is the post of that cluster least similar to the first post
+def contrastingPairs(embeddings, n_clusters, seed=None):
+    rng = np.random.default_rng(seed)
+    n_clusters = max(2, min(n_clusters, len(embeddings) // 2))
+    clusters = KMeans(n_clusters, n_init=4, random_state=seed).fit_predict(embeddings)
+    centroids = normalize(np.vstack([embeddings[clusters == cluster].mean(axis=0) for cluster in range(n_clusters)]))
+    centroid_similarity = centroids @ centroids.T
+    unused = np.ones(len(embeddings), dtype=bool)
+    uses = np.zeros(n_clusters, dtype=int)
+
+    while True:
+        available = [cluster for cluster in range(n_clusters) if (unused & (clusters == cluster)).any()]
+        if len(available) < 2:
+            return
+        tie_breaks = rng.random(n_clusters)
+        first_cluster = min(available, key=lambda cluster: (uses[cluster], tie_breaks[cluster]))
+        second_cluster = min((cluster for cluster in available if cluster != first_cluster),
+                             key=lambda cluster: (uses[cluster], centroid_similarity[first_cluster, cluster]))
+
+        first = rng.choice(np.flatnonzero(unused & (clusters == first_cluster)))
+        candidates = np.flatnonzero(unused & (clusters == second_cluster))
+        second = candidates[np.argmin(embeddings[candidates] @ embeddings[first])]
+
+        unused[[first, second]] = False
+        uses[[first_cluster, second_cluster]] += 1
+        yield int(first), int(second)
+
+
+# Function to check whether the comparisons have saturated: fewer than min_new new categories in the last window comparisons
+# new_counts: number of new categories found by each comparison so far
+def isSaturated(new_counts, window, min_new):
+    return len(new_counts) >= window and sum(new_counts[-window:]) < min_new
@@ -0,0 +1,65 @@
+# prefilter.py
+# Local pre-filter of the C-SSRS scoring (Part 1), requires scikit-learn.
+# A TF-IDF + logistic regression classifier is trained on the C-SSRS ratings of an earlier run
+# (dataset_train_10k_CSSRS_ratings.csv, label: CSSRS_any). Posts it rates below a threshold are assigned
+# "No" to all questions locally, only the others are sent to the LLM.
+# The threshold is chosen on cross-validated probabilities so that a target share of the positive posts
+# (recall) stays above it. The report compares the cascade with the full LLM scoring on a held-out split.
+
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import cross_val_predict, train_test_split
+from sklearn.pipeline import make_pipeline
+
+
+# Function to create the classifier: word and bigram TF-IDF, class-weighted logistic regression
+def createPrefilter(seed=None):
+    return make_pipeline(
+        TfidfVectorizer(sublinear_tf=True, ngram_range=(1, 2), min_df=2, max_features=200000),
+        LogisticRegression(class_weight="balanced", max_iter=1000, random_state=seed),
+    )
+
+
+# Function to get the highest threshold that keeps at least the share recall of the positive posts above it
+def recallThreshold(probabilities, labels, recall):
+    positives = np.sort(probabilities[labels == 1])
+    if len(positives) == 0:
+        return 0.0
+    return float(positives[int(np.floor((1 - recall) * len(positives)))])
+
+
+# Function to compare the cascade with the full scoring: LLM calls saved, agreement and recall of CSSRS_any
+def cascadeReport(probabilities, labels, threshold):
+    local = probabilities < threshold
+    positives = labels == 1
+    return {
+        "posts": int(len(labels)),
+        "positives": int(positives.sum()),
+        "llm_calls_saved": int(local.sum()),
+        "llm_calls_saved_rate": round(float(local.mean()), 4) if len(labels) else 0.0,
+        # The posts sent to the LLM keep its answer, the local ones are negative
+        "agreement": round(float(np.mean(~(local & positives))), 4) if len(labels) else 0.0,
+        "recall": round(float(np.mean(~local[positives])), 4) if positives.any() else 1.0,
+        "missed_positives": int((local & positives).sum()),
+    }
+
+
+# Function to train the pre-filter on rated posts and choose its threshold
+# texts / labels: posts and their CSSRS_any from the full LLM scoring, recall: share of the positives to keep
+# holdout: share of the posts kept out of the training to report how the cascade compares with the full scoring
+# Returns the trained classifier, the threshold and the report
+def trainPrefilter(texts, labels, recall, holdout=0.2, seed=None):
+    texts = np.asarray(texts, dtype=object)
+    labels = np.asarray(labels, dtype=int)
+    train_texts, test_texts, train_labels, test_labels = train_test_split(
+        texts, labels, test_size=holdout, stratify=labels, random_state=seed)
+
+    # The threshold is chosen on probabilities of posts the classifier was not trained on
+    probabilities = cross_val_predict(createPrefilter(seed), train_texts, train_labels, cv=5, method="predict_proba")[:, 1]
+    threshold = recallThreshold(probabilities, train_labels, recall)
+
+    prefilter = createPrefilter(seed).fit(train_texts, train_labels)
+    report = {"target_recall": recall, "threshold": round(threshold, 6), "train_posts": int(len(train_labels)),
+              "holdout": cascadeReport(prefilter.predict_proba(test_texts)[:, 1], test_labels, threshold)}
+    return prefilter, threshold, report
@@ -0,0 +1,67 @@
+# rating_store.py
+# Array-backed store for the evaluated feature ratings (Part 3).
+# Ratings are written into a preallocated int8 matrix of posts x features, with a boolean
+# mask marking which ratings are present, instead of building one DataFrame per post.
+
+import numpy as np
+import pandas as pd
+
+
+class RatingMatrix:
+    # post_ids: row order of the matrix, feature_ids: column order (e.g. from feature_definitions_final.csv)
+    def __init__(self, post_ids, feature_ids, max_rating=3):
+        self.post_ids = list(post_ids)
+        self.feature_ids = list(dict.fromkeys(feature_ids))
+        self.post_index = {post_id: idx for idx, post_id in enumerate(self.post_ids)}
+        self.feature_index = {feature_id: idx for idx, feature_id in enumerate(self.feature_ids)}
+        self.max_rating = max_rating
+        self.values = np.zeros((len(self.post_ids), len(self.feature_ids)), dtype=np.int8)
+        self.mask = np.zeros((len(self.post_ids), len(self.feature_ids)), dtype=bool)
+        # Ratings for feature ids that are not defined, or that are not an integer in 0..max_rating
+        self.unknown_features = 0
+        self.invalid_ratings = 0
+
+    # Function to create the matrix with the features of the final feature definitions
+    @classmethod
+    def fromFeatureDefinitions(cls, post_ids, feature_definitions_path, **kwargs):
+        feature_ids = pd.read_csv(feature_definitions_path)["feature_id"].tolist()
+        return cls(post_ids, feature_ids, **kwargs)
+
+    # Function to store the ratings of one post, ratings: dict of feature id -> rating
+    def setRatings(self, post_id, ratings):
+        row = self.post_index[post_id]
+        for feature_id, rating in ratings.items():
+            col = self.feature_index.get(feature_id)
+            if col is None:
+                if feature_id != "ID":
+                    self.unknown_features += 1
+                continue
+            try:
+                rating = int(rating)
+            except (TypeError, ValueError):
+                self.invalid_ratings += 1
+                continue
+            if not 0 <= rating <= self.max_rating:
+                self.invalid_ratings += 1
+                continue
+            self.values[row, col] = rating
+            self.mask[row, col] = True
+
+    # Function to get the fraction of missing ratings per feature
+    def missingRate(self):
+        return pd.Series(1 - self.mask.mean(axis=0), index=self.feature_ids)
+
+    # Function to export the matrix as a DataFrame with nullable int8 columns (missing ratings are NA)
+    def toDataFrame(self):
+        columns = {"ID": pd.Series(self.post_ids, dtype=object)}
+        for col, feature_id in enumerate(self.feature_ids):
+            columns[feature_id] = pd.arrays.IntegerArray(self.values[:, col].copy(), ~self.mask[:, col])
+        return pd.DataFrame(columns)
+
+    # Function to save the matrix as CSV in the format of evaluated_features_f1000.csv
+    def toCSV(self, path):
+        self.toDataFrame().to_csv(path, index=False)
+
+    # Function to save the matrix as Parquet (requires pyarrow or fastparquet)
+    def toParquet(self, path):
+        self.toDataFrame().to_parquet(path, index=False)
@@ -0,0 +1,126 @@
+# sharding.py
+# Splitting the LLM stages of main.py (C-SSRS scoring, feature evaluation) over several processes or hosts.
+# Posts are assigned to shards by a hash of their ID, so every worker knows its posts without coordination.
+# Each worker appends its results to its own shard log next to the checkpoint logs (a shared filesystem is enough
+# for several hosts) and writes a .done marker when its shard is finished. The merge reads the logs of all shards.
+# Re-running a shard is idempotent: posts already in any log of the stage are skipped.
+
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pandas as pd
+
+from checkpoint import loadCheckpoint
+
+
+# Function to get the shard of a post ID (stable across processes, hosts and Python versions)
+def shardOf(post_id, num_shards):
+    return int(hashlib.sha1(str(post_id).encode("utf-8")).hexdigest()[:8], 16) % num_shards
+
+
+# Function to add the shard to a file name, e.g. trace.json -> trace.shard-0-of-4.json
+def shardSuffix(path, index, num_shards):
+    root, extension = os.path.splitext(path)
+    return f"{root}.shard-{index}-of-{num_shards}{extension}"
+
+
+# Function to get the log of a stage: the single-process log, or the log of one shard
+def stageLogPath(checkpoint_path, stage, key, index=None, num_shards=None):
+    path = os.path.join(checkpoint_path, f"{stage}-{key}.jsonl")
+    return path if index is None else shardSuffix(path, index, num_shards)
+
+
+# Function to read the records of all logs of a stage (single-process and any number of shards), by ID
+def loadStageCheckpoint(checkpoint_path, stage, key):
+    finished = {}
+    for path in sorted(glob.glob(os.path.join(checkpoint_path, f"{stage}-{key}*.jsonl"))):
+        finished.update(loadCheckpoint(path))
+    return finished
+
+
+# Function to remove the logs, markers and worker output of a stage, to start it from scratch
+def clearStageLogs(checkpoint_path, stage, key):
+    for path in glob.glob(os.path.join(checkpoint_path, f"{stage}-{key}.*")):
+        os.remove(path)
+
+
+# Function to mark a shard as finished, with the IDs that failed (they are retried when the shard runs again)
+def markShardDone(log_path, scored, errors):
+    with open(os.path.splitext(log_path)[0] + ".done", "w") as f:
+        json.dump({"scored": scored, "errors": errors, "finished": time.strftime("%Y-%m-%d %H:%M:%S")}, f)
+
+
+# Function to read the .done marker of a shard, None while the shard is not finished
+def readShardDone(log_path):
+    path = os.path.splitext(log_path)[0] + ".done"
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+# Function to get the progress of all shards of a stage: posts, posts finished, failed posts and state per shard
+def shardProgress(checkpoint_path, stage, key, post_ids, num_shards):
+    finished = loadStageCheckpoint(checkpoint_path, stage, key)
+    rows = []
+    for index in range(num_shards):
+        shard_ids = [post_id for post_id in post_ids if shardOf(post_id, num_shards) == index]
+        log_path = stageLogPath(checkpoint_path, stage, key, index, num_shards)
+        done = readShardDone(log_path)
+        rows.append({
+            "shard": f"{index}/{num_shards}",
+            "posts": len(shard_ids),
+            "finished": sum(post_id in finished for post_id in shard_ids),
+            "errors": len(done["errors"]) if done else 0,
+            "state": "done" if done else ("running" if os.path.exists(log_path) else "waiting"),
+        })
+    progress = pd.DataFrame(rows).set_index("shard")
+    progress.loc["total"] = [progress["posts"].sum(), progress["finished"].sum(), progress["errors"].sum(),
+                             f"{(progress['state'] == 'done').sum()}/{num_shards} done"]
+    return progress
+
+
+# Function to run the shards of a stage as local worker processes and wait for them
+# command(index) gives the command line of the worker of a shard, its output goes to a .log file next to its shard log
+# Workers that fail are started again (they resume from their shard log) up to retries times
+def runLocalWorkers(command, log_path, num_shards, retries=2, poll_seconds=30, on_poll=None):
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    running = {}
+    attempts = {index: 0 for index in range(num_shards)}
+
+    def start(index):
+        attempts[index] += 1
+        output = open(shardSuffix(os.path.splitext(log_path)[0] + ".log", index, num_shards), "a")
+        running[index] = (subprocess.Popen(command(index), stdout=output, stderr=subprocess.STDOUT), output)
+
+    for index in range(num_shards):
+        start(index)
+    failed = []
+    last_poll = time.monotonic()
+    while running:
+        time.sleep(1)
+        for index, (process, output) in list(running.items()):
+            if process.poll() is None:
+                continue
+            output.close()
+            del running[index]
+            if process.returncode != 0:
+                if attempts[index] <= retries:
+                    print(f"Shard {index}/{num_shards} failed (exit code {process.returncode}), starting it again")
+                    start(index)
+                else:
+                    failed.append(index)
+        if on_poll is not None and time.monotonic() - last_poll >= poll_seconds:
+            on_poll()
+            last_poll = time.monotonic()
+    return failed
+
+
+# Function to get the command line that runs this script again for one shard of a stage
+def workerCommand(stage, index, num_shards):
+    return [sys.executable, os.path.abspath(sys.argv[0]), stage, "--shard", f"{index}/{num_shards}"]
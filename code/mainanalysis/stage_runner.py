@@ -0,0 +1,184 @@
+# stage_runner.py
+# Runs main.py as a graph of declared stages with explicit input and output files.
+# Every stage is keyed by a hash of the content of its input files, its parameters (e.g. modelID, seed) and the
+# source of the code that builds its prompts. The outputs of a finished stage are stored in the cache folder under
+# that key. When a stage is run again with the same key, its outputs are restored from the cache instead.
+# A changed prompt, model or upstream file therefore only reruns the stages that depend on it, and switching back to an
+# earlier setting reuses its outputs. Outputs are always (re)published in the output folder under their usual names.
+
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import time
+
+from tracing import tracer
+
+
+# Function to hash the content of a file in chunks
+def fileHash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Function to hash a piece of code: the source of a function, or a string such as a prompt template
+def codeHash(code):
+    text = code if isinstance(code, str) else inspect.getsource(code)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# Raised by a stage that cannot produce its outputs in this run, e.g. a shard worker or a merge waiting for shards
+# The runner stops without caching anything, the stages after it are not run
+class StageIncomplete(Exception):
+    pass
+
+
+class Stage:
+    # inputs / outputs: file names in the output folder, or paths of external files (e.g. the raw training data)
+    # params: values the outputs depend on, code: functions or prompt strings whose text the outputs depend on
+    def __init__(self, name, function, inputs, outputs, params, code):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = dict(params)
+        self.code = list(code)
+
+
+class StageRunner:
+    # output_path: folder of the published outputs, cache_path: folder of the cached outputs per stage and key
+    # force: names of stages to run even if their outputs are cached
+    def __init__(self, output_path, cache_path, force=()):
+        self.output_path = output_path
+        self.cache_path = cache_path
+        self.force = set(force)
+        self.stages = {}
+        self.producers = {}
+        self.keys = {}
+
+    # Decorator to declare a stage, run with runner.run(); the function writes its outputs to the output folder
+    def stage(self, name, inputs=(), outputs=(), params=None, code=()):
+        def register(function):
+            stage = Stage(name, function, inputs, outputs, params or {}, code)
+            for output in stage.outputs:
+                if output in self.producers:
+                    raise ValueError(f"{output} is an output of both {self.producers[output]} and {name}")
+                self.producers[output] = name
+            self.stages[name] = stage
+            return function
+        return register
+
+    # Function to get the path of an input or output file of a stage (files no stage produces are external paths)
+    def path(self, name):
+        return os.path.join(self.output_path, name) if name in self.producers else name
+
+    # Function to get the fingerprint of an input file: the content for files of the pipeline,
+    # size and modification time for external files (the raw training data is too large to hash on every run)
+    def inputFingerprint(self, name):
+        path = self.path(name)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Input {name} not found")
+        if name in self.producers:
+            return fileHash(path)
+        stat = os.stat(path)
+        return f"{stat.st_size}:{int(stat.st_mtime)}"
+
+    # Function to get the parts of the cache key of a stage (its inputs must exist)
+    def keyParts(self, stage):
+        return {
+            "inputs": {name: self.inputFingerprint(name) for name in stage.inputs},
+            "params": {name: repr(value) for name, value in sorted(stage.params.items())},
+            "code": {getattr(code, "__name__", f"text{idx}"): codeHash(code) for idx, code in enumerate(stage.code)},
+        }
+
+    # Function to get the cache key of a stage that was run (or restored) in this run, e.g. to name its checkpoint log
+    def key(self, name):
+        return self.keys[name]
+
+    # Function to get the stages needed for the targets in the order they were declared
+    def plan(self, targets=None):
+        if not targets:
+            return list(self.stages.values())
+        needed = set()
+        pending = list(targets)
+        while pending:
+            name = pending.pop()
+            if name not in self.stages:
+                raise ValueError(f"Unknown stage {name}")
+            if name in needed:
+                continue
+            needed.add(name)
+            pending += [self.producers[input_name] for input_name in self.stages[name].inputs if input_name in self.producers]
+        return [stage for name, stage in self.stages.items() if name in needed]
+
+    # Function to run the stages needed for targets (all stages by default), skipping the ones that are cached
+    # cached_only: only the targets may run, the stages they depend on must be cached (used by shard workers)
+    # Returns False if a stage raised StageIncomplete
+    def run(self, targets=None, cached_only=False):
+        os.makedirs(self.output_path, exist_ok=True)
+        for stage in self.plan(targets):
+            parts = self.keyParts(stage)
+            key = hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+            self.keys[stage.name] = key
+            cache_dir = os.path.join(self.cache_path, stage.name, key)
+            cached = all(os.path.exists(os.path.join(cache_dir, os.path.basename(output))) for output in stage.outputs)
+
+            if cached and stage.name not in self.force:
+                print(f"Stage {stage.name}: unchanged (key {key}), outputs restored from the cache")
+                for output in stage.outputs:
+                    self.publish(os.path.join(cache_dir, os.path.basename(output)), self.path(output))
+                continue
+
+            if cached_only and stage.name not in targets:
+                print(f"Stage {stage.name}: not cached, run it first")
+                return False
+            self.explainRun(stage, parts)
+            depth = len(tracer.stages)
+            tracer.begin(stage.name)
+            start = time.perf_counter()
+            try:
+                stage.function()
+            except StageIncomplete as e:
+                print(f"Stage {stage.name}: {e}")
+                return False
+            finally:
+                tracer.unwind(depth)
+            elapsed = time.perf_counter() - start
+
+            # Store the outputs under the key, the manifest records what the key was made of
+            os.makedirs(cache_dir, exist_ok=True)
+            for output in stage.outputs:
+                shutil.copyfile(self.path(output), os.path.join(cache_dir, os.path.basename(output)))
+            manifest = {"stage": stage.name, "key": key, "parts": parts, "seconds": round(elapsed, 1),
+                        "created": time.strftime("%Y-%m-%d %H:%M:%S")}
+            with open(os.path.join(cache_dir, "manifest.json"), "w") as f:
+                json.dump(manifest, f, indent=1)
+            with open(os.path.join(self.cache_path, stage.name, "latest.json"), "w") as f:
+                json.dump(manifest, f, indent=1)
+            print(f"Stage {stage.name}: done in {elapsed:.1f}s (key {key})")
+        return True
+
+    # Function to copy a cached output to the output folder, unless the same file is already there
+    def publish(self, source, target):
+        if os.path.exists(target) and fileHash(target) == fileHash(source):
+            return
+        shutil.copyfile(source, target)
+
+    # Function to print why a stage runs: what changed compared to its last run
+    def explainRun(self, stage, parts):
+        if stage.name in self.force:
+            print(f"Stage {stage.name}: forced to run")
+            return
+        latest_file = os.path.join(self.cache_path, stage.name, "latest.json")
+        if not os.path.exists(latest_file):
+            print(f"Stage {stage.name}: no cached outputs, running")
+            return
+        with open(latest_file) as f:
+            previous = json.load(f)["parts"]
+        changed = [f"{part} {name}" for part in parts for name in sorted(set(parts[part]) | set(previous.get(part, {})))
+                   if parts[part].get(name) != previous.get(part, {}).get(name)]
+        print(f"Stage {stage.name}: changed since the last run ({', '.join(changed) or 'outputs missing'}), running")
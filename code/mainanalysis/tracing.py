@@ -0,0 +1,133 @@
+# tracing.py
+# Span tracing of the pipeline, exported in the Chrome trace event format (open the file in ui.perfetto.dev
+# or chrome://tracing). main.py marks its stages with begin/end, the units within a stage (posts, pairs,
+# categories), the LLM calls and the parsing of their answers are nested spans.
+# Spans inside asyncio tasks (the concurrent C-SSRS scoring) overlap on one thread, so they are written as
+# async events with one track per worker task. Child tasks (e.g. of asyncio.wait_for) stay on the track of their worker.
+# Stages listed in profile_stages are also run under cProfile, for the CPU-bound pandas sections.
+
+import asyncio
+import contextlib
+import contextvars
+import cProfile
+import itertools
+import json
+import os
+import pstats
+import threading
+import time
+
+# Track of the async spans of the current task, inherited by the tasks it starts
+async_track = contextvars.ContextVar("async_track", default=None)
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+        self.tracks = itertools.count(1)
+        self.stages = []
+        # Stages to profile and the folder of the .prof files
+        self.profile_stages = set()
+        self.profile_path = None
+
+    # Function to switch tracing on, profile_stages: names of the stages to run under cProfile
+    def enable(self, profile_stages=(), profile_path=None):
+        self.enabled = True
+        self.profile_stages = set(profile_stages)
+        self.profile_path = profile_path
+
+    # Function to get the time since the start of the trace in microseconds
+    def now(self):
+        return (time.perf_counter() - self.origin) * 1e6
+
+    def add(self, event):
+        event["pid"] = self.pid
+        event.setdefault("tid", threading.get_ident())
+        with self.lock:
+            self.events.append(event)
+
+    # Function to start a stage of the pipeline (ended by end), stages can be nested
+    def begin(self, name, **args):
+        if not self.enabled:
+            return
+        profiler = None
+        if name in self.profile_stages:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        self.stages.append((name, profiler))
+        self.add({"name": name, "cat": "stage", "ph": "B", "ts": self.now(), "args": args})
+
+    # Function to end the last stage started with begin
+    def end(self):
+        if not self.enabled or not self.stages:
+            return
+        name, profiler = self.stages.pop()
+        self.add({"name": name, "cat": "stage", "ph": "E", "ts": self.now()})
+        if profiler is not None:
+            profiler.disable()
+            self.saveProfile(name, profiler)
+
+    # Function to end the stages that were started after depth stages were open (e.g. when a stage raised)
+    def unwind(self, depth):
+        while len(self.stages) > depth:
+            self.end()
+
+    # Function to trace a unit of work: with tracer.span("post", id=...): ...
+    @contextlib.contextmanager
+    def span(self, name, category="unit", **args):
+        if not self.enabled:
+            yield
+            return
+        try:
+            in_task = asyncio.current_task() is not None
+        except RuntimeError:
+            in_task = False
+        if not in_task:
+            start = self.now()
+            try:
+                yield
+            finally:
+                self.add({"name": name, "cat": category, "ph": "X", "ts": start, "dur": self.now() - start, "args": args})
+            return
+
+        # The first span of a task picks its track, which stays set in the (task-local) context
+        track = async_track.get()
+        if track is None:
+            track = next(self.tracks)
+            async_track.set(track)
+        self.add({"name": name, "cat": category, "ph": "b", "id": track, "ts": self.now(), "args": args})
+        try:
+            yield
+        finally:
+            self.add({"name": name, "cat": category, "ph": "e", "id": track, "ts": self.now()})
+
+    # Function to save the cProfile stats of a stage and print its most expensive functions
+    def saveProfile(self, name, profiler):
+        if self.profile_path is not None:
+            os.makedirs(self.profile_path, exist_ok=True)
+            profiler.dump_stats(os.path.join(self.profile_path, f"{name}.prof"))
+        print(f"Profile of stage {name}:")
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)
+
+    # Function to write the trace as Chrome trace JSON, with the names of the threads
+    def save(self, path):
+        if not self.enabled:
+            return
+        with self.lock:
+            events = list(self.events)
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for tid in sorted({event["tid"] for event in events}):
+            events.append({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid,
+                           "args": {"name": thread_names.get(tid, f"thread {tid}")}})
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+tracer = Tracer()
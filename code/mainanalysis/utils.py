@@ -1 +1,51 @@
-utils.py 
\ No newline at end of file
+# utils.py
+# Helper functions for loading the data
+
+import json
+import random
+
+import pandas as pd
+
+
+# Function to draw a seeded random sample of posts from a JSONL file without loading the whole file
+# The file is read line by line with reservoir sampling, so memory scales with the sample size and not the corpus size.
+# With stratify (e.g. "label"), the sample keeps the proportions of that column in the corpus.
+# IDs follow the scheme of the full-file loader: "ID" + line number + "_" + label
+def loadSampledDataset(path, n, seed=None, stratify=None):
+    rng = random.Random(seed)
+    reservoirs = {}
+    counts = {}
+    line_number = 0
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            # Without stratification all posts share one reservoir and only the kept lines are parsed
+            key = json.loads(line)[stratify] if stratify else None
+            seen = counts.get(key, 0)
+            reservoir = reservoirs.setdefault(key, [])
+            if seen < n:
+                reservoir.append((line_number, line))
+            else:
+                j = int(rng.random() * (seen + 1))
+                if j < n:
+                    reservoir[j] = (line_number, line)
+            counts[key] = seen + 1
+            line_number += 1
+
+    # Split the sample size over the strata in proportion to their size (largest remainder first)
+    total = sum(counts.values())
+    n = min(n, total)
+    quotas = {key: n * count // total for key, count in counts.items()}
+    remainders = sorted(counts, key=lambda key: n * counts[key] % total, reverse=True)
+    for key in remainders[:n - sum(quotas.values())]:
+        quotas[key] += 1
+
+    sampled = []
+    for key, reservoir in reservoirs.items():
+        sampled += rng.sample(reservoir, quotas[key])
+    sampled.sort()
+
+    dataset = pd.DataFrame([json.loads(line) for _, line in sampled], index=[line_number for line_number, _ in sampled])
+    dataset["ID"] = "ID" + dataset.index.astype(str) + "_" + dataset["label"]
+    return dataset
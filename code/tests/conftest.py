@@ -0,0 +1,18 @@
+# Unit tests of the helper modules of the analysis and the demo application (python -m pytest code/tests)
+# The shared modules (structured_output.py, rate_control.py, llm_cache.py, llm_metrics.py, near_duplicates.py) are
+# identical copies (checked by test_shared_modules.py), they are imported from mainanalysis. The modules that only exist
+# in demo_application (singleflight.py, api.py, app.py, asgi.py) are imported from there.
+
+import os
+import sys
+import tempfile
+
+code_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(code_dir, "mainanalysis"))
+sys.path.append(os.path.join(code_dir, "demo_application"))
+
+# functions.py creates its Together client, response cache and call log on import: the tests use a dummy API key,
+# no cache and a call log in a temporary folder instead of the output folder of the analysis
+os.environ.setdefault("TOGETHER_API_KEY", "test")
+os.environ["LLM_CACHE_DISABLED"] = "1"
+os.environ["LLM_METRICS_PATH"] = os.path.join(tempfile.mkdtemp(prefix="llm_tests_"), "llm_calls.jsonl")
@@ -0,0 +1,98 @@
+# Tests of the concurrent scoring engine of the C-SSRS pass (functions.runConcurrently, functions.scoreCSSRSConcurrently)
+# scoreCSSRSConcurrently runs against a stub of the async Together client, no request leaves the process
+
+import asyncio
+import json
+import re
+import types
+
+import httpx
+import pytest
+from together import APIStatusError
+
+import functions
+from rate_control import RateController
+
+
+# Function to score an input after a delay, "fail" raises and "slow" takes longer than the timeouts of the tests
+async def scoreAfterDelay(item):
+    name, delay = item
+    await asyncio.sleep(delay)
+    if name == "fail":
+        raise ValueError("stub failure")
+    if name == "slow":
+        await asyncio.sleep(5)
+    return name.upper()
+
+
+def testOutputsFollowTheInputOrder():
+    # The later inputs finish first
+    inputs = [(f"post{idx}", 0.05 - idx * 0.01) for idx in range(5)]
+    outputs, errors = asyncio.run(functions.runConcurrently(scoreAfterDelay, inputs, max_in_flight=5, timeout=None))
+    assert outputs == ["POST0", "POST1", "POST2", "POST3", "POST4"]
+    assert errors == [None] * 5
+
+
+def testFailureAndTimeoutOnlyAffectTheirOwnInput():
+    inputs = [("post0", 0.01), ("fail", 0.0), ("post2", 0.02), ("slow", 0.0), ("post4", 0.0)]
+    outputs, errors = asyncio.run(functions.runConcurrently(scoreAfterDelay, inputs, max_in_flight=2, timeout=0.5))
+    assert outputs == ["POST0", None, "POST2", None, "POST4"]
+    assert errors[1] == "stub failure"
+    assert errors[3] == "Timeout after 0.5s"
+    assert [errors[idx] for idx in (0, 2, 4)] == [None, None, None]
+
+
+def testOnResultIsCalledOncePerInput():
+    results = []
+    inputs = [("post0", 0.02), ("fail", 0.0), ("post2", 0.0)]
+    outputs, errors = asyncio.run(functions.runConcurrently(scoreAfterDelay, inputs, max_in_flight=3, timeout=None,
+                                                            on_result=lambda *result: results.append(result)))
+    assert sorted(results, key=lambda result: result[0]) == [(0, "POST0", None), (1, None, "stub failure"), (2, "POST2", None)]
+    # Every result is reported as soon as its input finishes, not in the order of the inputs
+    assert [result[0] for result in results] == [1, 2, 0]
+
+
+def testEmptyInput():
+    assert asyncio.run(functions.runConcurrently(scoreAfterDelay, [], max_in_flight=4, timeout=None)) == ([], [])
+
+
+# Stub of AsyncTogether: answers the C-SSRS prompt of the post "stub post <n>" after a delay that is shorter for the later posts,
+# and rejects the post "stub post fail" with a 400 (not retried by the rate controller)
+class StubAsyncTogether:
+    def __init__(self, timeout=None, max_retries=0):
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def create(self, model, messages, **params):
+        post = re.search(r"stub post (\w+)", messages[0]["content"]).group(1)
+        if post == "fail":
+            response = httpx.Response(400, request=httpx.Request("POST", "http://stub/v1/chat/completions"))
+            raise APIStatusError("status 400", response=response, body=None)
+        await asyncio.sleep(0.05 - int(post) * 0.01)
+        answer = {"brief_reasoning": f"post {post}", "answer1": "Yes", "answer2": "No", "answer3": "No",
+                  "answer4": "No", "answer5": "No", "frequency": int(post)}
+        message = types.SimpleNamespace(content=json.dumps(answer))
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=None)
+
+
+@pytest.fixture
+def stubClient(monkeypatch):
+    monkeypatch.setattr(functions, "AsyncTogether", StubAsyncTogether)
+    monkeypatch.setattr(functions, "rate_controller", RateController(initial_concurrency=8, max_concurrency=8, max_retries=0))
+
+
+def testScoreCSSRSConcurrentlyKeepsTheOrderOfThePosts(stubClient):
+    results = []
+    posts = ["stub post 0", "stub post 1", "stub post fail", "stub post 3", "stub post 4"]
+    outputs, errors = functions.scoreCSSRSConcurrently(posts, max_in_flight=5, timeout=1,
+                                                       on_result=lambda *result: results.append(result))
+    assert [json.loads(output)["frequency"] if output else None for output in outputs] == [0, 1, None, 3, 4]
+    assert [json.loads(output)["brief_reasoning"] for output in outputs if output] == ["post 0", "post 1", "post 3", "post 4"]
+    assert errors[2] is not None and "400" in errors[2]
+    assert [errors[idx] for idx in (0, 1, 3, 4)] == [None] * 4
+    assert sorted(result[0] for result in results) == [0, 1, 2, 3, 4]
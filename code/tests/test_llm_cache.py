@@ -0,0 +1,56 @@
+# Tests of the persistent LLM response cache and its size cap (llm_cache.py)
+
+import sqlite3
+
+from llm_cache import LLMCache
+
+
+def testHitsAndMisses(tmp_path):
+    cache = LLMCache(str(tmp_path / "cache.sqlite"))
+    key = LLMCache.key("model", [{"role": "user", "content": "hi"}], {})
+    assert key != LLMCache.key("model", [{"role": "user", "content": "hi"}], {"max_tokens": 10})
+    assert cache.get(key) is None
+    cache.put(key, "answer")
+    assert cache.get(key) == "answer"
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"], stats["bytes"]) == (1, 1, 1, 6)
+
+
+def testLeastRecentlyUsedAreEvicted(tmp_path):
+    cache = LLMCache(str(tmp_path / "cache.sqlite"), max_bytes=1000)
+    for idx in range(20):
+        cache.put(f"key{idx}", "x" * 100)
+    # A replaced response only counts once
+    cache.put("key19", "y" * 50)
+    assert cache.stats()["bytes"] == 950 and cache.stats()["entries"] == 10
+    assert cache.get("key9") is None and cache.get("key10") is not None
+
+
+def testRunningSizeMatchesTheTable(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = LLMCache(path, max_bytes=2000)
+    for idx in range(100):
+        cache.put(f"key{idx % 30}", "z" * (idx % 70 + 1))
+    entries, size = sqlite3.connect(path).execute("SELECT COUNT(*), SUM(size) FROM responses").fetchone()
+    assert (cache.stats()["entries"], cache.stats()["bytes"]) == (entries, size)
+    assert size <= 2000
+
+
+def testCacheWithoutRunningSizeIsSummedOnce(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+    conn.executemany("INSERT INTO responses VALUES (?, ?, ?, ?)", [(f"old{idx}", "abc", 3, idx) for idx in range(4)])
+    conn.commit()
+    conn.close()
+    cache = LLMCache(path)
+    assert (cache.stats()["entries"], cache.stats()["bytes"]) == (4, 12)
+    cache.put("old0", "abcdef")
+    assert cache.stats()["bytes"] == 15
+
+
+def testDisabledCacheStoresNothing(tmp_path):
+    cache = LLMCache(str(tmp_path / "cache.sqlite"), enabled=False)
+    cache.put("key", "answer")
+    assert cache.get("key") is None
+    assert not (tmp_path / "cache.sqlite").exists()
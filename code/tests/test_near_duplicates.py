@@ -0,0 +1,32 @@
+# Tests of the MinHash / LSH near-duplicate detection (near_duplicates.py)
+
+from near_duplicates import MinHashIndex, findNearDuplicates, shingles
+
+post = ("I have been feeling empty for months now and nothing I do seems to help. My friends stopped calling and "
+        "I spend most nights awake thinking about how tired I am of everything. I do not know who to talk to anymore.")
+other = ("Started a new job last week and honestly the commute is the worst part. Does anyone have tips for staying "
+         "awake on the train in the morning without drinking five coffees before nine?")
+
+
+def testShingles():
+    assert shingles("Hello, World!") == {"hello world"}
+    assert len(shingles(post)) == len(post.split()) - 4
+
+
+def testRepostsAreGroupedWithTheFirstPost():
+    repost = post.upper().replace(".", "!") + " Thanks for reading."
+    duplicates = findNearDuplicates(["a", "b", "c", "d"], [post, other, repost, post], threshold=0.8)
+    assert duplicates == [None, None, "a", "a"]
+
+
+def testDifferentPostsAreKept():
+    edited = post.replace("months", "weeks").replace("friends stopped calling", "family does not understand")
+    duplicates = findNearDuplicates(["a", "b", "c"], [post, other, edited], threshold=0.9)
+    assert duplicates == [None, None, None]
+
+
+def testStats():
+    index = MinHashIndex(threshold=0.9)
+    for key, text in enumerate([post, post, other]):
+        index.add(key, text)
+    assert index.stats() == {"posts": 3, "near_duplicates": 1}
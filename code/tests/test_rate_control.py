@@ -0,0 +1,132 @@
+# Tests of the adaptive concurrency limit, the token buckets and the retries of the rate controller (rate_control.py)
+
+import asyncio
+import time
+
+import httpx
+import pytest
+from together import APIStatusError
+
+from rate_control import (AdaptiveConcurrency, RateController, TokenBucket, classifyError, estimateRequestTokens, estimateTokens,
+                          parseRetryAfter)
+
+
+def statusError(status_code, headers=None):
+    response = httpx.Response(status_code, headers=headers, request=httpx.Request("POST", "http://stub/v1/chat/completions"))
+    return APIStatusError(f"status {status_code}", response=response, body=None)
+
+
+def testLimitGrowsAfterSuccessesAndHalvesOnThrottling():
+    concurrency = AdaptiveConcurrency(initial=4, max_limit=8)
+    for _ in range(3):
+        concurrency.release(concurrency.acquire(), "ok", 0.1)
+    assert int(concurrency.limit) == 7
+
+    # The calls in flight when throttling starts fail together, that is one decrease and not several
+    started = [concurrency.acquire() for _ in range(3)]
+    for call_started in started:
+        concurrency.release(call_started, "throttled")
+    assert int(concurrency.limit) == 3 and concurrency.decreases == 1
+    assert concurrency.in_flight == 0
+
+
+def testSlowCallsDoNotRaiseTheLimit():
+    concurrency = AdaptiveConcurrency(initial=2, max_limit=8, latency_factor=3.0)
+    concurrency.release(concurrency.acquire(), "ok", 0.1)
+    limit = concurrency.limit
+    concurrency.release(concurrency.acquire(), "ok", 1.0)
+    assert concurrency.limit == limit
+
+
+def acquireWithCancelledWaiter(cancel_after_wake_up):
+    async def run():
+        concurrency = AdaptiveConcurrency(initial=1, min_limit=1, max_limit=1)
+        started = await concurrency.acquireAsync()
+        first = asyncio.create_task(concurrency.acquireAsync())
+        second = asyncio.create_task(concurrency.acquireAsync())
+        await asyncio.sleep(0)
+        concurrency.release(started, "ok", 0.1)
+        if cancel_after_wake_up:
+            await asyncio.sleep(0)
+        first.cancel()
+        # The wake-up of the cancelled waiter goes to the next one instead of being lost
+        await asyncio.wait_for(second, timeout=1)
+        return concurrency.in_flight, first.cancelled()
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("cancel_after_wake_up", [False, True])
+def testCancelledWaiterPassesOnItsSlot(cancel_after_wake_up):
+    assert acquireWithCancelledWaiter(cancel_after_wake_up) == (1, True)
+
+
+def testCancelledCallFreesItsSlot():
+    async def run():
+        controller = RateController(initial_concurrency=1, max_concurrency=1)
+        call = asyncio.create_task(controller.callAsync(lambda: asyncio.sleep(10)))
+        await asyncio.sleep(0.01)
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call
+        return controller.concurrency.in_flight
+    assert asyncio.run(run()) == 0
+
+
+def testTokenBucketQueuesCallers():
+    bucket = TokenBucket(60, capacity=2)
+    assert bucket.reserve(1) == 0.0
+    assert bucket.reserve(1) == 0.0
+    # One token per second: the next callers wait about 1 and 2 seconds
+    assert bucket.reserve(1) == pytest.approx(1.0, abs=0.05)
+    assert bucket.reserve(1) == pytest.approx(2.0, abs=0.05)
+
+
+def testRequestTokensAreCountedLikeThePrompts():
+    messages = [{"role": "user", "content": "Ich fühle mich so müde 😔 ..."}, {"role": "assistant", "content": "Please answer:"}]
+    assert estimateRequestTokens(messages, 100) == estimateTokens(messages[0]["content"]) + estimateTokens(messages[1]["content"]) + 100
+    # Without tiktoken, emoji and non-Latin text count their UTF-8 bytes instead of 4 characters per token
+    assert estimateTokens("😔" * 8) > len("😔" * 8) // 4
+
+
+def testClassifyErrors():
+    assert classifyError(statusError(429)) == "throttled"
+    assert classifyError(statusError(503)) == "error"
+    assert classifyError(statusError(400)) == "fatal"
+    assert classifyError(TimeoutError()) == "error"
+    assert classifyError(ValueError()) == "fatal"
+
+
+def testParseRetryAfter():
+    assert parseRetryAfter("2.5") == 2.5
+    assert parseRetryAfter(None) is None
+    assert parseRetryAfter("not a date") is None
+    date = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(time.time() + 30))
+    assert 25 < parseRetryAfter(date) <= 31
+
+
+def testThrottledCallsAreRetried():
+    controller = RateController(max_retries=3, backoff=0.001)
+    answers = [statusError(429, {"retry-after": "0"}), TimeoutError(), "answer"]
+
+    def call():
+        answer = answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    assert controller.call(call) == "answer"
+    stats = controller.stats()
+    assert stats["retries"] == 2 and stats["throttled"] == 1 and stats["errors"] == 1 and stats["failed"] == 0
+
+
+def testFatalErrorsAreNotRetried():
+    controller = RateController(max_retries=3, backoff=0.001)
+    calls = []
+
+    def call():
+        calls.append(1)
+        raise statusError(400)
+
+    with pytest.raises(APIStatusError):
+        controller.call(call)
+    assert len(calls) == 1 and controller.stats()["failed"] == 1
@@ -0,0 +1,45 @@
+# Tests of the int8 rating matrix of the feature evaluation (rating_store.py)
+
+import numpy as np
+import pandas as pd
+
+from rating_store import RatingMatrix
+
+
+def createMatrix():
+    matrix = RatingMatrix(["ID1_a", "ID2_b", "ID3_c"], ["f1", "f2", "f2", "f3"])
+    matrix.setRatings("ID1_a", {"ID": "ID1_a", "f1": 3, "f2": "0", "f3": 2})
+    matrix.setRatings("ID2_b", {"f1": 1, "f2": 7, "f4": 2, "f3": None})
+    return matrix
+
+
+def testRatingsAreStoredAsInt8():
+    matrix = createMatrix()
+    assert matrix.feature_ids == ["f1", "f2", "f3"]
+    assert matrix.values.dtype == np.int8
+    assert matrix.values[0].tolist() == [3, 0, 2]
+    assert matrix.mask.tolist() == [[True, True, True], [True, False, False], [False, False, False]]
+
+
+def testInvalidAndUnknownRatingsAreCounted():
+    matrix = createMatrix()
+    # f2 = 7 is out of range and f3 = None is not a rating, f4 is not defined (the ID field is not counted)
+    assert matrix.invalid_ratings == 2
+    assert matrix.unknown_features == 1
+    assert matrix.missingRate().round(4).tolist() == [0.3333, 0.6667, 0.6667]
+
+
+def testCSVRoundTrip(tmp_path):
+    path = tmp_path / "evaluated_features.csv"
+    createMatrix().toCSV(path)
+    loaded = pd.read_csv(path)
+    assert loaded.columns.tolist() == ["ID", "f1", "f2", "f3"]
+    assert loaded["ID"].tolist() == ["ID1_a", "ID2_b", "ID3_c"]
+    assert loaded["f1"].tolist()[:2] == [3, 1] and pd.isna(loaded.loc[2, "f1"])
+    assert loaded.loc[0, "f2"] == 0 and pd.isna(loaded.loc[1, "f2"])
+
+
+def testDataFrameKeepsMissingRatings():
+    frame = createMatrix().toDataFrame()
+    assert str(frame["f1"].dtype) == "Int8"
+    assert frame["f3"].isna().tolist() == [False, True, True]
@@ -0,0 +1,51 @@
+# Tests of the seeded reservoir sampling of the training data (utils.loadSampledDataset)
+
+import json
+
+import pytest
+
+from utils import loadSampledDataset
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    # 600 SuicideWatch, 300 depression and 100 Anxiety posts, with an empty line in between
+    path = tmp_path / "train.jsonl"
+    labels = ["SuicideWatch"] * 600 + ["depression"] * 300 + ["Anxiety"] * 100
+    with open(path, "w", encoding="utf-8") as f:
+        for idx, label in enumerate(labels):
+            f.write(json.dumps({"text": f"post {idx}", "label": label}) + "\n")
+            if idx == 10:
+                f.write("\n")
+    return path
+
+
+def testSampleIsSeeded(corpus):
+    first = loadSampledDataset(corpus, 50, seed=1)
+    assert len(first) == 50
+    assert first["ID"].tolist() == loadSampledDataset(corpus, 50, seed=1)["ID"].tolist()
+    assert first["ID"].tolist() != loadSampledDataset(corpus, 50, seed=2)["ID"].tolist()
+
+
+def testIDsFollowTheLineNumbers(corpus):
+    dataset = loadSampledDataset(corpus, 1000, seed=1)
+    # Empty lines are not counted, so the post "post N" is line N
+    assert (dataset["text"] == "post " + dataset.index.astype(str)).all()
+    assert (dataset["ID"] == "ID" + dataset.index.astype(str) + "_" + dataset["label"]).all()
+    assert dataset.index.is_monotonic_increasing
+
+
+def testSampleLargerThanCorpus(corpus):
+    assert len(loadSampledDataset(corpus, 5000, seed=1)) == 1000
+    assert len(loadSampledDataset(corpus, 5000, seed=1, stratify="label")) == 1000
+
+
+def testStratifiedQuotas(corpus):
+    counts = loadSampledDataset(corpus, 100, seed=3, stratify="label")["label"].value_counts()
+    assert counts.to_dict() == {"SuicideWatch": 60, "depression": 30, "Anxiety": 10}
+
+
+def testStratifiedQuotasLargestRemainder(corpus):
+    # 7 posts: 4.2, 2.1 and 0.7, so the remaining post goes to the largest remainder (Anxiety)
+    counts = loadSampledDataset(corpus, 7, seed=3, stratify="label")["label"].value_counts()
+    assert counts.to_dict() == {"SuicideWatch": 4, "depression": 2, "Anxiety": 1}
@@ -0,0 +1,52 @@
+# Tests of the 400 answers of the demo application to invalid requests, in the ASGI (asgi.py) and the Flask (app.py) mode
+# No request reaches the evaluation, so no LLM call is made
+
+import pytest
+from starlette.testclient import TestClient
+
+import app
+import asgi
+
+
+@pytest.fixture(scope="module")
+def asgiClient():
+    # Without the context manager the lifespan (opening the shared LLM client) is not run
+    return TestClient(asgi.app)
+
+
+@pytest.fixture(scope="module")
+def flaskClient():
+    return app.app.test_client()
+
+
+@pytest.mark.parametrize("path", ["/evaluate", "/evaluate_cssrs", "/evaluate_features"])
+@pytest.mark.parametrize("body", [b'{"text_input": "I feel', b'["I feel tired"]', b'"I feel tired"', b"", b"\xff\xfe"])
+def testBodyThatIsNotAJSONObject(asgiClient, flaskClient, path, body):
+    headers = {"Content-Type": "application/json"}
+    asgi_response = asgiClient.post(path, content=body, headers=headers)
+    flask_response = flaskClient.post(path, data=body, headers=headers)
+    assert asgi_response.status_code == flask_response.status_code == 400
+    assert asgi_response.json() == flask_response.get_json() == {"error": "The request body must be a JSON object"}
+
+
+@pytest.mark.parametrize("body", [b"", b" \n"])
+def testEmptyBatchFile(asgiClient, flaskClient, body):
+    asgi_response = asgiClient.post("/evaluate_batch", content=body)
+    flask_response = flaskClient.post("/evaluate_batch", data=body)
+    assert asgi_response.status_code == flask_response.status_code == 400
+    assert asgi_response.json() == flask_response.get_json() == {"error": "The batch file is empty"}
+
+
+def testBatchUploadErrors(asgiClient, flaskClient):
+    cases = [
+        ({"files": {"other": ("posts.jsonl", b"{}")}}, {"data": {"other": "x"}, "content_type": "multipart/form-data"}, "Missing file field"),
+        ({"content": b"\xff\xfe"}, {"data": b"\xff\xfe"}, "The batch file is not UTF-8 text"),
+    ]
+    for asgi_request, flask_request, error in cases:
+        asgi_response = asgiClient.post("/evaluate_batch", **asgi_request)
+        flask_response = flaskClient.post("/evaluate_batch", **flask_request)
+        assert asgi_response.status_code == flask_response.status_code == 400
+        assert asgi_response.json() == flask_response.get_json() == {"error": error}
+    asgi_response = asgiClient.post("/evaluate_batch?max_concurrent=many", content=b'{"text_input": "I feel tired"}\n')
+    flask_response = flaskClient.post("/evaluate_batch?max_concurrent=many", data=b'{"text_input": "I feel tired"}\n')
+    assert asgi_response.status_code == flask_response.status_code == 400
@@ -0,0 +1,72 @@
+# Tests of the shard assignment and the merge of the shard logs (sharding.py)
+
+from checkpoint import appendCheckpoint
+from sharding import (clearStageLogs, loadStageCheckpoint, markShardDone, readShardDone, shardOf, shardProgress,
+                      shardSuffix, stageLogPath)
+
+post_ids = [f"ID{idx}_SuicideWatch" for idx in range(40)]
+
+
+def testShardOfIsStableAndCoversAllShards():
+    shards = [shardOf(post_id, 4) for post_id in post_ids]
+    assert shards == [shardOf(post_id, 4) for post_id in post_ids]
+    assert set(shards) == {0, 1, 2, 3}
+    # Fixed values: the assignment must not depend on the process (unlike hash()), workers on other hosts agree on it
+    assert shards[:8] == [0, 0, 0, 3, 1, 3, 0, 3]
+
+
+def testShardSuffix():
+    assert shardSuffix("/out/trace.json", 1, 4) == "/out/trace.shard-1-of-4.json"
+    assert stageLogPath("/cp", "cssrs_ratings", "abc", 0, 2) == "/cp/cssrs_ratings-abc.shard-0-of-2.jsonl"
+
+
+def writeShards(checkpoint_path, num_shards, finished_shards):
+    for post_id in post_ids:
+        index = shardOf(post_id, num_shards)
+        if index in finished_shards:
+            appendCheckpoint(stageLogPath(checkpoint_path, "stage", "key", index, num_shards), {"ID": post_id, "value": 1})
+    for index in finished_shards:
+        markShardDone(stageLogPath(checkpoint_path, "stage", "key", index, num_shards), 10, {})
+
+
+def testMergeReadsAllShardLogs(tmp_path):
+    writeShards(str(tmp_path), 2, [0, 1])
+    # A single-process log of the same key is merged as well, a later record of a post wins
+    appendCheckpoint(stageLogPath(str(tmp_path), "stage", "key"), {"ID": "extra", "value": 2})
+    appendCheckpoint(stageLogPath(str(tmp_path), "stage", "key", 1, 2), {"ID": post_ids[0], "value": 3})
+    # Logs of another key are not merged
+    appendCheckpoint(stageLogPath(str(tmp_path), "stage", "other"), {"ID": "stale", "value": 4})
+
+    finished = loadStageCheckpoint(str(tmp_path), "stage", "key")
+    assert set(finished) == set(post_ids) | {"extra"}
+    assert finished[post_ids[0]]["value"] == 3
+
+
+def testMergeIgnoresIncompleteLastLine(tmp_path):
+    writeShards(str(tmp_path), 2, [0])
+    with open(stageLogPath(str(tmp_path), "stage", "key", 0, 2), "a") as f:
+        f.write('{"ID": "cut')
+    finished = loadStageCheckpoint(str(tmp_path), "stage", "key")
+    assert set(finished) == {post_id for post_id in post_ids if shardOf(post_id, 2) == 0}
+
+
+def testDoneMarkerAndProgress(tmp_path):
+    writeShards(str(tmp_path), 3, [0, 2])
+    assert readShardDone(stageLogPath(str(tmp_path), "stage", "key", 1, 3)) is None
+    assert readShardDone(stageLogPath(str(tmp_path), "stage", "key", 0, 3))["scored"] == 10
+
+    progress = shardProgress(str(tmp_path), "stage", "key", post_ids, 3)
+    assert progress.loc["1/3", "state"] == "waiting" and progress.loc["1/3", "finished"] == 0
+    assert progress.loc["0/3", "state"] == "done"
+    assert progress.loc["0/3", "finished"] == progress.loc["0/3", "posts"]
+    assert progress.loc["total", "posts"] == len(post_ids)
+    assert progress.loc["total", "state"] == "2/3 done"
+
+
+def testClearStageLogs(tmp_path):
+    writeShards(str(tmp_path), 2, [0, 1])
+    appendCheckpoint(stageLogPath(str(tmp_path), "stage", "other"), {"ID": "stale"})
+    clearStageLogs(str(tmp_path), "stage", "key")
+    assert loadStageCheckpoint(str(tmp_path), "stage", "key") == {}
+    assert readShardDone(stageLogPath(str(tmp_path), "stage", "key", 0, 2)) is None
+    assert list(loadStageCheckpoint(str(tmp_path), "stage", "other")) == ["stale"]
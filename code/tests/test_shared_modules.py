@@ -0,0 +1,20 @@
+# The modules used by both the analysis and the demo application are copied into both folders, because the Docker
+# image of the demo application is built from code/demo_application alone. The copies must not drift apart.
+
+import filecmp
+import os
+
+code_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+analysis_dir = os.path.join(code_dir, "mainanalysis")
+demo_dir = os.path.join(code_dir, "demo_application")
+
+
+def sharedModules():
+    return sorted(set(name for name in os.listdir(analysis_dir) if name.endswith(".py")) & set(os.listdir(demo_dir)))
+
+
+def testSharedModulesAreIdentical():
+    shared = sharedModules()
+    assert {"llm_cache.py", "llm_metrics.py", "near_duplicates.py", "rate_control.py", "structured_output.py"} <= set(shared)
+    different = [name for name in shared if not filecmp.cmp(os.path.join(analysis_dir, name), os.path.join(demo_dir, name), shallow=False)]
+    assert different == [], f"copy the changes to both code/mainanalysis and code/demo_application: {different}"
@@ -0,0 +1,71 @@
+# Tests of the coalescing of identical in-flight requests of the demo application (singleflight.py)
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from singleflight import SingleFlight, requestKey
+
+
+def testRequestKeyIgnoresWhitespaceAndNormalization():
+    assert requestKey("cssrs", "  I feel\n tired ") == requestKey("cssrs", "I feel tired")
+    assert requestKey("cssrs", "café") == requestKey("cssrs", "café")
+    assert requestKey("cssrs", "I feel tired") != requestKey("features", "I feel tired")
+
+
+def testConcurrentThreadsShareOneCall():
+    flight = SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def evaluate(text):
+        calls.append(text)
+        release.wait(5)
+        return {"text": text}
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do("key", evaluate, "post"))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    while flight.stats()["waiting"] < 4:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert calls == ["post"] and len(results) == 5
+    # Waiters get copies, so no request can change the result of another one
+    assert all(result == {"text": "post"} for result in results)
+    assert len({id(result) for result in results}) == 5
+    assert flight.stats()["coalesced_hits"] == 4 and flight.stats()["in_flight"] == 0
+
+
+def testErrorsReachEveryWaiterAndAreNotKept():
+    flight = SingleFlight()
+
+    def fail():
+        raise ValueError("upstream failed")
+
+    with pytest.raises(ValueError):
+        flight.do("key", fail)
+    assert flight.do("key", lambda: "ok") == "ok"
+
+
+def testCancelledRequestDoesNotCancelTheSharedCall():
+    async def run():
+        flight = SingleFlight()
+        calls = []
+
+        async def evaluate():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "result"
+
+        first = asyncio.create_task(flight.doAsync("key", evaluate))
+        second = asyncio.create_task(flight.doAsync("key", evaluate))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second, len(calls), flight.stats()["in_flight"]
+    assert asyncio.run(run()) == ("result", 1, 0)
@@ -0,0 +1,69 @@
+# Tests of the repair, validation and re-ask of LLM answers (structured_output.py)
+
+import json
+
+from structured_output import extractJSON, parseStructured, parseStats, schemas, validateStructured
+
+cssrs_answer = {"brief_reasoning": "r", "answer1": "Yes", "answer2": "No", "answer3": "No", "answer4": "No", "answer5": "No", "frequency": 2}
+
+
+def parseCSSRS(text):
+    return extractJSON(text, "object", schemas["cssrs"][1])
+
+
+def testValidJSONNeedsNoRepair():
+    value, repairs = parseCSSRS(json.dumps(cssrs_answer))
+    assert value["answer1"] == "Yes" and value["frequency"] == 2
+    assert repairs == set()
+
+
+def testRepairsCodeFenceAndSurroundingText():
+    value, repairs = parseCSSRS("Here is my answer:\n```json\n" + json.dumps(cssrs_answer) + "\n```\nTake care.")
+    assert value["answer1"] == "Yes"
+    assert "surrounding text" in repairs
+
+
+def testRepairsSingleQuotesTrailingCommasAndPythonLiterals():
+    text = "{'brief_reasoning': 'r', 'answer1': True, 'answer2': 'no', 'answer3': 'No', 'answer4': 'No', 'answer5': 'No', 'frequency': 1,}"
+    value, repairs = parseCSSRS(text)
+    assert value["answer1"] == "Yes" and value["answer2"] == "No" and value["frequency"] == 1
+    assert repairs
+
+
+def testRepairsTruncatedList():
+    text = '[{"featureid": "f1", "rating": 2}, {"featureid": "f2", "rating": 3}, {"featureid": "f3", "rat'
+    value, _ = extractJSON(text, "array", schemas["feature_ratings"][1])
+    assert value == [{"featureid": "f1", "rating": 2}, {"featureid": "f2", "rating": 3}]
+
+
+def testRatingsAreCoercedAndChecked():
+    value, error = validateStructured({"f1": "2", "f2": 3.0}, "feature_ratings")
+    assert error is None and [entry["rating"] for entry in value] == [2, 3]
+    assert validateStructured({"f1": 4}, "feature_ratings")[1] is not None
+    assert validateStructured({"f1": 1.5}, "feature_ratings")[1] is not None
+
+
+def testFeatureScoresKeepValidRatings():
+    value, error = validateStructured({"a": "2", "b": "high", "c": 2.5, "d": 0}, "feature_scores")
+    assert error is None
+    assert value == {"a": 2, "b": None, "c": None, "d": 0}
+    assert validateStructured({"a": "high"}, "feature_scores")[1] == "no valid feature ratings"
+
+
+def testReaskOnlyWhenRepairFails():
+    sent = []
+    reask = lambda messages: sent.append(messages) or json.dumps(cssrs_answer)
+    value, error = parseStructured("I cannot answer that.", "cssrs", reask=reask)
+    assert error is None and value["answer1"] == "Yes"
+    assert len(sent) == 1 and "I cannot answer that." in sent[0][0]["content"]
+
+    sent.clear()
+    parseStructured(json.dumps(cssrs_answer), "cssrs", reask=reask)
+    assert sent == []
+
+
+def testFailedReaskIsCounted():
+    before = parseStats().get("cssrs", {}).get("failed", 0)
+    value, error = parseStructured("no json", "cssrs", reask=lambda messages: "still no json")
+    assert value is None and error
+    assert parseStats()["cssrs"]["failed"] == before + 1